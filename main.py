@@ -1,3 +1,4 @@
+import os
 import argparse
 import pathlib
 
@@ -8,6 +9,7 @@ from injector import Injector
 from yadt import ui_styling
 
 from yadt.configuration_injector import InjectorConfiguration
+from yadt.db_pool import SQLITE_PROFILES
 from yadt.ui_image import ImagePage
 from yadt.ui_dataset import DatasetPage
 # from yadt.ui_directory import DirectoryPage
@@ -28,6 +30,23 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--score-slider-step", type=float, default=0.05)
     parser.add_argument("--score-general-threshold", type=float, default=0.35)
     parser.add_argument("--score-character-threshold", type=float, default=0.9)
+    parser.add_argument("--score-threshold-table", type=pathlib.Path, default=None, help="json file with per category and per tag thresholds, taking precedence over the threshold sliders")
+    parser.add_argument("--score-general-top-k", type=int, default=0, help="keep at most this many general tags per image (0 keeps all of them)")
+    parser.add_argument("--score-character-top-k", type=int, default=0, help="keep at most this many character tags per image (0 keeps all of them)")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--model-cache-size", type=float, default=8, help="memory budget in GiB for keeping multiple models loaded")
+    parser.add_argument("--dataset-workers", type=int, default=min(8, os.cpu_count() or 1), help="threads used for reading and decoding dataset images")
+    parser.add_argument("--post-process-cache-size", type=int, default=20000, help="number of post processed dataset images kept in memory for resubmitting with the same settings (0 disables it)")
+    parser.add_argument("--dataset-cache-size", type=float, default=0, help="budget in GiB for cached predictions in the dataset database, least recently used ones are evicted beyond it (0 keeps everything)")
+    parser.add_argument("--verify-file-hashes", action="store_true", help="always rehash dataset files instead of trusting unchanged file stats")
+    parser.add_argument("--sqlite-profile", type=str, default="wal", choices=list(SQLITE_PROFILES), help="pragmas the dataset database is tuned with")
+    parser.add_argument("--model-idle-timeout", type=float, default=0, help="seconds after which unused models are unloaded (0 keeps them loaded)")
+    parser.add_argument("--onnx-graph-optimization-level", type=str, default="all", choices=["disable", "basic", "extended", "all"])
+    parser.add_argument("--onnx-intra-op-threads", type=int, default=0, help="0 lets onnxruntime decide")
+    parser.add_argument("--onnx-inter-op-threads", type=int, default=0, help="0 lets onnxruntime decide")
+    parser.add_argument("--onnx-execution-mode", type=str, default="sequential", choices=["sequential", "parallel"])
+    parser.add_argument("--onnx-disable-mem-arena", action="store_true")
+    parser.add_argument("--onnx-disable-mem-pattern", action="store_true")
     parser.add_argument("--share", action="store_true")
     return parser.parse_args()
 
@@ -44,6 +63,10 @@ def main():
 
     print('* Using device:', args.device)
 
+    assert args.batch_size > 0, "--batch-size must be at least 1"
+    assert args.score_general_top_k >= 0, "--score-general-top-k can't be negative"
+    assert args.score_character_top_k >= 0, "--score-character-top-k can't be negative"
+
     cache_folder = pathlib.Path(__file__).parent / '.cache_save'
     cache_folder.mkdir(exist_ok=True)
 
@@ -54,7 +77,24 @@ def main():
         cache_folder=cache_folder,
         score_character_threshold=args.score_character_threshold,
         score_general_threshold=args.score_general_threshold,
-        score_slider_step=args.score_slider_step
+        score_slider_step=args.score_slider_step,
+        batch_size=args.batch_size,
+        score_threshold_table=args.score_threshold_table,
+        score_general_top_k=args.score_general_top_k,
+        score_character_top_k=args.score_character_top_k,
+        model_cache_max_bytes=int(args.model_cache_size * 1024**3),
+        model_idle_timeout=args.model_idle_timeout,
+        dataset_workers=args.dataset_workers,
+        post_process_cache_size=args.post_process_cache_size,
+        dataset_cache_max_bytes=int(args.dataset_cache_size * 1024**3),
+        verify_file_hashes=args.verify_file_hashes,
+        sqlite_profile=args.sqlite_profile,
+        onnx_graph_optimization_level=args.onnx_graph_optimization_level,
+        onnx_intra_op_threads=args.onnx_intra_op_threads,
+        onnx_inter_op_threads=args.onnx_inter_op_threads,
+        onnx_execution_mode=args.onnx_execution_mode,
+        onnx_enable_mem_arena=not args.onnx_disable_mem_arena,
+        onnx_enable_mem_pattern=not args.onnx_disable_mem_pattern,
     ))
 
     with gr.Blocks(title=TITLE, css=ui_styling.CSS) as demo:
@@ -0,0 +1,402 @@
+"""
+Offline benchmarks of the tagging and post processing hot paths, on synthetic predictions, map_tags rules and wiki pages.
+
+    python -m yadt.benchmark --output baseline.json
+    python -m yadt.benchmark --baseline baseline.json
+"""
+
+import sys
+import json
+import time
+import pathlib
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from yadt import process_prediction
+from yadt.tagger_prediction import Prediction, TagVocabulary
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# the same data is generated on every run, so results can be compared between runs
+BENCHMARK_SEED = 0
+
+# roughly the vocabulary sizes of the smallest and largest supported taggers
+BENCHMARK_TAG_COUNTS = (10000, 70000)
+
+# benchmarks taking this much longer than their baseline are reported as regressions
+BENCHMARK_MAX_REGRESSION = 1.25
+
+# every benchmark is timed for at least this long per repeat, calling it as many times as needed
+BENCHMARK_MIN_SECONDS = 0.2
+
+_RATINGS = ('rating_general', 'rating_sensitive', 'rating_questionable', 'rating_explicit')
+
+_SYLLABLES = ('ka', 'ri', 'mo', 'na', 'to', 'shi', 'ra', 'lo', 'me', 'ha', 'yu', 'ki', 'so', 'ne', 'po', 'za', 'an', 'er', 'el', 'on')
+
+@dataclass
+class Benchmark:
+    name: str
+    run: Callable[[], object]
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    seconds: float
+    min_seconds: float
+    number: int
+    repeat: int
+
+def _synthetic_names(rng: np.random.Generator, parts: np.ndarray, count: int, make: Callable[[List[str], int], str], max_parts: int, p: List[float] = None) -> List[str]:
+    names = {}
+
+    while len(names) < count:
+        rows = parts[rng.integers(0, len(parts), size=(count, max_parts))].tolist()
+        lengths = (rng.choice(max_parts, size=count, p=p) + 1).tolist()
+
+        for row, length in zip(rows, lengths):
+            names.setdefault(make(row, length), None)
+
+    return list(names)[:count]
+
+def _synthetic_words(rng: np.random.Generator, count: int) -> np.ndarray:
+    return np.array(_synthetic_names(rng, np.array(_SYLLABLES, dtype=object), count, lambda row, length: ''.join(row[:length]), 4), dtype=object)
+
+def synthetic_vocabulary(rng: np.random.Generator, tag_count: int) -> TagVocabulary:
+    """A vocabulary shaped like a danbooru tagger's: a few ratings, a quarter characters and the rest general tags."""
+    words = _synthetic_words(rng, max(tag_count // 8, 64))
+
+    character_count = tag_count // 4
+    general_count = tag_count - character_count - len(_RATINGS)
+
+    # general tags share their words a lot (e.g. 'long_hair' & 'very_long_hair'), which is what trimming dupes is about
+    general_names = _synthetic_names(rng, words, general_count, lambda row, length: '_'.join(row[:length]), 3, [0.3, 0.5, 0.2])
+    character_names = _synthetic_names(rng, words, character_count, lambda row, _: f'{row[0]}_{row[1]}_({row[2]})', 3)
+
+    return TagVocabulary(
+        [*_RATINGS, *general_names, *character_names],
+        range(len(_RATINGS)),
+        range(len(_RATINGS), len(_RATINGS) + general_count),
+        range(len(_RATINGS) + general_count, tag_count),
+    )
+
+def synthetic_scores(rng: np.random.Generator, vocabulary: TagVocabulary, images: int) -> np.ndarray:
+    """Scores of a tagger that's fairly sure about a few dozen general tags and a character per image, and not about the rest."""
+    scores = rng.beta(0.3, 30.0, size=(images, len(vocabulary))).astype(np.float32)
+    rows = np.arange(images)[:, np.newaxis]
+
+    scores[rows, rng.choice(vocabulary.general_indexes, size=(images, 40))] = rng.uniform(0.2, 1.0, size=(images, 40))
+    scores[rows, rng.choice(vocabulary.character_indexes, size=(images, 2))] = rng.uniform(0.5, 1.0, size=(images, 2))
+    scores[:, vocabulary.rating_indexes] = rng.dirichlet(np.ones(len(vocabulary.rating_indexes)), size=images)
+
+    return scores
+
+def _general_tags(vocabulary: TagVocabulary) -> np.ndarray:
+    # with spaces instead of underscores, the way post processing sees the tags
+    return np.array(sorted(vocabulary.category_names('general', replace_underscores=True)), dtype=object)
+
+def synthetic_map_tags(rng: np.random.Generator, vocabulary: TagVocabulary, rules: int) -> str:
+    tags = _general_tags(vocabulary)
+    lines = ['# synthetic rules']
+
+    for i in range(rules):
+        condition = ' & '.join(tags[rng.choice(len(tags), size=rng.integers(1, 3), replace=False)].tolist())
+
+        if rng.random() < 0.3:
+            condition += f' & -{tags[rng.integers(len(tags))]}'
+
+        # rules map to tags of their own, so they never end up in a cycle
+        lines.append(f'{condition}, {tags[rng.integers(len(tags))]} : mapped tag {i}')
+
+    return '\n'.join(lines)
+
+def synthetic_manual_edits(rng: np.random.Generator, vocabulary: TagVocabulary, cases: int) -> List[tuple[str, str, str]]:
+    """(initial tags, edited tags, new tags) of captions that were edited by hand and then tagged again with other settings."""
+    tags = _general_tags(vocabulary)
+    results = []
+
+    for _ in range(cases):
+        initial_tags = tags[rng.choice(len(tags), size=30, replace=False)].tolist()
+
+        edited_tags = [tag for tag in initial_tags if rng.random() > 0.1]
+        for tag in tags[rng.integers(0, len(tags), size=rng.integers(0, 4))].tolist():
+            edited_tags.insert(rng.integers(0, len(edited_tags) + 1), tag)
+
+        new_tags = [tag for tag in initial_tags if rng.random() > 0.2]
+        new_tags.extend(tags[rng.integers(0, len(tags), size=rng.integers(0, 6))].tolist())
+
+        results.append((', '.join(initial_tags), ', '.join(edited_tags), ', '.join(new_tags)))
+
+    return results
+
+def synthetic_dtext(rng: np.random.Generator, pages: int) -> List[str]:
+    """Wiki pages made of the dtext markup danbooru wikis use the most."""
+    words = _synthetic_words(rng, 500)
+
+    def text(count: int):
+        return ' '.join(words[rng.integers(0, len(words), size=count)].tolist())
+
+    def tag():
+        return '_'.join(words[rng.integers(0, len(words), size=2)].tolist())
+
+    blocks = [
+        lambda: f'h4. {text(3)}',
+        lambda: f'{text(12)} [b]{text(2)}[/b] {text(8)} [i]{text(3)}[/i].',
+        lambda: f'See [[{tag()}]] and [[{tag()}|{text(2)}]] for {text(4)}.',
+        lambda: '\n'.join(f'* [[{tag()}]]' for _ in range(rng.integers(3, 10))),
+        lambda: f'"{text(2)}":https://danbooru.donmai.us/posts?tags={tag()} {text(6)}',
+        lambda: f'[quote]\n{text(15)}\n[/quote]',
+        lambda: f'[expand={text(2)}]\n{text(20)}\n[/expand]',
+        lambda: f'[code]{text(5)}[/code]',
+        lambda: f'{text(10)}[br]{text(10)}',
+    ]
+
+    return [
+        '\n\n'.join(blocks[i]() for i in rng.integers(0, len(blocks), size=rng.integers(5, 20)))
+        for _ in range(pages)
+    ]
+
+def _benchmark_post_processing(rng: np.random.Generator, tag_count: int) -> List[Benchmark]:
+    vocabulary = synthetic_vocabulary(rng, tag_count)
+    scores = synthetic_scores(rng, vocabulary, 256)
+    prediction = Prediction(vocabulary, scores[0])
+    map_tags = synthetic_map_tags(rng, vocabulary, 500)
+
+    post_processor = process_prediction.PostProcessor(0.35, False, 0.9, False, True, True, False)
+
+    # the results of thresholding with underscores replaced, which is what dupes get trimmed from
+    general_res = [
+        post_processor._replace_underscore(general_res)
+        for general_res in post_processor._threshold(scores, vocabulary, 'general', 0.35, False)
+    ]
+
+    def trim_general_tag_dupes():
+        for tags in general_res:
+            post_processor._trim_general_tag_dupes(tags)
+
+    return [
+        Benchmark(f'post_process_prediction[tags={tag_count}]', lambda: process_prediction.post_process_prediction(prediction, 0.35, False, 0.9, False, True, True, False)),
+        Benchmark(f'post_process_prediction[tags={tag_count},mcut]', lambda: process_prediction.post_process_prediction(prediction, 0.35, True, 0.9, True, True, True, False)),
+        Benchmark(f'post_process_prediction[tags={tag_count},map_tags]', lambda: process_prediction.post_process_prediction(prediction, 0.35, False, 0.9, False, True, True, False, map_tags=map_tags)),
+        Benchmark(f'post_process_batch[tags={tag_count},images={len(scores)}]', lambda: process_prediction.post_process_batch(scores, vocabulary, 0.35, False, 0.9, False, True, True, False)),
+        Benchmark(f'trim_general_tag_dupes[tags={tag_count},images={len(scores)}]', trim_general_tag_dupes),
+    ]
+
+def _benchmark_manual_edits(rng: np.random.Generator) -> List[Benchmark]:
+    cases = synthetic_manual_edits(rng, synthetic_vocabulary(rng, 2000), 100)
+
+    def manual_edits():
+        for initial_tags, edited_tags, new_tags in cases:
+            process_prediction.post_process_manual_edits(initial_tags, edited_tags, new_tags)
+
+    return [
+        Benchmark(f'post_process_manual_edits[cases={len(cases)}]', manual_edits),
+    ]
+
+def _benchmark_dataset_db(rng: np.random.Generator, tag_count: int, folder: pathlib.Path, stack: ExitStack) -> List[Benchmark]:
+    from yadt.configuration import Configuration
+    from yadt.db_dataset import AsyncDatasetDB, DatasetDB
+    from yadt.tagger_shared import Predictor
+    from yadt.ui_dataset import DatasetPage
+
+    vocabulary = synthetic_vocabulary(rng, tag_count)
+    predictions = [Prediction(vocabulary, row) for row in synthetic_scores(rng, vocabulary, 500)]
+    hashes = [rng.bytes(32) for _ in range(len(predictions))]
+
+    # the database would move a dataset.db of older versions into the temporary folder, where it'd be deleted
+    assert not (pathlib.Path(__file__).parent.parent / 'dataset.db').exists(), "Start the app once to migrate dataset.db before running the benchmarks"
+
+    db_folder = folder / f'dataset_db_{tag_count}'
+    db_folder.mkdir()
+
+    configuration = Configuration(
+        device='cpu',
+        cache_folder=db_folder,
+        score_slider_step=0.05,
+        score_general_threshold=0.35,
+        score_character_threshold=0.9,
+        batch_size=1,
+    )
+
+    db = DatasetDB(configuration)
+    stack.callback(db.close)
+
+    # predictions are stored and read back the way the dataset page does it
+    page = DatasetPage(configuration, db, AsyncDatasetDB(db), Predictor(configuration))
+
+    def round_trip():
+        db.set_dataset_cache_many([
+            (file_hash, 'benchmark', 'benchmark', page._encode_results(prediction))
+            for file_hash, prediction in zip(hashes, predictions)
+        ])
+
+        results = db.get_dataset_cache_many(hashes, 'benchmark')
+        assert len(results) == len(hashes), f"Expected {len(hashes)} cached predictions, got {len(results)}"
+
+        for data in results.values():
+            assert page._decode_results(data) is not None, "Failed to decode a cached prediction"
+
+    return [
+        Benchmark(f'dataset_cache_round_trip[tags={tag_count},images={len(predictions)}]', round_trip),
+    ]
+
+def _benchmark_dtext(rng: np.random.Generator) -> List[Benchmark]:
+    from yadt.process_wiki import _wiki_processors
+
+    dtext_to_markdown, _ = _wiki_processors()
+    pages = synthetic_dtext(rng, 100)
+
+    def parse():
+        for page in pages:
+            dtext_to_markdown(page)
+
+    return [
+        Benchmark(f'dtext_to_markdown[pages={len(pages)}]', parse),
+    ]
+
+@contextmanager
+def benchmarks(folder: pathlib.Path, tag_counts: List[int] = BENCHMARK_TAG_COUNTS):
+    """Yields the benchmarks, with whatever they need (e.g. databases) kept open until the end of the block."""
+    rng = np.random.default_rng(BENCHMARK_SEED)
+    results: List[Benchmark] = []
+
+    with ExitStack() as stack:
+        for tag_count in tag_counts:
+            results.extend(_benchmark_post_processing(rng, tag_count))
+
+        results.extend(_benchmark_manual_edits(rng))
+
+        for tag_count in tag_counts:
+            results.extend(_benchmark_dataset_db(rng, tag_count, folder, stack))
+
+        results.extend(_benchmark_dtext(rng))
+
+        yield results
+
+def measure(benchmark: Benchmark, repeat: int, min_seconds: float = BENCHMARK_MIN_SECONDS) -> BenchmarkResult:
+    # the first call warms up caches (e.g. parsed rules or word runs), the way they'd be warm while tagging a dataset
+    start = time.perf_counter()
+    benchmark.run()
+    elapsed = time.perf_counter() - start
+
+    number = max(1, int(min_seconds / elapsed)) if elapsed > 0 else 1
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            benchmark.run()
+        timings.append((time.perf_counter() - start) / number)
+
+    return BenchmarkResult(
+        name=benchmark.name,
+        seconds=statistics.median(timings),
+        min_seconds=min(timings),
+        number=number,
+        repeat=repeat,
+    )
+
+def to_json(results: List[BenchmarkResult]) -> Dict:
+    return {
+        'version': BENCHMARK_FORMAT_VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'benchmarks': {
+            result.name: {
+                'seconds': result.seconds,
+                'min_seconds': result.min_seconds,
+                'number': result.number,
+                'repeat': result.repeat,
+            }
+            for result in results
+        },
+    }
+
+def compare(results: Dict, baseline: Dict, max_regression: float = BENCHMARK_MAX_REGRESSION) -> List[tuple[str, float, float, bool]]:
+    """Returns (name, seconds, baseline seconds, regressed) for the benchmarks found in both results."""
+    assert baseline.get('version') == BENCHMARK_FORMAT_VERSION, f"Unsupported baseline version: {baseline.get('version')}"
+
+    comparison = []
+
+    for name, result in results['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            continue
+
+        seconds, baseline_seconds = result['seconds'], baseline_result['seconds']
+        comparison.append((name, seconds, baseline_seconds, seconds > baseline_seconds * max_regression))
+
+    return comparison
+
+def _format_seconds(seconds: float):
+    if seconds >= 1.0:
+        return f'{seconds:.3f} s'
+    if seconds >= 1e-3:
+        return f'{seconds * 1e3:.3f} ms'
+
+    return f'{seconds * 1e6:.1f} µs'
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks the tagging and post processing hot paths on synthetic data")
+    parser.add_argument("--output", type=pathlib.Path, default=None, help="json file to write the results to, e.g. to use as a baseline later on")
+    parser.add_argument("--baseline", type=pathlib.Path, default=None, help="json file of earlier results to compare against")
+    parser.add_argument("--max-regression", type=float, default=BENCHMARK_MAX_REGRESSION, help="ratio to the baseline above which a benchmark counts as a regression")
+    parser.add_argument("--tags", type=int, nargs='+', default=list(BENCHMARK_TAG_COUNTS), help="vocabulary sizes to benchmark with")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", type=str, default=None, help="only run benchmarks whose name contains this")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    assert args.repeat > 0, "--repeat must be at least 1"
+    assert all(tags >= 100 for tags in args.tags), "--tags must be at least 100"
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as folder, benchmarks(pathlib.Path(folder), args.tags) as all_benchmarks:
+        results = []
+
+        for benchmark in all_benchmarks:
+            if args.filter is not None and args.filter not in benchmark.name:
+                continue
+
+            result = measure(benchmark, args.repeat)
+            results.append(result)
+
+            print(f'{result.name:<70} {_format_seconds(result.seconds):>12}')
+
+    results = to_json(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is None:
+        return 0
+
+    print('')
+
+    regressions = 0
+    for name, seconds, baseline_seconds, regressed in compare(results, baseline, args.max_regression):
+        regressions += regressed
+        print(f'{name:<70} {_format_seconds(baseline_seconds):>12} -> {_format_seconds(seconds):>12} ({seconds / baseline_seconds:.2f}x){" REGRESSION" if regressed else ""}')
+
+    return 1 if regressions > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
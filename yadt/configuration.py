@@ -9,3 +9,20 @@ class Configuration:
     score_slider_step: float
     score_general_threshold: float
     score_character_threshold: float
+    batch_size: int
+    score_threshold_table: pathlib.Path = None
+    score_general_top_k: int = 0
+    score_character_top_k: int = 0
+    model_cache_max_bytes: int = 8 * 1024**3
+    model_idle_timeout: float = 0
+    dataset_workers: int = 4
+    post_process_cache_size: int = 20000
+    dataset_cache_max_bytes: int = 0
+    verify_file_hashes: bool = False
+    sqlite_profile: str = 'wal'
+    onnx_graph_optimization_level: str = 'all'
+    onnx_intra_op_threads: int = 0
+    onnx_inter_op_threads: int = 0
+    onnx_execution_mode: str = 'sequential'
+    onnx_enable_mem_arena: bool = True
+    onnx_enable_mem_pattern: bool = True
@@ -11,7 +11,24 @@ class InjectorConfiguration(Module, Configuration):
             cache_folder=self.cache_folder,
             score_character_threshold=self.score_character_threshold,
             score_general_threshold=self.score_general_threshold,
-            score_slider_step=self.score_slider_step
+            score_slider_step=self.score_slider_step,
+            batch_size=self.batch_size,
+            score_threshold_table=self.score_threshold_table,
+            score_general_top_k=self.score_general_top_k,
+            score_character_top_k=self.score_character_top_k,
+            model_cache_max_bytes=self.model_cache_max_bytes,
+            model_idle_timeout=self.model_idle_timeout,
+            dataset_workers=self.dataset_workers,
+            post_process_cache_size=self.post_process_cache_size,
+            dataset_cache_max_bytes=self.dataset_cache_max_bytes,
+            verify_file_hashes=self.verify_file_hashes,
+            sqlite_profile=self.sqlite_profile,
+            onnx_graph_optimization_level=self.onnx_graph_optimization_level,
+            onnx_intra_op_threads=self.onnx_intra_op_threads,
+            onnx_inter_op_threads=self.onnx_inter_op_threads,
+            onnx_execution_mode=self.onnx_execution_mode,
+            onnx_enable_mem_arena=self.onnx_enable_mem_arena,
+            onnx_enable_mem_pattern=self.onnx_enable_mem_pattern,
         ))
 
     @singleton
@@ -21,5 +38,5 @@ class InjectorConfiguration(Module, Configuration):
 
     @singleton
     @provider
-    def provide_preditor(self) -> Predictor:
-        return Predictor()
+    def provide_preditor(self, configuration: Configuration) -> Predictor:
+        return Predictor(configuration)
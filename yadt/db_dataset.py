@@ -1,68 +1,109 @@
 import os
+import asyncio
 import sqlite3
-import contextlib
+import functools
 import threading
 import pathlib
+import time
 
-from injector import inject
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from injector import inject, singleton
 
 from yadt.configuration import Configuration
-from yadt.db_pool import Sqlite3DBPool
+from yadt.db_pool import PoolMetrics, Sqlite3DBPool, Sqlite3DBWriter
+
+# sqlite limits the amount of parameters in a single query
+QUERY_CHUNK_SIZE = 500
+
+# threads the database calls of async handlers are run on, any further calls wait for one without taking up a thread
+ASYNC_DB_WORKERS = 4
+
+# cache hits are written down this many at a time, rather than with a write per hit
+DATASET_CACHE_ACCESS_BATCH_SIZE = 1000
+
+# seconds between checks of the dataset cache against its budget
+DATASET_CACHE_EVICTION_INTERVAL = 60
+
+# once over budget, the dataset cache is evicted down to this part of it, so it isn't evicted again right away
+DATASET_CACHE_EVICTION_TARGET = 0.9
+
+# cached predictions which don't carry their vocabulary with them start with a header followed by the digest of
+# one in dataset_vocabulary, which is how the vocabularies still in use are told apart
+DATASET_CACHE_MAGIC = b'YDTC'
+DATASET_CACHE_HEADER_SIZE = 12
+DATASET_CACHE_VOCABULARY_DIGEST_SIZE = 32
 
 class DatasetDB:
     @inject
     def __init__(self, configuration: Configuration):
         self.path = configuration.cache_folder / 'dataset.db'
         self._db_lock = threading.Lock()
-
-        self._pool = Sqlite3DBPool(self.path, busy_timeout='10000', journal_model='wal', foreign_keys='on')
-        self._pool.open()
+        self._dataset_vocabularies: set[bytes] = set()
+        self._dataset_cache_max_bytes = configuration.dataset_cache_max_bytes
+        self._dataset_cache_access: set[int] = set()
+        self._dataset_cache_access_lock = threading.Lock()
+        # cache hits aren't written down while the writer is closed (e.g. during a reset)
+        self._dataset_cache_access_enabled = False
+        self._evictor_stop = threading.Event()
+        self._evictor_thread: threading.Thread = None
 
         # migrate old path
         old_path = pathlib.Path(__file__).parent.parent / 'dataset.db'
         if old_path.exists():
             old_path.rename(self.path)
 
+        # all writes go through a single connection, while reads are spread over read only connections, which
+        # don't need to wait for the writes with the database in wal mode
+        self._writer = Sqlite3DBWriter(self.path, profile=configuration.sqlite_profile, busy_timeout='10000', foreign_keys='on')
+        self._pool = Sqlite3DBPool(self.path, profile=configuration.sqlite_profile, busy_timeout='10000', query_only='on')
+
         with self._db_lock:
+            self._writer.open()
+            self._pool.open()
+
             self._setup_migrations()
             self._do_migrations()
 
-    def _conn(self, locked: bool = True):
-        lock = self._db_lock
-        if not locked:
-            lock = contextlib.nullcontext()
+            with self._dataset_cache_access_lock:
+                self._dataset_cache_access_enabled = True
+
+        if self._dataset_cache_max_bytes > 0:
+            self._evictor_thread = threading.Thread(name='DatasetDB._evictor', target=self._evictor, daemon=True)
+            self._evictor_thread.start()
+
+    def _conn(self):
+        return self._pool.connection()
+
+    def pool_metrics(self) -> PoolMetrics:
+        return self._pool.metrics()
 
-        with lock:
-            return self._pool.connection()
+    def _write(self, fn: Callable[[sqlite3.Cursor], object], error: str, transaction: bool = True):
+        try:
+            return self._writer.write(fn, transaction=transaction)
+        except sqlite3.Error as e:
+            raise Exception(error) from e
 
     def _setup_migrations(self):
-        with self._conn(locked=False) as conn:
-            cursor = conn.cursor()
+        def setup(cursor: sqlite3.Cursor):
+            cursor.executescript("""
+                create table if not exists migrations (name text, timestamp integer default current_timestamp);
+            """)
+
+        self._write(setup, "could not create migrations table", transaction=False)
 
-            try:
-                cursor.executescript("""
-                    create table if not exists migrations (name text, timestamp integer default current_timestamp);
-                """)
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception("could not create migrations table") from e
-        
     def _do_migration(self, name: str, script: str):
-        with self._conn(locked=False) as conn:
-            cursor = conn.cursor()
+        def migrate(cursor: sqlite3.Cursor):
+            rows = cursor.execute('select * from migrations where name = ?', (name,)).fetchall()
+            if len(rows) > 0:
+                return
 
-            try:
-                rows = cursor.execute('select * from migrations where name = ?', (name,)).fetchall()
-                if len(rows) > 0:
-                    return
-                
-                cursor.executescript(script)
-                cursor.execute("insert into migrations (name) values (?)", (name,))
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception(f"could not perform migration: {name}") from e
+            cursor.executescript(script)
+            cursor.execute("insert into migrations (name) values (?)", (name,))
+
+        # scripts commit on their own, so migrations can't be part of a larger transaction
+        self._write(migrate, f"could not perform migration: {name}", transaction=False)
 
     def _do_migrations(self):
         self._do_migration("dataset_cache", """
@@ -142,6 +183,122 @@ class DatasetDB:
             create unique index idx_dataset_manual_edit_id on dataset_manual_edit (dataset_id, hash_id);
         """)
 
+        self._do_migration("dataset_file_stat", """
+            create table if not exists dataset_file_stat (
+                id integer primary key,
+                path text not null,
+                size integer not null,
+                mtime_ns integer not null,
+                inode integer not null,
+                hash blob not null
+            );
+
+            create unique index idx_dataset_file_stat_path on dataset_file_stat (path);
+        """)
+
+        self._do_migration("dataset_vocabulary", """
+            create table if not exists dataset_vocabulary (
+                id integer primary key,
+                digest blob not null,
+                data blob not null
+            );
+
+            create unique index idx_dataset_vocabulary_digest on dataset_vocabulary (digest);
+        """)
+
+        # cache usage is kept up to date by triggers, rather than summing up every cached prediction when it's needed;
+        # cached predictions that don't belong to any dataset are counted under dataset_id 0
+        self._do_migration("dataset_cache_usage", """
+            create table if not exists dataset_cache_repo_usage (
+                repo_name text primary key,
+                rows integer not null,
+                bytes integer not null
+            );
+
+            create table if not exists dataset_cache_dataset_usage (
+                dataset_id integer primary key,
+                rows integer not null,
+                bytes integer not null
+            );
+
+            -- the triggers look up the datasets of cached predictions
+            create index if not exists idx_dataset_cache_stats_hash_id on dataset_cache_stats (hash_id);
+
+            insert into dataset_cache_repo_usage (repo_name, rows, bytes)
+                select repo_name, count(*), sum(length(data)) from dataset_cache group by repo_name;
+
+            insert into dataset_cache_dataset_usage (dataset_id, rows, bytes)
+                select coalesce(s.dataset_id, 0), count(*), sum(length(c.data)) from dataset_cache c left join dataset_cache_stats s on c.id = s.hash_id group by coalesce(s.dataset_id, 0);
+
+            create trigger if not exists trg_dataset_cache_usage_insert after insert on dataset_cache begin
+                insert into dataset_cache_repo_usage (repo_name, rows, bytes) values (new.repo_name, 1, length(new.data))
+                    on conflict (repo_name) do update set rows = rows + 1, bytes = bytes + excluded.bytes;
+
+                insert into dataset_cache_dataset_usage (dataset_id, rows, bytes) values (0, 1, length(new.data))
+                    on conflict (dataset_id) do update set rows = rows + 1, bytes = bytes + excluded.bytes;
+            end;
+
+            create trigger if not exists trg_dataset_cache_usage_update after update of repo_name, data on dataset_cache begin
+                update dataset_cache_repo_usage set rows = rows - 1, bytes = bytes - length(old.data) where repo_name = old.repo_name;
+
+                insert into dataset_cache_repo_usage (repo_name, rows, bytes) values (new.repo_name, 1, length(new.data))
+                    on conflict (repo_name) do update set rows = rows + 1, bytes = bytes + excluded.bytes;
+
+                update dataset_cache_dataset_usage set bytes = bytes - length(old.data) + length(new.data)
+                    where dataset_id in (select dataset_id from dataset_cache_stats where hash_id = new.id)
+                    or (dataset_id = 0 and not exists (select 1 from dataset_cache_stats where hash_id = new.id));
+
+                delete from dataset_cache_repo_usage where repo_name = old.repo_name and rows <= 0;
+            end;
+
+            -- deleting a cached prediction also deletes its rows in dataset_cache_stats, which happens after it's gone,
+            -- so it's taken out of the dataset usage before
+            create trigger if not exists trg_dataset_cache_usage_delete before delete on dataset_cache begin
+                update dataset_cache_repo_usage set rows = rows - 1, bytes = bytes - length(old.data) where repo_name = old.repo_name;
+
+                update dataset_cache_dataset_usage set rows = rows - 1, bytes = bytes - length(old.data)
+                    where dataset_id in (select dataset_id from dataset_cache_stats where hash_id = old.id)
+                    or (dataset_id = 0 and not exists (select 1 from dataset_cache_stats where hash_id = old.id));
+
+                delete from dataset_cache_repo_usage where repo_name = old.repo_name and rows <= 0;
+                delete from dataset_cache_dataset_usage where rows <= 0;
+            end;
+
+            create trigger if not exists trg_dataset_cache_stats_usage_insert after insert on dataset_cache_stats begin
+                insert into dataset_cache_dataset_usage (dataset_id, rows, bytes)
+                    select new.dataset_id, 1, length(data) from dataset_cache where id = new.hash_id
+                    on conflict (dataset_id) do update set rows = rows + 1, bytes = bytes + excluded.bytes;
+
+                update dataset_cache_dataset_usage set rows = rows - 1, bytes = bytes - (select length(data) from dataset_cache where id = new.hash_id)
+                    where dataset_id = 0 and (select count(*) from dataset_cache_stats where hash_id = new.hash_id) = 1;
+
+                delete from dataset_cache_dataset_usage where dataset_id = 0 and rows <= 0;
+            end;
+
+            create trigger if not exists trg_dataset_cache_stats_usage_delete after delete on dataset_cache_stats
+            when exists (select 1 from dataset_cache where id = old.hash_id) begin
+                update dataset_cache_dataset_usage set rows = rows - 1, bytes = bytes - (select length(data) from dataset_cache where id = old.hash_id)
+                    where dataset_id = old.dataset_id;
+
+                insert into dataset_cache_dataset_usage (dataset_id, rows, bytes)
+                    select 0, 1, length(data) from dataset_cache where id = old.hash_id and not exists (select 1 from dataset_cache_stats where hash_id = old.hash_id)
+                    on conflict (dataset_id) do update set rows = rows + 1, bytes = bytes + excluded.bytes;
+
+                delete from dataset_cache_dataset_usage where rows <= 0;
+            end;
+        """)
+
+        # cached predictions from before are all equally old, and are evicted in the order they were added
+        self._do_migration("dataset_cache_last_access", """
+            alter table dataset_cache add column last_access integer not null default 0;
+
+            create index if not exists idx_dataset_cache_last_access on dataset_cache (last_access);
+
+            -- deleting file hashes looks up whatever refers to them
+            create index if not exists idx_dataset_cache_hash_id on dataset_cache (hash_id);
+            create index if not exists idx_dataset_manual_edit_hash_id on dataset_manual_edit (hash_id);
+        """)
+
     def get_recent_datasets(self) -> list[str]:
         with self._conn() as conn:
             cursor = conn.cursor()
@@ -150,25 +307,14 @@ class DatasetDB:
             return [row[0] for row in rows]
 
     def update_recent_datasets(self, last_dataset: str):
-        with self._conn() as conn:
-            cursor = conn.cursor()
+        def update(cursor: sqlite3.Cursor):
+            cursor.execute('insert or ignore into dataset_stats (dataset) values (?)', (last_dataset,))
+            dataset_id = int(cursor.execute('select id from dataset_stats where dataset = ?', (last_dataset,)).fetchone()[0])
 
-            try:
-                try:
-                    rows = cursor.execute('insert or abort into dataset_stats (dataset) values (?) returning id', (last_dataset,)).fetchall()
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    rows = cursor.execute('select id from dataset_stats where dataset = ?', (last_dataset,)).fetchall()
+            cursor.execute('insert into dataset_history (dataset_id) values (?)', (dataset_id,))
+            cursor.execute('delete from dataset_history where id not in (select id from dataset_history order by id desc limit 10)')
 
-                dataset_id = int(rows[0][0])
-
-                cursor.execute('insert into dataset_history (dataset_id) values (?)', (dataset_id,))
-                cursor.execute('delete from dataset_history where id not in (select id from dataset_history order by id desc limit 10)')
-
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception("failed to update dataset cache") from e
+        self._write(update, "failed to update dataset cache")
 
     def get_dataset_setting(self, dataset: str, key: str, default=None):
         with self._conn() as conn:
@@ -181,25 +327,172 @@ class DatasetDB:
             return str(rows[0][0])
         
     def set_dataset_setting(self, dataset: str, key: str, value: str):
+        def update(cursor: sqlite3.Cursor):
+            cursor.execute('insert or replace into dataset_settings (dataset, key, value) values (?, ?, ?)', (dataset, key, value))
+
+        self._write(update, f"failed to update dataset setting: {key}")
+
+    def get_dataset_settings(self, dataset: str) -> dict[str, str]:
         with self._conn() as conn:
             cursor = conn.cursor()
-            cursor.execute('insert or replace into dataset_settings (dataset, key, value) values (?, ?, ?)', (dataset, key, value))
 
+            rows = cursor.execute('select key, value from dataset_settings where dataset = ?', (dataset,)).fetchall()
+            return { str(key): str(value) for key, value in rows }
+
+    def set_dataset_settings(self, dataset: str, settings: dict[str, str]):
+        def update(cursor: sqlite3.Cursor):
+            cursor.executemany('insert or replace into dataset_settings (dataset, key, value) values (?, ?, ?)', [(dataset, key, value) for key, value in settings.items()])
+
+        self._write(update, f"failed to update dataset settings: {dataset}")
 
     def get_dataset_cache(self, hash: bytes, repo_name: str):
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            rows = cursor.execute('select c.data from dataset_cache c inner join dataset_file_hash h on h.id = c.hash_id where h.hash = ? and c.repo_name = ? limit 1', (hash, repo_name)).fetchall()
+            rows = cursor.execute('select c.id, c.data from dataset_cache c inner join dataset_file_hash h on h.id = c.hash_id where h.hash = ? and c.repo_name = ? limit 1', (hash, repo_name)).fetchall()
             if len(rows) == 0:
                 return None
-            
-            return bytes(rows[0][0])
+
+        self._touch_dataset_cache([rows[0][0]])
+
+        return bytes(rows[0][1])
+
+    def _touch_dataset_cache(self, ids: list[int]):
+        with self._dataset_cache_access_lock:
+            if not self._dataset_cache_access_enabled:
+                return
+
+            self._dataset_cache_access.update(ids)
+
+            if len(self._dataset_cache_access) < DATASET_CACHE_ACCESS_BATCH_SIZE:
+                return
+
+            ids, self._dataset_cache_access = self._dataset_cache_access, set()
+
+            # reads don't wait for it to be written down
+            self._writer.submit(self._update_dataset_cache_access(ids))
+
+    def _update_dataset_cache_access(self, ids: set[int]):
+        ids = list(ids)
+        last_access = int(time.time())
+
+        def update(cursor: sqlite3.Cursor):
+            for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[i:i+QUERY_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+
+                cursor.execute(f'update dataset_cache set last_access = ? where id in ({placeholders})', (last_access, *chunk))
+
+        return update
+
+    def flush_dataset_cache_access(self):
+        with self._dataset_cache_access_lock:
+            ids, self._dataset_cache_access = self._dataset_cache_access, set()
+
+        if len(ids) > 0:
+            self._write(self._update_dataset_cache_access(ids), "failed to update dataset cache access")
+
+    def evict_dataset_cache(self, max_bytes: int = None):
+        """Evicts the least recently used cached predictions while over max_bytes, along with any file hashes, file stats and vocabularies left unused. Returns the rows and bytes evicted."""
+        max_bytes = self._dataset_cache_max_bytes if max_bytes is None else max_bytes
+
+        self.flush_dataset_cache_access()
+
+        def usage(cursor: sqlite3.Cursor):
+            return cursor.execute('select coalesce(sum(bytes), 0) from dataset_cache_repo_usage').fetchone()[0]
+
+        total = self._write(usage, "failed to get dataset cache usage")
+        if total <= max_bytes:
+            return 0, 0
+
+        remaining = total - int(max_bytes * DATASET_CACHE_EVICTION_TARGET)
+
+        # evicted a chunk at a time, so other writes don't wait for all of it
+        def evict(cursor: sqlite3.Cursor):
+            ids, evicted = [], 0
+
+            for id, size, hash in cursor.execute('select c.id, length(c.data), h.hash from dataset_cache c inner join dataset_file_hash h on h.id = c.hash_id order by c.last_access, c.id limit ?', (QUERY_CHUNK_SIZE,)).fetchall():
+                if evicted >= remaining:
+                    break
+
+                ids.append(id)
+                evicted += size
+                evicted_hashes.add(bytes(hash))
+
+            placeholders = ', '.join('?' * len(ids))
+            cursor.execute(f'delete from dataset_cache where id in ({placeholders})', ids)
+
+            return len(ids), evicted
+
+        rows, evicted = 0, 0
+        evicted_hashes: set[bytes] = set()
+
+        while remaining > 0:
+            chunk_rows, chunk_evicted = self._write(evict, "failed to evict dataset cache")
+            if chunk_rows == 0:
+                break
+
+            rows += chunk_rows
+            evicted += chunk_evicted
+            remaining -= chunk_evicted
+
+        # file stats are kept for files which were hashed but never cached (e.g. they failed to open, or their cached
+        # prediction is yet to be written), only the ones of evicted hashes and of files which are gone are dropped
+        evicted_hashes = list(evicted_hashes)
+        missing_paths = self._get_missing_file_stat_paths()
+
+        # vocabularies written by this process might be waiting for their cached predictions to be written
+        written_vocabularies = list(self._dataset_vocabularies)
+
+        def delete_orphans(cursor: sqlite3.Cursor):
+            cursor.execute('delete from dataset_file_hash where id not in (select hash_id from dataset_cache) and id not in (select hash_id from dataset_manual_edit)')
+
+            for i in range(0, len(evicted_hashes), QUERY_CHUNK_SIZE):
+                chunk = evicted_hashes[i:i+QUERY_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+
+                cursor.execute(f'delete from dataset_file_stat where hash in ({placeholders}) and hash not in (select hash from dataset_file_hash)', chunk)
+
+            for i in range(0, len(missing_paths), QUERY_CHUNK_SIZE):
+                chunk = missing_paths[i:i+QUERY_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+
+                cursor.execute(f'delete from dataset_file_stat where path in ({placeholders})', chunk)
+
+            placeholders = ', '.join('?' * len(written_vocabularies))
+            cursor.execute(
+                f'delete from dataset_vocabulary where digest not in ({placeholders}) and digest not in (select substr(data, ?, ?) from dataset_cache where substr(data, 1, ?) = ?)',
+                (*written_vocabularies, DATASET_CACHE_HEADER_SIZE + 1, DATASET_CACHE_VOCABULARY_DIGEST_SIZE, len(DATASET_CACHE_MAGIC), DATASET_CACHE_MAGIC),
+            )
+
+        self._write(delete_orphans, "failed to delete unused file hashes and vocabularies")
+
+        return rows, evicted
+
+    def _get_missing_file_stat_paths(self):
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            rows = cursor.execute('select path from dataset_file_stat').fetchall()
+
+        return [
+            row[0] for row in rows if not os.path.exists(row[0])
+        ]
+
+    def _evictor(self):
+        while not self._evictor_stop.wait(timeout=DATASET_CACHE_EVICTION_INTERVAL):
+            try:
+                with self._db_lock:
+                    rows, evicted = self.evict_dataset_cache()
+
+                if rows > 0:
+                    print(f'* Evicted {rows} cached predictions ({evicted} bytes) from the dataset cache')
+            except Exception as e:
+                print(f'* Warning: dataset cache eviction failed: {e}')
 
     def get_dataset_cache_for_repo_name(self):
         with self._conn() as conn:
             cursor = conn.cursor()
-            rows = cursor.execute('select repo_name from dataset_cache group by repo_name').fetchall()
+            rows = cursor.execute('select repo_name from dataset_cache_repo_usage').fetchall()
 
             return [
                 row[0] for row in rows
@@ -208,28 +501,23 @@ class DatasetDB:
     def get_dataset_cache_usage_for_repo_name(self):
         with self._conn() as conn:
             cursor = conn.cursor()
-            rows = cursor.execute('select sum(length(data)), repo_name from dataset_cache group by repo_name').fetchall()
+            rows = cursor.execute('select bytes, rows, repo_name from dataset_cache_repo_usage').fetchall()
 
             return [
-                { 'repo_name': row[1], 'bytes': row[0] } for row in rows
+                { 'repo_name': row[2], 'bytes': row[0], 'rows': row[1] } for row in rows
             ]
     
     def delete_dataset_cache_by_repo_name(self, repo_name: str):
-        with self._conn() as conn:
-            cursor = conn.cursor()
+        def delete(cursor: sqlite3.Cursor):
+            cursor.execute('delete from dataset_cache where repo_name = ?', (repo_name,))
 
-            try:
-                cursor.execute('delete from dataset_cache where repo_name = ?', (repo_name,))
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception(f"failed to deleted cache for repo_name: {repo_name}") from e
+        self._write(delete, f"failed to deleted cache for repo_name: {repo_name}")
 
     def get_dataset_cache_for_dataset(self):
         with self._conn() as conn:
             cursor = conn.cursor()
             
-            rows = cursor.execute('select d.dataset from dataset_cache c left join dataset_cache_stats s on c.id = s.hash_id left join dataset_stats d on d.id = s.dataset_id group by d.dataset').fetchall()
+            rows = cursor.execute('select d.dataset from dataset_cache_dataset_usage u left join dataset_stats d on d.id = u.dataset_id').fetchall()
 
             return [
                 row[0] for row in rows
@@ -239,120 +527,258 @@ class DatasetDB:
         with self._conn() as conn:
             cursor = conn.cursor()
             
-            rows = cursor.execute('select sum(length(c.data)), d.dataset from dataset_cache c left join dataset_cache_stats s on c.id = s.hash_id left join dataset_stats d on d.id = s.dataset_id group by d.dataset').fetchall()
+            rows = cursor.execute('select u.bytes, u.rows, d.dataset from dataset_cache_dataset_usage u left join dataset_stats d on d.id = u.dataset_id').fetchall()
 
             return [
-                { 'dataset': row[1], 'bytes': row[0] } for row in rows
+                { 'dataset': row[2], 'bytes': row[0], 'rows': row[1] } for row in rows
             ]
     
     def delete_dataset_cache_by_dataset(self, dataset: str):
+        def delete(cursor: sqlite3.Cursor):
+            cursor.execute('delete from dataset_cache where id in (select s.hash_id from dataset_cache_stats s left join dataset_stats d on d.id = s.dataset_id group by s.hash_id having s.hash_id in (select s2.hash_id from dataset_cache_stats s2 left join dataset_stats d2 on d2.id = s2.dataset_id where d2.dataset = ?) and count(distinct s.dataset_id) = 1)', (dataset,))
+            cursor.execute('delete from dataset_stats where dataset = ?', (dataset,))
+
+        self._write(delete, f"failed to deleted cache for dataset: {dataset}")
+
+    def set_dataset_cache(self, hash: bytes, repo_name: str, dataset: str, data: bytes):
+        self.set_dataset_cache_many([(hash, repo_name, dataset, data)])
+
+    def get_dataset_cache_many(self, hashes: list[bytes], repo_name: str):
+        results = {}
+        ids = []
+
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            try:
-                cursor.execute('delete from dataset_cache where id in (select s.hash_id from dataset_cache_stats s left join dataset_stats d on d.id = s.dataset_id group by s.hash_id having s.hash_id in (select s2.hash_id from dataset_cache_stats s2 left join dataset_stats d2 on d2.id = s2.dataset_id where d2.dataset = ?) and count(distinct s.dataset_id) = 1)', (dataset,))
-                cursor.execute('delete from dataset_stats where dataset = ?', (dataset,))
+            for i in range(0, len(hashes), QUERY_CHUNK_SIZE):
+                chunk = hashes[i:i+QUERY_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
 
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception(f"failed to deleted cache for dataset: {dataset}") from e
+                rows = cursor.execute(f'select c.id, h.hash, c.data from dataset_cache c inner join dataset_file_hash h on h.id = c.hash_id where c.repo_name = ? and h.hash in ({placeholders})', (repo_name, *chunk)).fetchall()
 
-    def set_dataset_cache(self, hash: bytes, repo_name: str, dataset: str, data: bytes):
+                for id, hash, data in rows:
+                    ids.append(id)
+                    results[bytes(hash)] = bytes(data)
+
+        self._touch_dataset_cache(ids)
+
+        return results
+
+    def set_dataset_cache_many(self, rows: list[tuple[bytes, str, str, bytes]]):
+        """Stores (hash, repo_name, dataset, data) rows in a single transaction."""
+        if len(rows) == 0:
+            return
+
+        last_access = int(time.time())
+
+        def update(cursor: sqlite3.Cursor):
+            cursor.executemany('insert or ignore into dataset_stats (dataset) values (?)', {(dataset,) for _, _, dataset, _ in rows})
+            cursor.executemany('insert or ignore into dataset_file_hash (hash) values (?)', [(hash,) for hash, _, _, _ in rows])
+            cursor.executemany('insert into dataset_cache (hash_id, repo_name, data, last_access) select h.id, ?, ?, ? from dataset_file_hash h where h.hash = ? on conflict (repo_name, hash_id) do update set data = excluded.data, last_access = excluded.last_access', [(repo_name, data, last_access, hash) for hash, repo_name, _, data in rows])
+            cursor.executemany('insert or ignore into dataset_cache_stats (dataset_id, hash_id) select d.id, c.id from dataset_stats d, dataset_cache c inner join dataset_file_hash h on h.id = c.hash_id where d.dataset = ? and h.hash = ? and c.repo_name = ?', [(dataset, hash, repo_name) for hash, repo_name, dataset, _ in rows])
+
+        self._write(update, "failed to update dataset cache")
+
+    def get_dataset_vocabulary(self, digest: bytes):
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            try:
-                try:
-                    rows = cursor.execute('insert or abort into dataset_stats (dataset) values (?) returning id', (dataset,)).fetchall()
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    rows = cursor.execute('select id from dataset_stats where dataset = ?', (dataset,)).fetchall()
+            rows = cursor.execute('select data from dataset_vocabulary where digest = ? limit 1', (digest,)).fetchall()
+            if len(rows) == 0:
+                return None
 
-                dataset_id = int(rows[0][0])
+            return bytes(rows[0][0])
 
-                try:
-                    rows = cursor.execute('insert or abort into dataset_file_hash (hash) values (?) returning id', (hash,)).fetchall()
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    rows = cursor.execute('select id from dataset_file_hash where hash = ?', (hash,)).fetchall()
+    def set_dataset_vocabulary(self, digest: bytes, data: bytes):
+        # vocabularies never change for a given digest, so they only need to be written once
+        if digest in self._dataset_vocabularies:
+            return
 
-                hash_id = int(rows[0][0])
+        def update(cursor: sqlite3.Cursor):
+            cursor.execute('insert or ignore into dataset_vocabulary (digest, data) values (?, ?)', (digest, data))
 
-                try:
-                    cursor.execute('insert or abort into dataset_cache (hash_id, repo_name, data) values (?, ?, ?)', (hash_id, repo_name, data))
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    pass
+        self._write(update, "failed to update dataset vocabulary")
 
-                try:
-                    cursor.execute('insert or abort into dataset_cache_stats (dataset_id, hash_id) values (?, ?)', (dataset_id, hash_id))
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    pass
+        self._dataset_vocabularies.add(digest)
 
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception("failed to update dataset cache") from e
-    
-    def get_dataset_edit(self, dataset: str, hash: bytes):
+    def get_file_hash(self, path: str, size: int, mtime_ns: int, inode: int):
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            rows = cursor.execute('select e.previous_edit, e.new_edit from dataset_manual_edit e left join dataset_stats s on s.id = e.dataset_id left join dataset_file_hash h on h.id = e.hash_id where s.dataset = ? and h.hash = ? limit 1', (dataset, hash)).fetchall()
+            rows = cursor.execute('select hash from dataset_file_stat where path = ? and size = ? and mtime_ns = ? and inode = ? limit 1', (path, size, mtime_ns, inode)).fetchall()
             if len(rows) == 0:
                 return None
 
-            return str(rows[0][0]), str(rows[0][1])
+            return bytes(rows[0][0])
+
+    def set_file_hash(self, path: str, size: int, mtime_ns: int, inode: int, hash: bytes):
+        def update(cursor: sqlite3.Cursor):
+            cursor.execute('insert or replace into dataset_file_stat (path, size, mtime_ns, inode, hash) values (?, ?, ?, ?, ?)', (path, size, mtime_ns, inode, hash))
+
+        self._write(update, f"failed to update file hash for: {path}")
+
+    def get_file_hashes(self, paths: list[str]):
+        results = {}
 
-    def set_dataset_edit(self, dataset: str, hash: bytes, previous_edit: str, new_edit: str):
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            try:
-                try:
-                    rows = cursor.execute('insert or abort into dataset_stats (dataset) values (?) returning id', (dataset,)).fetchall()
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    rows = cursor.execute('select id from dataset_stats where dataset = ?', (dataset,)).fetchall()
+            for i in range(0, len(paths), QUERY_CHUNK_SIZE):
+                chunk = paths[i:i+QUERY_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
 
-                dataset_id = int(rows[0][0])
+                rows = cursor.execute(f'select path, size, mtime_ns, inode, hash from dataset_file_stat where path in ({placeholders})', chunk).fetchall()
 
-                try:
-                    rows = cursor.execute('insert or abort into dataset_file_hash (hash) values (?) returning id', (hash,)).fetchall()
-                    conn.commit()
-                except sqlite3.IntegrityError:
-                    rows = cursor.execute('select id from dataset_file_hash where hash = ?', (hash,)).fetchall()
+                for path, size, mtime_ns, inode, hash in rows:
+                    results[str(path)] = (int(size), int(mtime_ns), int(inode), bytes(hash))
 
-                hash_id = int(rows[0][0])
+        return results
 
-                cursor.execute('insert or replace into dataset_manual_edit (dataset_id, hash_id, previous_edit, new_edit) values (?, ?, ?, ?)', (dataset_id, hash_id, previous_edit, new_edit))
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception("failed to update dataset cache") from e
+    def get_dataset_edits(self, dataset: str):
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-    def vacuum(self):
+            rows = cursor.execute('select h.hash, e.previous_edit, e.new_edit from dataset_manual_edit e inner join dataset_stats s on s.id = e.dataset_id inner join dataset_file_hash h on h.id = e.hash_id where s.dataset = ?', (dataset,)).fetchall()
+
+            return {
+                bytes(row[0]): (str(row[1]), str(row[2])) for row in rows
+            }
+
+    def get_dataset_edit(self, dataset: str, hash: bytes):
         with self._conn() as conn:
             cursor = conn.cursor()
 
-            try:
-                cursor.execute('vacuum')
-                conn.commit()
-            except sqlite3.Error as e:
-                conn.rollback()
-                raise Exception('failed to minimize db size') from e
-            
+            rows = cursor.execute('select e.previous_edit, e.new_edit from dataset_manual_edit e left join dataset_stats s on s.id = e.dataset_id left join dataset_file_hash h on h.id = e.hash_id where s.dataset = ? and h.hash = ? limit 1', (dataset, hash)).fetchall()
+            if len(rows) == 0:
+                return None
+
+            return str(rows[0][0]), str(rows[0][1])
+
+    def set_dataset_edit(self, dataset: str, hash: bytes, previous_edit: str, new_edit: str):
+        def update(cursor: sqlite3.Cursor):
+            cursor.execute('insert or ignore into dataset_stats (dataset) values (?)', (dataset,))
+            dataset_id = int(cursor.execute('select id from dataset_stats where dataset = ?', (dataset,)).fetchone()[0])
+
+            cursor.execute('insert or ignore into dataset_file_hash (hash) values (?)', (hash,))
+            hash_id = int(cursor.execute('select id from dataset_file_hash where hash = ?', (hash,)).fetchone()[0])
+
+            cursor.execute('insert or replace into dataset_manual_edit (dataset_id, hash_id, previous_edit, new_edit) values (?, ?, ?, ?)', (dataset_id, hash_id, previous_edit, new_edit))
+
+        self._write(update, "failed to update dataset cache")
+
+    def vacuum(self):
+        def vacuum(cursor: sqlite3.Cursor):
+            cursor.execute('vacuum')
+
+        self._write(vacuum, 'failed to minimize db size', transaction=False)
+
     def reset(self):
         with self._db_lock:
+            self._dataset_vocabularies.clear()
+            with self._dataset_cache_access_lock:
+                self._dataset_cache_access.clear()
+                self._dataset_cache_access_enabled = False
+            self._writer.close()
             self._pool.close()
-            try:
-                os.unlink(self.path)
-            except FileNotFoundError:
-                pass
+            # the write ahead log belongs to the old database, it'd be applied to the new one otherwise
+            for path in (self.path, self.path.with_name(self.path.name + '-wal'), self.path.with_name(self.path.name + '-shm')):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            self._writer.open()
             self._pool.open()
 
             self._setup_migrations()
             self._do_migrations()
 
+            with self._dataset_cache_access_lock:
+                self._dataset_cache_access_enabled = True
+
+    def close(self):
+        """Stops the evictor, writes down the pending cache hits and closes all connections."""
+        if self._evictor_thread is not None:
+            self._evictor_stop.set()
+            self._evictor_thread.join()
+            self._evictor_thread = None
+
+        with self._db_lock:
+            with self._dataset_cache_access_lock:
+                if not self._dataset_cache_access_enabled:
+                    return
+
+            self.flush_dataset_cache_access()
+
+            with self._dataset_cache_access_lock:
+                self._dataset_cache_access_enabled = False
+
+            self._writer.close()
+            self._pool.close()
+
+
+@singleton
+class AsyncDatasetDB:
+    """DatasetDB for async handlers, with the calls run on threads of its own instead of holding one of gradio's."""
+
+    @inject
+    def __init__(self, db: DatasetDB):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix='AsyncDatasetDB')
+
+    @property
+    def path(self):
+        return self._db.path
+
+    async def _run(self, fn: Callable, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_recent_datasets(self) -> list[str]:
+        return await self._run(self._db.get_recent_datasets)
+
+    async def update_recent_datasets(self, last_dataset: str):
+        return await self._run(self._db.update_recent_datasets, last_dataset)
+
+    async def get_dataset_settings(self, dataset: str) -> dict[str, str]:
+        return await self._run(self._db.get_dataset_settings, dataset)
+
+    async def set_dataset_settings(self, dataset: str, settings: dict[str, str]):
+        return await self._run(self._db.set_dataset_settings, dataset, settings)
+
+    async def get_dataset_cache_many(self, hashes: list[bytes], repo_name: str):
+        return await self._run(self._db.get_dataset_cache_many, hashes, repo_name)
+
+    async def set_dataset_cache_many(self, rows: list[tuple[bytes, str, str, bytes]]):
+        return await self._run(self._db.set_dataset_cache_many, rows)
+
+    async def get_dataset_cache_for_repo_name(self):
+        return await self._run(self._db.get_dataset_cache_for_repo_name)
+
+    async def get_dataset_cache_usage_for_repo_name(self):
+        return await self._run(self._db.get_dataset_cache_usage_for_repo_name)
+
+    async def delete_dataset_cache_by_repo_name(self, repo_name: str):
+        return await self._run(self._db.delete_dataset_cache_by_repo_name, repo_name)
+
+    async def get_dataset_cache_for_dataset(self):
+        return await self._run(self._db.get_dataset_cache_for_dataset)
+
+    async def get_dataset_cache_usage_for_dataset(self):
+        return await self._run(self._db.get_dataset_cache_usage_for_dataset)
+
+    async def delete_dataset_cache_by_dataset(self, dataset: str):
+        return await self._run(self._db.delete_dataset_cache_by_dataset, dataset)
+
+    async def get_dataset_edits(self, dataset: str):
+        return await self._run(self._db.get_dataset_edits, dataset)
+
+    async def set_dataset_edit(self, dataset: str, hash: bytes, previous_edit: str, new_edit: str):
+        return await self._run(self._db.set_dataset_edit, dataset, hash, previous_edit, new_edit)
+
+    async def vacuum(self):
+        return await self._run(self._db.vacuum)
+
+    async def reset(self):
+        return await self._run(self._db.reset)
+
+    def pool_metrics(self) -> PoolMetrics:
+        return self._db.pool_metrics()
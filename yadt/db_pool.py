@@ -1,149 +1,490 @@
 import time
+import queue
+import bisect
 import sqlite3
+import threading
 
 from contextlib import contextmanager
 from dataclasses import dataclass
+from concurrent.futures import Future
+from typing import Callable
 
 from collections import deque
-from threading import Condition, Semaphore, Thread, Lock
+from threading import Condition, Thread, Lock
+
+# pragmas applied to every connection of a pool, before the pragmas it was given itself
+SQLITE_PROFILES: dict[str, dict[str, str]] = {
+    # whatever sqlite defaults to, i.e. a rollback journal, during which writes block all reads
+    'default': {},
+    # readers and the writer don't block each other; commits are only synced to disk on checkpoints, so a power loss
+    # can lose the last few of them, but can't corrupt the database
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'temp_store': 'memory',
+        'cache_size': '-65536',
+        'mmap_size': str(256 * 1024**2),
+        'wal_autocheckpoint': '1000',
+    },
+}
+
+# pragmas sqlite is free to apply partially or not at all (e.g. without memory mapping support), which is only worth a warning
+SQLITE_ADVISORY_PRAGMAS = frozenset(('mmap_size',))
+
+# values as they're given to pragmas, for those that read them back as numbers
+_SQLITE_PRAGMA_VALUES = {
+    'synchronous': { 'off': 0, 'normal': 1, 'full': 2, 'extra': 3 },
+    'temp_store': { 'default': 0, 'file': 1, 'memory': 2 },
+}
+_SQLITE_BOOLEAN_VALUES = { 'off': 0, 'false': 0, 'no': 0, 'on': 1, 'true': 1, 'yes': 1 }
+
+def _pragma_value(pragma: str, value) -> str:
+    value = str(value).strip().lower()
+    return str(_SQLITE_PRAGMA_VALUES.get(pragma, _SQLITE_BOOLEAN_VALUES).get(value, value))
+
+def apply_pragmas(connection: sqlite3.Connection, pragmas: dict[str, str]):
+    """Applies the pragmas and reads them back, as sqlite silently ignores unknown pragmas and values it can't apply."""
+    for pragma, value in pragmas.items():
+        connection.execute(f'pragma {pragma} = {value}').fetchall()
+
+        row = connection.execute(f'pragma {pragma}').fetchone()
+        if row is None:
+            raise AssertionError(f"Unknown sqlite pragma: {pragma}")
+
+        if _pragma_value(pragma, row[0]) == _pragma_value(pragma, value):
+            continue
+
+        message = f"sqlite pragma {pragma} is {row[0]} instead of {value}"
+        if pragma not in SQLITE_ADVISORY_PRAGMAS:
+            raise AssertionError(message)
+
+        print('* Warning:', message)
+
+# upper bounds in seconds of the buckets checkout wait times are counted in, with a last bucket for anything longer
+POOL_WAIT_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
 
 @dataclass
 class PoolConnection:
     last_used: float
     connection: sqlite3.Connection
+    generation: int
+
+@dataclass
+class PoolMetrics:
+    in_use: int
+    idle: int
+    waiting: int
+    opens: int
+    closes: int
+    idle_evictions: int
+    failed_health_checks: int
+    checkouts: int
+    wait_seconds: float
+    # (upper bound in seconds, checkouts), the last bucket is unbounded
+    wait_histogram: list[tuple[float, int]]
 
 class Sqlite3DBPool:
-    def __init__(self, database: str, default_timeout: float = 10, idle_timeout: float = 30, max_connections: int = 10, **pragmas: str):
+    """
+    Up to max_connections connections to a database, handed out to whoever asked first once one is free.
+
+    Connections are checked with a query before they're handed out, and closed once they weren't used for idle_timeout seconds.
+    """
+
+    def __init__(self, database: str, default_timeout: float = 10, idle_timeout: float = 30, max_connections: int = 10, cached_statements: int = 128, profile: str = 'default', **pragmas: str):
+        assert profile in SQLITE_PROFILES, f"Unknown sqlite profile: {profile}"
+        assert max_connections > 0, "max_connections must be at least 1"
+
         self._database = database
         self._max_connections = max_connections
         self._idle_timeout = idle_timeout
         self._default_timeout = default_timeout
-        self._pragmas = pragmas
-        self._connection_sem_allowed = 0
-        self._connection_sem = Semaphore(0)
+        self._cached_statements = cached_statements
+        self._pragmas = { **SQLITE_PROFILES[profile], **pragmas }
+
+        self._cv = Condition()
+        self._open = False
+        # connections opened before the pool was last closed are closed once they're given back
+        self._generation = 0
+        # connections in use, idle or being opened
         self._connection_count = 0
-        self._connections_open = False
-        self._connections_open_cv = Condition()
-        self._connection_pool: deque[PoolConnection] = deque()
-        self._connection_pool_lock = Lock()
-        self._connection_cleanup_thread: Thread = None
+        self._in_use = 0
+        self._idle: deque[PoolConnection] = deque()
+        self._waiters: deque[object] = deque()
+
+        self._opens = 0
+        self._closes = 0
+        self._idle_evictions = 0
+        self._failed_health_checks = 0
+        self._checkouts = 0
+        self._wait_seconds = 0.0
+        self._wait_histogram = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+
+        self._cleanup_stop = threading.Event()
+        self._cleanup_thread: Thread = None
 
     @contextmanager
     def connection(self, timeout=None):
-        if timeout is None:
-            timeout = self._default_timeout
+        pool_item = self._checkout(self._default_timeout if timeout is None else timeout)
+        broken = False
+
+        try:
+            yield pool_item.connection
+            pool_item.connection.commit()
+        finally:
+            # whatever the connection was in the middle of is undone before it's handed out again
+            try:
+                if pool_item.connection.in_transaction:
+                    pool_item.connection.rollback()
+            except sqlite3.Error:
+                broken = True
+
+            self._checkin(pool_item, broken)
+
+    def metrics(self) -> PoolMetrics:
+        with self._cv:
+            return PoolMetrics(
+                in_use=self._in_use,
+                idle=len(self._idle),
+                waiting=len(self._waiters),
+                opens=self._opens,
+                closes=self._closes,
+                idle_evictions=self._idle_evictions,
+                failed_health_checks=self._failed_health_checks,
+                checkouts=self._checkouts,
+                wait_seconds=self._wait_seconds,
+                wait_histogram=list(zip((*POOL_WAIT_BUCKETS, float('inf')), self._wait_histogram)),
+            )
+
+    def _checkout(self, timeout: float) -> PoolConnection:
+        start_t = time.monotonic()
+        timeout_t = start_t + timeout
+
+        with self._cv:
+            waiter = object()
+            self._waiters.append(waiter)
 
-        timeout_t = time.time() + timeout
+            try:
+                # waiting in line, also while the pool is closed, as it might just be reset
+                while not (self._open and self._waiters[0] is waiter and (len(self._idle) > 0 or self._connection_count < self._max_connections)):
+                    if not self._cv.wait(timeout=max(0, timeout_t - time.monotonic())):
+                        raise TimeoutError('Could not aquire database connection')
+            finally:
+                self._waiters.remove(waiter)
+                self._cv.notify_all()
+
+            wait_seconds = time.monotonic() - start_t
+            self._checkouts += 1
+            self._wait_seconds += wait_seconds
+            self._wait_histogram[bisect.bisect_left(POOL_WAIT_BUCKETS, wait_seconds)] += 1
+
+            self._in_use += 1
+            pool_item = self._idle.pop() if len(self._idle) > 0 else None
 
-        with self._connections_open_cv:
-            while not self._connections_open:
-                if not self._connections_open_cv.wait(timeout=max(0, timeout_t-time.time())):
-                    raise TimeoutError('Could not aquire database connection')
+            if pool_item is None:
+                self._connection_count += 1
+
+            generation = self._generation
 
-        if not self._connection_sem.acquire(timeout=max(0, timeout_t-time.time())):
-            raise TimeoutError('Could not aquire database connection')
-        
         try:
-            pool_item = None
+            if pool_item is not None and not self._healthy(pool_item):
+                self._close_connection(pool_item.connection)
+                pool_item = None
 
-            with self._connection_pool_lock:
-                if len(self._connection_pool) > 0:
-                    pool_item = self._connection_pool.popleft()
-                elif self._connection_count < self._max_connections:
-                    connection = sqlite3.connect(self._database, check_same_thread=False)
+                with self._cv:
+                    self._failed_health_checks += 1
 
-                    for pragma, value in self._pragmas.items():
-                        connection.execute(f'pragma {pragma} = {value}')
+            if pool_item is None:
+                pool_item = PoolConnection(last_used=time.monotonic(), connection=self._connect(), generation=generation)
 
-                    pool_item = PoolConnection(last_used=time.time(), connection=connection)
-                    self._connection_count += 1
+                with self._cv:
+                    self._opens += 1
+        except:
+            with self._cv:
+                self._in_use -= 1
+                self._connection_count -= 1
+                self._cv.notify_all()
+            raise
 
-            try:
-                yield pool_item.connection
-                pool_item.connection.commit()
-            except sqlite3.Error:
-                pool_item.connection.rollback()
+        return pool_item
+
+    def _checkin(self, pool_item: PoolConnection, broken: bool = False):
+        with self._cv:
+            self._in_use -= 1
+
+            keep = self._open and not broken and pool_item.generation == self._generation
+            if keep:
+                pool_item.last_used = time.monotonic()
+                self._idle.append(pool_item)
+            else:
+                self._connection_count -= 1
+
+            self._cv.notify_all()
+
+        if not keep:
+            self._close_connection(pool_item.connection)
+
+    def _healthy(self, pool_item: PoolConnection):
+        try:
+            pool_item.connection.execute('select 1').fetchall()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _connect(self):
+        connection = sqlite3.connect(self._database, check_same_thread=False, cached_statements=self._cached_statements)
+
+        try:
+            apply_pragmas(connection, self._pragmas)
+        except:
+            connection.close()
+            raise
+
+        return connection
+
+    def _close_connection(self, connection: sqlite3.Connection):
+        try:
+            connection.close()
         finally:
-            if pool_item is not None:
-                pool_item.last_used = time.time()
+            with self._cv:
+                self._closes += 1
+
+    def open(self):
+        with self._cv:
+            if self._open:
+                return
+
+            self._open = True
+            self._cv.notify_all()
+
+        self._cleanup_stop.clear()
+        self._cleanup_thread = Thread(name=f'Sqlite3DBPool._cleanup', target=self._cleanup, daemon=True)
+        self._cleanup_thread.start()
+
+    def close(self, timeout: float = None):
+        """Closes all connections, waiting up to timeout seconds for those in use to be given back."""
+        with self._cv:
+            if not self._open:
+                return
+
+            self._open = False
+            self._generation += 1
+
+            idle = list(self._idle)
+            self._idle.clear()
+            self._connection_count -= len(idle)
+
+            self._cv.notify_all()
 
-                self._connection_pool.append(pool_item)
-                self._connection_sem.release()
+        for pool_item in idle:
+            self._close_connection(pool_item.connection)
+
+        self._cleanup_stop.set()
+        self._cleanup_thread.join()
+        self._cleanup_thread = None
+
+        # connections still in use are closed as soon as they're given back, even if that's after waiting
+        with self._cv:
+            self._cv.wait_for(lambda: self._in_use == 0, timeout=self._default_timeout if timeout is None else timeout)
+
+    def _cleanup(self):
+        while not self._cleanup_stop.wait(timeout=max(1, min(60, self._idle_timeout))):
+            self._cleanup_connections()
+
+    def _cleanup_connections(self):
+        with self._cv:
+            current_t = time.monotonic()
+
+            removed_connections = [pool_item for pool_item in self._idle if current_t - pool_item.last_used > self._idle_timeout]
+            if len(removed_connections) == 0:
+                return
+
+            self._idle = deque(pool_item for pool_item in self._idle if current_t - pool_item.last_used <= self._idle_timeout)
+            self._connection_count -= len(removed_connections)
+            self._idle_evictions += len(removed_connections)
+
+            self._cv.notify_all()
+
+        for pool_item in removed_connections:
+            self._close_connection(pool_item.connection)
+
+@dataclass
+class WriteOperation:
+    fn: Callable[[sqlite3.Cursor], object]
+    transaction: bool
+    future: Future
+
+class Sqlite3DBWriter:
+    """
+    Runs all the writes to a database on a thread of its own, so writers queue up instead of waiting on sqlite's locks.
+
+    Writes queued up while a transaction is running are grouped into the next transaction, each in a savepoint of its
+    own, so a failing write only undoes its own changes. Results are only handed out once the transaction is committed.
+    """
+
+    def __init__(self, database: str, max_batch_size: int = 64, cached_statements: int = 128, profile: str = 'default', **pragmas: str):
+        assert profile in SQLITE_PROFILES, f"Unknown sqlite profile: {profile}"
+        assert max_batch_size > 0, "max_batch_size must be at least 1"
+
+        self._database = database
+        self._max_batch_size = max_batch_size
+        self._cached_statements = cached_statements
+        self._pragmas = { **SQLITE_PROFILES[profile], **pragmas }
+        self._queue: queue.SimpleQueue[WriteOperation] = queue.SimpleQueue()
+        self._thread: Thread = None
+        self._lock = Lock()
 
     def open(self):
-        with self._connections_open_cv:
-            while self._connection_sem_allowed < self._max_connections:
-                self._connection_sem_allowed += 1
-                self._connection_sem.release()
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            # transactions are started by the writer itself
+            connection = sqlite3.connect(self._database, check_same_thread=False, isolation_level=None, cached_statements=self._cached_statements)
 
-            self._connections_open = True
-            self._connections_open_cv.notify_all()
+            try:
+                apply_pragmas(connection, self._pragmas)
+            except:
+                connection.close()
+                raise
 
-        if self._connection_cleanup_thread is None:
-            self._connection_cleanup_thread = Thread(name=f'Sqlite3DBPool._cleanup', target=self._cleanup, kwargs=dict(until_closed=True), daemon=True)
-            self._connection_cleanup_thread.start()
+            self._thread = Thread(name='Sqlite3DBWriter._run', target=self._run, args=(connection,), daemon=True)
+            self._thread.start()
 
     def close(self):
-        with self._connections_open_cv:
-            self._connections_open = False
+        """Stops the writer once the writes queued up so far are done."""
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
 
-            while self._connection_sem_allowed > 0:
-                self._connection_sem_allowed -= 1
-                self._connection_sem.acquire()
+    def submit(self, fn: Callable[[sqlite3.Cursor], object], transaction: bool = True) -> Future:
+        """Queues up fn to be called with a cursor of the writer; writes that can't run in a transaction (e.g. vacuum) are run on their own."""
+        with self._lock:
+            assert self._thread is not None, "Database writer is closed"
+            assert threading.current_thread() is not self._thread, "Writes can't be queued up from within a write"
 
-            self._connections_open_cv.notify_all()
+            future = Future()
+            self._queue.put(WriteOperation(fn=fn, transaction=transaction, future=future))
 
-        self._connection_sem.release()
-        self._cleanup_connections(all=True)
-        self._connection_sem.acquire()
+            return future
 
-        if self._connection_cleanup_thread is not None:
-            self._connection_cleanup_thread.join()
-            self._connection_cleanup_thread = None
-        
-    def _cleanup(self, until_closed: bool = False):
+    def write(self, fn: Callable[[sqlite3.Cursor], object], transaction: bool = True, timeout: float = None):
+        return self.submit(fn, transaction=transaction).result(timeout=timeout)
+
+    def _run(self, connection: sqlite3.Connection):
         try:
-            while until_closed:
-                with self._connections_open_cv:
-                    self._connections_open_cv.wait(timeout=60)
+            closed = False
+
+            while not closed:
+                operations = [self._queue.get()]
+
+                while len(operations) < self._max_batch_size:
+                    try:
+                        operations.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                batch: list[WriteOperation] = []
+
+                for operation in operations:
+                    if operation is None:
+                        closed = True
+                        break
+
+                    if operation.transaction:
+                        batch.append(operation)
+                        continue
 
-                    if not self._connections_open:
-                        return
+                    # writes are still done in the order they were queued up
+                    self._run_transaction(connection, batch)
+                    batch = []
 
-                self._cleanup_connections()
-        except KeyboardInterrupt:
+                    self._run_operation(connection, operation)
+
+                self._run_transaction(connection, batch)
+        finally:
+            connection.close()
+
+    def _run_transaction(self, connection: sqlite3.Connection, operations: list[WriteOperation]):
+        operations = [operation for operation in operations if operation.future.set_running_or_notify_cancel()]
+
+        if len(operations) > 0:
+            self._run_batch(connection, operations)
+
+    def _run_batch(self, connection: sqlite3.Connection, operations: list[WriteOperation]):
+        """Runs the operations in a single transaction, or one at a time once the transaction is lost, so that only the failing ones fail."""
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('begin immediate')
+        except sqlite3.Error as e:
+            for operation in operations:
+                operation.future.set_exception(e)
             return
-    
-    def _cleanup_connections(self, all: bool = False):
-        removed_connections: list[PoolConnection] = []
-        cleaned_up_connections: list[PoolConnection] = []
 
-        with self._connection_pool_lock:
+        done: list[tuple[WriteOperation, object]] = []
+
+        for i, operation in enumerate(operations):
             try:
-                while self._connection_count > 0:
-                    if not self._connection_sem.acquire(blocking=all):
-                        break
+                cursor.execute(f'savepoint write_{i}')
+                result = operation.fn(cursor)
+                cursor.execute(f'release write_{i}')
+            except Exception as e:
+                operation.future.set_exception(e)
 
-                    current_t = time.time()
+                try:
+                    cursor.execute(f'rollback to write_{i}')
+                    cursor.execute(f'release write_{i}')
+                except sqlite3.Error:
+                    # some errors (e.g. a full disk) roll back the whole transaction, the other writes are run again
+                    self._run_one_by_one(connection, [operation for operation, _ in done] + operations[i+1:])
+                    return
 
-                    try:
-                        if len(self._connection_pool) <= 0:
-                            break
-
-                        pool_item = self._connection_pool.popleft()
-                        assert pool_item is not None, "no connection was aquired"
-
-                        if current_t - pool_item.last_used > self._idle_timeout or all:
-                            pool_item.connection.close()
-                            self._connection_count -= 1
-                            removed_connections.append(pool_item)
-                        else:
-                            cleaned_up_connections.append(pool_item)
-                    finally:
-                        self._connection_sem.release()
-            finally:
-                for pool_item in cleaned_up_connections:
-                    self._connection_pool.append(pool_item)
+                continue
+
+            done.append((operation, result))
+
+        try:
+            cursor.execute('commit')
+        except sqlite3.Error as e:
+            if len(done) > 1:
+                self._run_one_by_one(connection, [operation for operation, _ in done])
+                return
+
+            if connection.in_transaction:
+                connection.rollback()
+
+            for operation, _ in done:
+                operation.future.set_exception(e)
+            return
+
+        for operation, result in done:
+            operation.future.set_result(result)
+
+    def _run_one_by_one(self, connection: sqlite3.Connection, operations: list[WriteOperation]):
+        if connection.in_transaction:
+            connection.rollback()
+
+        for operation in operations:
+            self._run_batch(connection, [operation])
+
+    def _run_operation(self, connection: sqlite3.Connection, operation: WriteOperation):
+        if not operation.future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = operation.fn(connection.cursor())
+        except Exception as e:
+            if connection.in_transaction:
+                connection.rollback()
+
+            operation.future.set_exception(e)
+            return
+
+        if connection.in_transaction:
+            connection.commit()
 
-                # print('removed_connections', removed_connections)
-                # print('cleaned_up_connections', cleaned_up_connections)
+        operation.future.set_result(result)
@@ -1,8 +1,19 @@
-from typing import Tuple, Dict, List
-
+from typing import Collection, Tuple, Dict, List
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import os
+import re
+import json
+import heapq
+import difflib
+import hashlib
 import functools
+import threading
 import numpy as np
 
+from yadt.tagger_prediction import Prediction, TagVocabulary
+
 # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/blob/a9eacb1eff904552d3012babfa28b57e1d3e295c/tagger/ui.py#L368
 kaomojis = {
     "0_0",
@@ -30,373 +41,738 @@ kaomojis = {
 def _replace_underscore_for_tag(tag):
     return tag.replace('_', ' ') if tag not in kaomojis else tag
 
-def post_process_prediction(
-        rating: Dict[str, float],
-        general_res: Dict[str, float],
-        character_res: Dict[str, float],
-        general_thresh: float,
-        general_mcut_enabled: bool,
-        character_thresh: float,
-        character_mcut_enabled: bool,
-        replace_underscores: bool,
-        trim_general_tag_dupes: bool,
-        escape_brackets: bool,
-        prefix_tags: str = None,
-        keep_tags: str = None,
-        ban_tags: str = None,
-        map_tags: str = None,
-):
-    def _threshold(tags: List[Tuple[str, float]], t: float, mcut: bool):
-        def mcut_threshold(probs):
-            """
-            Maximum Cut Thresholding (MCut)
-            Largeron, C., Moulin, C., & Gery, M. (2012). MCut: A Thresholding Strategy
-            for Multi-label Classification. In 11th International Symposium, IDA 2012
-            (pp. 172-183).
-            """
-            sorted_probs = probs[probs.argsort()[::-1]]
-            difs = sorted_probs[:-1] - sorted_probs[1:]
-            t = difs.argmax()
-            thresh = (sorted_probs[t] + sorted_probs[t + 1]) / 2
-            return thresh
+@functools.lru_cache(maxsize=102400)
+def _word_runs(tag: str):
+    """Returns the tag's words, along with every run of consecutive words shorter than the whole tag."""
+    words = tuple(tag.split())
+    runs = frozenset(words[i:i+length] for length in range(len(words)) for i in range(len(words) - length + 1))
+    return words, runs
+
+POST_PROCESS_BATCH_ROWS = 16
+
+@dataclass
+class ThresholdTable:
+    """Thresholds for whole categories or single tags, taking precedence over the ones picked in the ui."""
+    categories: Dict[str, float]
+    tags: Dict[str, float]
+
+    def thresholds(self, vocabulary: TagVocabulary, category: str, default: float) -> np.ndarray:
+        thresholds = self.tag_thresholds(vocabulary, category)
+        return np.where(np.isnan(thresholds), default, thresholds)
+
+    def tag_thresholds(self, vocabulary: TagVocabulary, category: str) -> np.ndarray:
+        """The thresholds the table sets for each tag of a category, NaN for the ones left to the ui."""
+        names = vocabulary.names[vocabulary.indexes(category)].tolist()
+        thresholds = np.full(len(names), self.categories.get(category, np.nan), dtype=np.float64)
+
+        if len(self.tags) > 0:
+            for i, name in enumerate(names):
+                t = self.tags.get(_threshold_table_key(name))
+                if t is not None:
+                    thresholds[i] = t
+
+        return thresholds
+
+    @functools.cached_property
+    def digest(self) -> str:
+        return hashlib.sha256(json.dumps([self.categories, self.tags], sort_keys=True).encode()).hexdigest()
+
+def _threshold_table_key(tag: str):
+    # tables can list tags either the way the model names them or with spaces instead of underscores
+    return tag.replace(' ', '_')
+
+def load_threshold_table(path: str) -> ThresholdTable:
+    """
+    Loads a json file of the form {"categories": {"general": 0.35}, "tags": {"long_hair": 0.5}}.
+    The file is only read again once it changed.
+    """
+    if path is None:
+        return None
+
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError as e:
+        raise AssertionError(f"Threshold table doesn't exist: {path}") from e
+
+    return _load_threshold_table(str(path), mtime_ns)
+
+@functools.lru_cache(maxsize=4)
+def _load_threshold_table(path: str, mtime_ns: int):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise AssertionError(f"Failed to read threshold table: {path}") from e
+
+    assert isinstance(data, dict), f"Threshold table must be a json object: {path}"
+
+    unknown_keys = set(data.keys()) - {'categories', 'tags'}
+    assert len(unknown_keys) == 0, f"Threshold table contains unknown keys: {', '.join(sorted(unknown_keys))}"
+
+    def _thresholds(key: str):
+        thresholds = data.get(key, {})
+        assert isinstance(thresholds, dict), f"Threshold table {key} must be a json object: {path}"
+
+        for name, t in thresholds.items():
+            assert isinstance(t, (int, float)) and 0 <= t <= 1, f"Threshold table {key} must map to numbers between 0 and 1: {name}"
+
+        return thresholds
+
+    return ThresholdTable(
+        categories={ category: float(t) for category, t in _thresholds('categories').items() },
+        tags={ _threshold_table_key(tag): float(t) for tag, t in _thresholds('tags').items() },
+    )
+
+_map_tags_line_re = re.compile("^(\\s*|(.+?) : (.+))$")
+
+@dataclass
+class MapTagsRule:
+    line: str
+    pos_tags: List[str]
+    neg_tags: List[str]
+    mapped_tags: List[str]
+
+def mcut_threshold(probs: np.ndarray):
+    """
+    Maximum Cut Thresholding (MCut)
+    Largeron, C., Moulin, C., & Gery, M. (2012). MCut: A Thresholding Strategy
+    for Multi-label Classification. In 11th International Symposium, IDA 2012
+    (pp. 172-183).
+    """
+    sorted_probs = probs[probs.argsort()[::-1]]
+    difs = sorted_probs[:-1] - sorted_probs[1:]
+    t = difs.argmax()
+    thresh = (sorted_probs[t] + sorted_probs[t + 1]) / 2
+    return thresh
+
+def mcut_thresholds(probs: np.ndarray):
+    """Same as mcut_threshold, for every row of a (N images x tags) matrix at once."""
+    sorted_probs = np.sort(probs, axis=1)[:, ::-1]
+    difs = sorted_probs[:, :-1] - sorted_probs[:, 1:]
+    t = difs.argmax(axis=1)
+    rows = np.arange(len(sorted_probs))
+    thresh = (sorted_probs[rows, t] + sorted_probs[rows, t + 1]) / 2
+    return thresh
+
+def _top_k_mask(probs: np.ndarray, top_k: int):
+    """Marks the top_k highest scores of every row of a (N images x tags) matrix."""
+    # ties for the last place are broken arbitrarily
+    top = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+    in_top = np.zeros(probs.shape, dtype=bool)
+    np.put_along_axis(in_top, top, True, axis=1)
+
+    return in_top
+
+def _parse_tags(tags: str):
+    if tags is None or len(tags) == 0:
+        return None
+
+    return list(filter(lambda t: len(t) > 0, map(lambda t: t.strip(), tags.split(','))))
+
+def _parse_map_tags(map_tags: str):
+    if map_tags is None or len(map_tags) == 0:
+        return None
+
+    map_tags_list: List[MapTagsRule] = []
+
+    for line in map_tags.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+
+        line_match = _map_tags_line_re.match(line)
+        assert line_match is not None, "map tokens is not valid: expected lines of format: token, token, ... : token: {line}"
+
+        _, tokens, to_token = line_match.groups()
+
+        if to_token is None:
+            continue
+
+        to_token = list(map(lambda t: t.strip(), to_token.split(',')))
+        tokens = list(map(lambda t: t.strip(), tokens.split(',')))
+
+        for token in tokens:
+            token = token.strip()
+            token = token.split('&')
+            token_clean = []
+
+            # special handling when the tag contains a "&"
+            c_token = None
+            for _token in token:
+                if c_token is not None:
+                    if _token.rstrip().endswith('"'):
+                        c_token += '&'
+                        c_token += _token.rstrip()
+                        token_clean.append(c_token[1:-1])
+                        c_token = None
+                    else:
+                        c_token += '&'
+                        c_token += _token
+                elif _token.lstrip().startswith('"'):
+                    if _token.rstrip().endswith('"'):
+                        token_clean.append(_token.strip()[1:-1])
+                    else:
+                        c_token = _token.lstrip()
+                else:
+                    token_clean.append(_token.strip())
+
+            pos_tags = list(filter(lambda t: not t.startswith('-'), token_clean))
+            neg_tags = list(map(lambda t: t[1:], filter(lambda t: t.startswith('-'), token_clean)))
+
+            map_tags_list.append(MapTagsRule(line=line, pos_tags=pos_tags, neg_tags=neg_tags, mapped_tags=to_token))
+
+        if c_token is not None:
+            raise AssertionError(f'token mapping contains an invalid condition: unclosed quote: {repr(line)}')
+
+    for rule in map_tags_list:
+        if len(rule.pos_tags) == 0:
+            raise AssertionError(f'token mapping condition must contain at least one positive tag: {repr(rule.line)}')
+
+    return map_tags_list
+
+def _map_tags_cycle(map_tags_list: List[MapTagsRule]):
+    """Returns the rules which would keep on triggering each other, if there are any."""
+    rules_by_pos_tag: Dict[str, List[int]] = {}
+    rules_by_neg_tag: Dict[str, List[int]] = {}
+
+    for i, rule in enumerate(map_tags_list):
+        for tag in set(rule.pos_tags):
+            rules_by_pos_tag.setdefault(tag, []).append(i)
+
+        for tag in set(rule.neg_tags):
+            rules_by_neg_tag.setdefault(tag, []).append(i)
+
+    # a rule can only make other rules apply by adding the tags they require, or taking away the tags they
+    # exclude, while the tags it maps to themselves stay where they are
+    triggered_rules = []
+
+    for i, rule in enumerate(map_tags_list):
+        added_tags = set(rule.mapped_tags).difference(rule.pos_tags)
+        removed_tags = set(rule.pos_tags).difference(rule.mapped_tags)
+
+        triggered_rules.append(sorted(
+            {j for t in added_tags for j in rules_by_pos_tag.get(t, ()) if j != i} |
+            {j for t in removed_tags for j in rules_by_neg_tag.get(t, ()) if j != i}
+        ))
+
+    # depth first search, where coming back to a rule which is still on the path closes a cycle
+    visited = [False] * len(map_tags_list)
+    on_path = [False] * len(map_tags_list)
+
+    for start in range(len(map_tags_list)):
+        if visited[start]:
+            continue
+
+        path = [start]
+        stack = [iter(triggered_rules[start])]
+        visited[start] = on_path[start] = True
+
+        while len(stack) > 0:
+            j = next(stack[-1], None)
+
+            if j is None:
+                on_path[path.pop()] = False
+                stack.pop()
+            elif on_path[j]:
+                return [map_tags_list[k] for k in path[path.index(j):]]
+            elif not visited[j]:
+                visited[j] = on_path[j] = True
+                path.append(j)
+                stack.append(iter(triggered_rules[j]))
+
+    return None
+
+class PostProcessor:
+    """Post processing settings, parsed once so they can be applied to any number of predictions."""
+
+    def __init__(
+            self,
+            general_thresh: float,
+            general_mcut_enabled: bool,
+            character_thresh: float,
+            character_mcut_enabled: bool,
+            replace_underscores: bool,
+            trim_general_tag_dupes: bool,
+            escape_brackets: bool,
+            prefix_tags: str = None,
+            keep_tags: str = None,
+            ban_tags: str = None,
+            map_tags: str = None,
+            threshold_table: ThresholdTable = None,
+            general_top_k: int = None,
+            character_top_k: int = None,
+    ):
+        self.general_thresh = general_thresh
+        self.general_mcut_enabled = general_mcut_enabled
+        self.character_thresh = character_thresh
+        self.character_mcut_enabled = character_mcut_enabled
+        self.replace_underscores = replace_underscores
+        self.trim_general_tag_dupes = trim_general_tag_dupes
+        self.escape_brackets = escape_brackets
+        self.threshold_table = threshold_table
+        self.general_top_k = general_top_k
+        self.character_top_k = character_top_k
+
+        # per tag thresholds only need to be worked out once per vocabulary
+        self._thresholds: Dict[Tuple[int, str], Tuple[TagVocabulary, np.ndarray]] = {}
+
+        # identifies the results of these settings, e.g. for caching them
+        self.fingerprint = hashlib.sha256(json.dumps([
+            general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
+            replace_underscores, trim_general_tag_dupes, escape_brackets,
+            prefix_tags, keep_tags, ban_tags, map_tags,
+            threshold_table.digest if threshold_table is not None else None, general_top_k, character_top_k,
+        ]).encode()).hexdigest()
+
+        self._prefix_tags = _parse_tags(prefix_tags)
+        self._map_tags = _parse_map_tags(map_tags)
+        self._map_tags_index: Dict[str, List[int]] = {}
+
+        # rules only need to be looked at again once one of the tags of their condition changed
+        for i, rule in enumerate(self._map_tags or []):
+            for tag in set(rule.pos_tags + rule.neg_tags):
+                self._map_tags_index.setdefault(tag, []).append(i)
+
+        if self._map_tags is not None and (cycle := _map_tags_cycle(self._map_tags)) is not None:
+            raise AssertionError(f"token mapping contains a cycle: {' -> '.join(repr(rule.line) for rule in cycle)}")
+
+        self._keep_tags: Dict[str, float] = None
+        self._ban_tags: frozenset[str] = None
+
+        if (keep_tags_list := _parse_tags(keep_tags)) is not None:
+            self._keep_tags = {}
+
+            # tags listed first are kept first
+            for i, tag in enumerate(keep_tags_list):
+                self._keep_tags.setdefault(tag, 5.0 + (1.0 - i / len(keep_tags_list)))
+
+        if ban_tags is not None and len(ban_tags) > 0:
+            self._ban_tags = frozenset(map(lambda t: t.strip(), ban_tags.split(',')))
+
+    def process(self, prediction: Prediction):
+        return self.process_batch(prediction.scores[np.newaxis], prediction.vocabulary)[0]
+
+    def process_batch(self, scores: np.ndarray, vocabulary: TagVocabulary):
+        """Post processes the scores of several images tagged by the same model, one row per image."""
+        scores = np.asarray(scores)
+        assert scores.ndim == 2 and scores.shape[1] == len(vocabulary), f"Expected scores of shape (N, {len(vocabulary)}), got {scores.shape}"
+
+        character_tags = vocabulary.category_names('character', replace_underscores=self.replace_underscores)
+        general_tags = vocabulary.category_names('general', replace_underscores=self.replace_underscores)
+
+        rating_names = vocabulary.names[vocabulary.rating_indexes].tolist()
+        ratings = scores[:, vocabulary.rating_indexes].tolist()
+
+        character_thresh = self._category_thresholds(vocabulary, 'character', self.character_thresh)
+        general_thresh = self._category_thresholds(vocabulary, 'general', self.general_thresh)
+
+        results = []
+
+        # thresholds are applied to a block of images at once, only the tags above them are handled one image at a time;
+        # blocks are kept small as the scores are copied to double precision on the way
+        for i in range(0, len(scores), POST_PROCESS_BATCH_ROWS):
+            block = scores[i:i+POST_PROCESS_BATCH_ROWS]
+
+            characters = self._threshold(block, vocabulary, 'character', character_thresh, self.character_mcut_enabled, self.character_top_k)
+            generals = self._threshold(block, vocabulary, 'general', general_thresh, self.general_mcut_enabled, self.general_top_k)
+
+            results.extend(
+                self._process_tags(character_tags, general_tags, dict(zip(rating_names, rating)), character_res, general_res)
+                for rating, character_res, general_res in zip(ratings[i:i+POST_PROCESS_BATCH_ROWS], characters, generals)
+            )
+
+        return results
+
+    def _process_tags(
+            self,
+            character_tags: frozenset[str],
+            general_tags: frozenset[str],
+            rating: Dict[str, float],
+            character_res: List[Tuple[str, float]],
+            general_res: List[Tuple[str, float]],
+    ):
+        character_res = self._replace_underscore(character_res)
+        general_res = self._trim_general_tag_dupes(self._replace_underscore(general_res))
+
+        tag_string = self._generate_string(character_res, general_res)
+
+        rating = self._clean_ratings(rating.items())
+
+        # recreate results to match the changes
+
+        tag_res = list(character_res) + list(general_res)
+        tag_res = sorted(tag_res, key=lambda x: x[1], reverse=True)
+        tag_res = self._map_tokens(tag_res)
+        tag_res = self._ban_tokens(tag_res)
+        tag_res = sorted(tag_res, key=lambda x: x[1], reverse=True)
+
+        character_res = [ (k, v) for k, v in tag_res if k in character_tags ]
+        general_res = [ (k, v) for k, v in tag_res if k in general_tags ]
+
+        return tag_string, dict(rating), dict(general_res), dict(character_res)
+
+    def tag_thresholds(self, vocabulary: TagVocabulary, category: str) -> np.ndarray:
+        """The thresholds of the tags of a category which don't follow the category's threshold, NaN for the ones which do."""
+        if self.threshold_table is None:
+            return np.full(len(vocabulary.indexes(category)), np.nan, dtype=np.float64)
+
+        return self.threshold_table.tag_thresholds(vocabulary, category)
+
+    def top_k(self, category: str) -> int:
+        return self.general_top_k if category == 'general' else self.character_top_k
+
+    def _category_thresholds(self, vocabulary: TagVocabulary, category: str, t: float):
+        if self.threshold_table is None:
+            return t
 
+        key = (id(vocabulary), category)
+        cached = self._thresholds.get(key)
+
+        if cached is None or cached[0] is not vocabulary:
+            cached = self._thresholds[key] = (vocabulary, self.threshold_table.thresholds(vocabulary, category, t))
+
+        return cached[1]
+
+    def _threshold(self, scores: np.ndarray, vocabulary: TagVocabulary, category: str, t: float | np.ndarray, mcut: bool, top_k: int = None):
+        indexes = vocabulary.indexes(category)
+        probs = scores[:, indexes].astype(np.float64)
+
+        # either a single threshold or one per tag, raised per image by mcut
+        thresh = np.asarray(t, dtype=np.float64)
         if mcut:
-            probs = np.array([x[1] for x in tags])
-            t = max(t, mcut_threshold(probs))
-        
-        return [x for x in tags if x[1] >= t]
+            thresh = np.maximum(thresh, mcut_thresholds(probs)[:, np.newaxis])
+
+        selected = probs >= thresh
+
+        if top_k and top_k < probs.shape[1]:
+            selected &= _top_k_mask(probs, top_k)
+
+        # only the tags above the threshold are turned into python objects
+        rows, cols = np.nonzero(selected)
+        names = vocabulary.names[indexes[cols]].tolist()
+        selected_probs = probs[rows, cols].tolist()
 
-    def _replace_underscore(tags: List[Tuple[str, float]]):
-        if not replace_underscores:
+        bounds = np.searchsorted(rows, np.arange(len(probs) + 1)).tolist()
+        return [
+            list(zip(names[start:end], selected_probs[start:end])) for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def _replace_underscore(self, tags: List[Tuple[str, float]]):
+        if not self.replace_underscores:
             return tags
 
         return [
             [ _replace_underscore_for_tag(tag), prob] for tag, prob in tags
         ]
 
-    def _generate_string(character_res: List[Tuple[str, float]], general_res: List[Tuple[str, float]]):
+    def _generate_string(self, character_res: List[Tuple[str, float]], general_res: List[Tuple[str, float]]):
         character_res = character_res
         general_res = list(map(lambda x: (x[0], x[1] - 1.0), general_res))
 
-        # print('generate_string', character_res, general_res)
-
         sorted_tags = sorted(character_res + general_res, key=lambda x: x[1], reverse=True)
-        sorted_tags = _map_tokens(sorted_tags)
-        sorted_tags = _keep_tokens(sorted_tags)
-        sorted_tags = _prefix_tokens(sorted_tags)
-        sorted_tags = _ban_tokens(sorted_tags)
+        sorted_tags = self._map_tokens(sorted_tags)
+        sorted_tags = self._keep_tokens(sorted_tags)
+        sorted_tags = self._prefix_tokens(sorted_tags)
+        sorted_tags = self._ban_tokens(sorted_tags)
         sorted_tags = sorted(sorted_tags, key=lambda x: x[1], reverse=True)
 
         sorted_tags = list(map(lambda x: x[0], sorted_tags))
         generated_string = ', '.join(sorted_tags)
 
-        if escape_brackets:
+        if self.escape_brackets:
             generated_string = generated_string.replace("(", "\\(").replace(")", "\\)")
 
         return generated_string
-    
-    def _trim_general_tag_dupes(tags: List[Tuple[str, float]]):
-        if not trim_general_tag_dupes:
-            return tags
-
-        def matches_tag(search_tag):
-            # returns True if the search_tag's words are included in tag's words
-            #   example: 'A B' & 'A' -> True
-            #   example: 'Aa B' & 'A' -> False
-            #   example: 'A B C' & 'B C' -> True
-            #   example: 'A B Cc' & 'B C' -> False
 
-            search_tag = search_tag[0]
-
-            def _matches_tag(tag):
-                tag = tag[0]
-
-                if tag == search_tag:
-                    return False
-
-                search_tag_words = search_tag.split()
-                tag_words = tag.split()
-                len_tag_words = len(tag_words)
-
-                for i in range(len(search_tag_words)-len_tag_words+1):
-                    if tag_words == search_tag_words[i:len_tag_words+i]:
-                        return True
-
-                return False
-
-            return _matches_tag
-        
-        tags_new = list(tags)
+    def _trim_general_tag_dupes(self, tags: List[Tuple[str, float]]):
+        if not self.trim_general_tag_dupes:
+            return tags
 
-        removed = True
-        while removed:
-            removed = False
-            for i in range(len(tags_new)):
-                tag = tags_new[i]
-                found_tags = list(filter(matches_tag(tag), tags_new))
+        # a tag is dropped when its words show up, in order, within a longer tag
+        #   example: 'A B' & 'A' -> 'A' is dropped
+        #   example: 'Aa B' & 'A' -> both are kept
+        #   example: 'A B C' & 'B C' -> 'B C' is dropped
+        #   example: 'A B Cc' & 'B C' -> both are kept
 
-                if len(found_tags) == 0:
-                    continue
+        tag_runs = [ _word_runs(tag[0]) for tag in tags ]
+        tag_words = [ words for words, _ in tag_runs ]
 
-                for found_tag in found_tags:
-                    tags_new.remove(found_tag)
-                    break
+        contained_words = set()
+        for _, runs in tag_runs:
+            contained_words.update(runs)
 
-                removed = True
-                break
+        # tags made of the same words but spelled differently contain each other, the first spelling is kept
+        first_tags = {}
+        for tag, words in zip(tags, tag_words):
+            first_tags.setdefault(words, tag[0])
 
-        return tags_new
+        return [
+            tag for tag, words in zip(tags, tag_words) if words not in contained_words and first_tags[words] == tag[0]
+        ]
 
-    def _prefix_tokens(tags: List[Tuple[str, float]]):
-        if prefix_tags is None or len(prefix_tags) == 0:
+    def _prefix_tokens(self, tags: List[Tuple[str, float]]):
+        if self._prefix_tags is None:
             return tags
-        
+
         tags_new: List[Tuple[str, float]] = []
 
-        prefix_tags_list = list(filter(lambda t: len(t) > 0, map(lambda t: t.strip(), prefix_tags.split(','))))
         max_prob = max(([0] + list(map(lambda t: t[1], tags))))
 
-        for i, tag in enumerate(reversed(prefix_tags_list)):
+        for i, tag in enumerate(reversed(self._prefix_tags)):
             tags_new.append((tag, i + 1.0 + max_prob))
 
         tags_new.extend(tags)
-        # print('prefix_tokens', tags_new)
         return tags_new
 
-    def _keep_tokens(tags: List[Tuple[str, float]]):
-        if keep_tags is None or len(keep_tags) == 0:
+    def _keep_tokens(self, tags: List[Tuple[str, float]]):
+        if self._keep_tags is None:
             return tags
 
         tags_new: List[Tuple[str, float]] = []
 
-        keep_tags_list = list(filter(lambda t: len(t) > 0, map(lambda t: t.strip(), keep_tags.split(','))))
         max_prob = max(([0] + list(map(lambda t: t[1], tags))))
 
         for tag, prob in tags:
-            if tag in keep_tags_list:
-                prob = 5.0 + (1.0 - keep_tags_list.index(tag) / len(keep_tags_list))
+            tags_new.append((tag, self._keep_tags.get(tag, prob)))
 
-            tags_new.append((tag, prob))
-        
         tags_new.append(('BREAK', max_prob + 1.0))
-        # print('keep_tokens', tags_new)
         return tags_new
 
-    def _ban_tokens(tags: List[Tuple[str, float]]):
-        if ban_tags is None or len(ban_tags) == 0:
+    def _ban_tokens(self, tags: List[Tuple[str, float]]):
+        if self._ban_tags is None:
             return tags
-        
-        tags_new: List[Tuple[str, float]] = []
 
-        ban_tags_list = list(map(lambda t: t.strip(), ban_tags.split(',')))
+        return [(tag, prob) for tag, prob in tags if tag not in self._ban_tags]
 
-        for tag, prob in tags:
-            if tag in ban_tags_list:
-                continue
-
-            tags_new.append((tag, prob))
-
-        # print('ban_tokens', tags_new)
-        return tags_new
-
-
-    def _map_tokens(tags: List[Tuple[str, float]]):
-        if map_tags is None or len(map_tags) == 0:
+    def _map_tokens(self, tags: List[Tuple[str, float]]):
+        if self._map_tags is None:
             return tags
 
-        import re
-        line_re = re.compile("^(\\s*|(.+?) : (.+))$")
-
-        map_tags_list: List[Tuple[List[str], Tuple[str, List[str]]]] = []
+        current_tags: Dict[str, float] = {}
+        for tag, prob in tags:
+            current_tags.setdefault(tag, prob)
 
-        for line in map_tags.splitlines():
-            if line.startswith('#') or not line.strip():
-                continue
+        # rules are applied in passes in the order they were given, like before, but a rule is only queued again
+        # when one of its tags changed: rules after the current one still run in this pass, the others in the next
+        queued = {i for t in current_tags for i in self._map_tags_index.get(t, ())}
+        queue = [(0, i) for i in sorted(queued)]
 
-            line_match = line_re.match(line)
-            assert line_match is not None, "map tokens is not valid: expected lines of format: token, token, ... : token: {line}"
+        while len(queue) > 0:
+            current_pass, i = heapq.heappop(queue)
+            queued.discard(i)
 
-            _, tokens, to_token = line_match.groups()
+            rule = self._map_tags[i]
 
-            if to_token is None:
+            if not all(t in current_tags for t in rule.pos_tags) or any(t in current_tags for t in rule.neg_tags):
                 continue
 
-            to_token = list(map(lambda t: t.strip(), to_token.split(',')))
-            tokens = list(map(lambda t: t.strip(), tokens.split(',')))
-
-            for token in tokens:
-                token = token.strip()
-                token = token.split('&')
-                token_clean = []
-
-                # special handling when the tag contains a "&"
-                c_token = None
-                for _token in token:
-                    if c_token is not None:
-                        if _token.rstrip().endswith('"'):
-                            c_token += '&'
-                            c_token += _token.rstrip()
-                            token_clean.append(c_token[1:-1])
-                            c_token = None
-                        else:
-                            c_token += '&'
-                            c_token += _token
-                    elif _token.lstrip().startswith('"'):
-                        if _token.rstrip().endswith('"'):
-                            token_clean.append(_token.strip()[1:-1])
-                        else:
-                            c_token = _token.lstrip()
-                    else:
-                        token_clean.append(_token.strip())
-
-                map_tags_list.append((token_clean, (line, to_token)))
-            
-            if c_token is not None:
-                raise AssertionError(f'token mapping contains an invalid condition: unclosed quote: {repr(line)}')
-
+            mapping_tags_max_prob = max(current_tags[t] for t in rule.pos_tags)
+            previous_tags = {t: current_tags.get(t) for t in rule.pos_tags + rule.mapped_tags}
 
+            for t in rule.pos_tags:
+                current_tags.pop(t, None)
 
-        has_mapped_a_tag = True
-        for i in range(20):
-            has_mapped_a_tag = False
+            for t in rule.mapped_tags:
+                if t not in current_tags:
+                    current_tags[t] = mapping_tags_max_prob
+                elif current_tags[t] < mapping_tags_max_prob:
+                    # tags which were already there keep the higher score, and the place that comes with it
+                    del current_tags[t]
+                    current_tags[t] = mapping_tags_max_prob
 
-            for mapping_tags, (line, mapped_tags) in map_tags_list:
-                pos_mapping_tags = list(filter(lambda t: not t.startswith('-'), mapping_tags))
-                neg_mapping_tags = list(map(lambda t: t[1:], filter(lambda t: t.startswith('-'), mapping_tags)))
-
-                if len(pos_mapping_tags) == 0:
-                    raise AssertionError(f'token mapping condition must contain at least one positive tag: {repr(line)}')
-
-                pos_mapping_tags_probs = list(map(lambda t: next(filter(lambda e_t: t == e_t[0], tags), ('', 0.0))[1], pos_mapping_tags))
-                neg_mapping_tags_probs = list(map(lambda t: next(filter(lambda e_t: t == e_t[0], tags), ('', 0.0))[1], neg_mapping_tags))
-
-                if not all(pos_mapping_tags_probs) or any(neg_mapping_tags_probs):
-                    continue
-
-                has_mapped_a_tag = has_mapped_a_tag or not all(map(lambda t: t in mapped_tags, pos_mapping_tags))
-                mapping_tags_max_prob = max(pos_mapping_tags_probs)
-
-                tags = list(filter(lambda t: t[0] not in pos_mapping_tags, tags))
-                tags.extend(map(lambda t: (t, mapping_tags_max_prob), mapped_tags))
+            changed_tags = [t for t, prob in previous_tags.items() if current_tags.get(t) != prob]
+            if len(changed_tags) == 0:
+                continue
 
-            if not has_mapped_a_tag:
-                break
-        else:
-            pass # skip for now, might enable later
-            # raise AssertionError('token mapping likely contains a recursion')
-        
-        return tags
+            for t in changed_tags:
+                for j in self._map_tags_index.get(t, ()):
+                    if j not in queued:
+                        heapq.heappush(queue, (current_pass if j > i else current_pass + 1, j))
+                        queued.add(j)
 
+        return list(current_tags.items())
 
-    def _clean_ratings(items: List[Tuple[str, float]]):
+    def _clean_ratings(self, items: List[Tuple[str, float]]):
         items_new = []
         for k, v in items:
             items_new.append([ k.removeprefix('rating_'), v])
         return items_new
 
+class PostProcessCache:
+    """Post processing results of the most recently processed predictions, evicting the least recently used ones."""
 
-    # print('character_res', len(character_res.items()), len(_replace_underscore(_threshold(character_res.items(), character_thresh, character_mcut_enabled))))
-    # print('general_res', len(general_res.items()), len(_replace_underscore(_threshold(general_res.items(), general_thresh, general_mcut_enabled))))
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
 
-    
-    character_res = _replace_underscore(character_res.items())
-    general_res = _replace_underscore(general_res.items())
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()
+        self._lock = threading.Lock()
 
-    character_tags = set([ k for k, _ in character_res ])
-    general_tags = set([ k for k, _ in general_res ])
+    def __len__(self):
+        return len(self._entries)
 
-    character_res = _threshold(character_res, character_thresh, character_mcut_enabled)
-    general_res = _trim_general_tag_dupes(_threshold(general_res, general_thresh, general_mcut_enabled))
+    def get(self, key: tuple):
+        with self._lock:
+            result = self._entries.get(key)
 
-    tag_string = _generate_string(character_res, general_res)
+            if result is None:
+                self.misses += 1
+                return None
 
-    rating = _clean_ratings(rating.items())
-    
-    # recreate results to match the changes
+            self._entries.move_to_end(key)
+            self.hits += 1
 
-    tag_res = list(character_res) + list(general_res)
-    tag_res = sorted(tag_res, key=lambda x: x[1], reverse=True)
-    tag_res = _map_tokens(tag_res)
-    tag_res = _ban_tokens(tag_res)
-    tag_res = sorted(tag_res, key=lambda x: x[1], reverse=True)
+            return result
 
-    character_res = [ (k, v) for k, v in tag_res if k in character_tags ]
-    general_res = [ (k, v) for k, v in tag_res if k in general_tags ]
+    def set(self, key: tuple, result: tuple):
+        if self.max_entries <= 0:
+            return
 
-    return tag_string, dict(rating), dict(general_res), dict(character_res)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+
+            # results of settings that aren't used anymore are never looked up again, so they end up in front
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def post_process_prediction(
+        prediction: Prediction,
+        general_thresh: float,
+        general_mcut_enabled: bool,
+        character_thresh: float,
+        character_mcut_enabled: bool,
+        replace_underscores: bool,
+        trim_general_tag_dupes: bool,
+        escape_brackets: bool,
+        prefix_tags: str = None,
+        keep_tags: str = None,
+        ban_tags: str = None,
+        map_tags: str = None,
+        threshold_table: ThresholdTable = None,
+        general_top_k: int = None,
+        character_top_k: int = None,
+):
+    return PostProcessor(
+        general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
+        replace_underscores, trim_general_tag_dupes, escape_brackets,
+        prefix_tags, keep_tags, ban_tags, map_tags,
+        threshold_table, general_top_k, character_top_k,
+    ).process(prediction)
+
+def post_process_batch(
+        scores: np.ndarray,
+        vocabulary: TagVocabulary,
+        general_thresh: float,
+        general_mcut_enabled: bool,
+        character_thresh: float,
+        character_mcut_enabled: bool,
+        replace_underscores: bool,
+        trim_general_tag_dupes: bool,
+        escape_brackets: bool,
+        prefix_tags: str = None,
+        keep_tags: str = None,
+        ban_tags: str = None,
+        map_tags: str = None,
+        threshold_table: ThresholdTable = None,
+        general_top_k: int = None,
+        character_top_k: int = None,
+):
+    return PostProcessor(
+        general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
+        replace_underscores, trim_general_tag_dupes, escape_brackets,
+        prefix_tags, keep_tags, ban_tags, map_tags,
+        threshold_table, general_top_k, character_top_k,
+    ).process_batch(scores, vocabulary)
+
+def _split_tags(tags: str):
+    return [ tag for tag in map(str.strip, tags.split(',')) if len(tag) > 0 ]
+
+def _diff_tags(a: List[str], b: List[str]):
+    # the trivial cases are what most images run into, and come out the same as ndiff would have them
+    if a == b:
+        return [ '  ' + tag for tag in a ]
+    if len(a) == 0:
+        return [ '+ ' + tag for tag in b ]
+    if len(b) == 0:
+        return [ '- ' + tag for tag in a ]
+
+    # ndiff's intraline hints ('? ' lines) never make it into the results, but would stall the merge
+    return [ line for line in difflib.ndiff(a, b) if not line.startswith('? ') ]
+
+def _merge_tag_diffs(initial: List[str], new: List[str]):
+    i_initial = 0
+    l_initial = len(initial)
+    i_new = 0
+    l_new = len(new)
+
+    merged = []
+
+    while i_initial < l_initial and i_new < l_new:
+        c_initial = initial[i_initial]
+        c_new = new[i_new]
+
+        op_initial, tag_initial = c_initial[:2], c_initial[2:]
+        op_new, tag_new = c_new[:2], c_new[2:]
+
+        tags_equal = tag_initial == tag_new
+
+        match (tags_equal, op_initial, op_new):
+            case (True, _, _):
+                merged.append(c_initial)
+                i_initial += 1
+                i_new += 1
+            case (False, '  ', _):
+                merged.append(c_new)
+                i_new += 1
+            case (False, _, '  '):
+                merged.append(c_initial)
+                i_initial += 1
+            case (False, '+ ', '+ '):
+                merged.append(c_new)
+                i_new += 1
+            case (False, '+ ', '- '):
+                merged.append(c_new)
+                merged.append(c_initial)
+                i_initial += 1
+                i_new += 1
+            case (False, '- ', '+ '):
+                merged.append(c_new)
+                merged.append(c_initial)
+                i_initial += 1
+                i_new += 1
+            case (False, '- ', '- '):
+                merged.append(c_initial)
+                merged.append(c_new)
+                i_initial += 1
+                i_new += 1
+
+    merged.extend(initial[i_initial:])
+    merged.extend(new[i_new:])
+
+    return merged
 
 def post_process_manual_edits(
         initial_tags: str,
         edited_tags: str,
         new_tags: str,
-        whitelist: list[str] = None,
+        whitelist: Collection[str] = None,
 ):
-    import difflib
-
-    def merge_diffs(initial, new):
-        i_initial = 0
-        l_initial = len(initial)
-        i_new = 0
-        l_new = len(new)
-
-        merged = []
-
-        while i_initial < l_initial and i_new < l_new:
-            c_initial = initial[i_initial]
-            c_new = new[i_new]
-
-            op_initial, tag_initial = c_initial[:2], c_initial[2:]
-            op_new, tag_new = c_new[:2], c_new[2:]
-
-            tags_equal = tag_initial == tag_new
-
-            match (tags_equal, op_initial, op_new):
-                case (True, _, _):
-                    merged.append(c_initial)
-                    i_initial += 1
-                    i_new += 1
-                case (False, '  ', _):
-                    merged.append(c_new)
-                    i_new += 1
-                case (False, _, '  '):
-                    merged.append(c_initial)
-                    i_initial += 1
-                case (False, '+ ', '+ '):
-                    merged.append(c_new)
-                    i_new += 1
-                case (False, '+ ', '- '):
-                    merged.append(c_new)
-                    merged.append(c_initial)
-                    i_initial += 1
-                    i_new += 1
-                case (False, '- ', '+ '):
-                    merged.append(c_new)
-                    merged.append(c_initial)
-                    i_initial += 1
-                    i_new += 1
-                case (False, '- ', '- '):
-                    merged.append(c_initial)
-                    merged.append(c_new)
-                    i_initial += 1
-                    i_new += 1
-        
-        
-        for i in range(i_initial, l_initial):
-            merged.append(initial[i])
-
-        for i in range(i_new, l_new):
-            merged.append(new[i])
-        
-        return merged
-    
-    initial_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in initial_tags.split(',')]))
-    edited_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in edited_tags.split(',')]))
-    new_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in new_tags.split(',')]))
-
-    diff_initial = list(difflib.ndiff(initial_tags, edited_tags))
-    diff_new = list(difflib.ndiff(initial_tags, new_tags))
+    initial_tags = _split_tags(initial_tags)
+    edited_tags = _split_tags(edited_tags)
+    new_tags = _split_tags(new_tags)
+
+    diff_initial = _diff_tags(initial_tags, edited_tags)
+    diff_new = _diff_tags(initial_tags, new_tags)
 
     if whitelist is not None:
+        if not isinstance(whitelist, (set, frozenset)):
+            whitelist = frozenset(whitelist)
+
         diff_new_with_whitelist = []
 
         for diff in diff_new:
@@ -418,7 +794,6 @@ def post_process_manual_edits(
 
         diff_new = diff_new_with_whitelist
 
+    diff_after = _merge_tag_diffs(diff_initial, diff_new)
 
-    diff_after = merge_diffs(diff_initial, diff_new)
-
-    return ', '.join(difflib.restore(diff_after, 2))
+    return ', '.join(line[2:] for line in diff_after if line[:2] in ('  ', '+ '))
@@ -0,0 +1,237 @@
+from typing import Dict, List
+from dataclasses import dataclass
+
+import threading
+import numpy as np
+
+from yadt.tagger_prediction import CATEGORY_GENERAL, CATEGORY_CHARACTER, Prediction, TagVocabulary
+from yadt.process_prediction import POST_PROCESS_BATCH_ROWS, PostProcessor, _replace_underscore_for_tag, _top_k_mask
+
+SWEEP_CATEGORIES = (CATEGORY_GENERAL, CATEGORY_CHARACTER)
+
+# scores are put into bins this fine, which is also as precise as the thresholds of a sweep get
+SWEEP_BINS = 100
+
+# predictions are added to the histograms this many at a time
+SWEEP_BLOCK_SIZE = 256
+
+def _float16_bins():
+    # every half precision value mapped to its bin, as cached predictions are stored that way
+    values = np.arange(2**16, dtype=np.uint32).astype(np.uint16).view(np.float16).astype(np.float64)
+    values = np.clip(np.nan_to_num(values, nan=0.0), 0.0, 1.0)
+
+    return np.floor(values * SWEEP_BINS).astype(np.intp)
+
+_FLOAT16_BINS = _float16_bins()
+
+def _score_bins(scores: np.ndarray):
+    if scores.dtype == np.float16:
+        return _FLOAT16_BINS[scores.view(np.uint16)]
+
+    return np.clip(np.floor(scores.astype(np.float64) * SWEEP_BINS), 0, SWEEP_BINS).astype(np.intp)
+
+@dataclass
+class SweepStats:
+    threshold: float
+    images: int
+    tags: int
+    images_without_tags: int
+    images_changed: int
+    tag_counts: np.ndarray
+
+    @property
+    def tags_per_image(self):
+        return self.tags / self.images if self.images > 0 else 0.0
+
+class ThresholdSweep:
+    """
+    Tag statistics of a whole dataset at any threshold, without going through its predictions again.
+
+    Tags are picked like the post processor picks them: the ones with a threshold of their own in the threshold table
+    are counted once, and only the top-k tags of an image count. For the tags following the category's threshold, only
+    histograms of the scores are kept: per tag, how many images scored in each bin, and per image, which bins any of its
+    tags scored in. The trim, map, ban, keep and prefix rules applied afterwards aren't accounted for.
+    """
+
+    def __init__(self, post_processor: PostProcessor):
+        self.post_processor = post_processor
+
+        # the thresholds the dataset was processed with, which the other thresholds are compared to
+        self.thresholds = { CATEGORY_GENERAL: post_processor.general_thresh, CATEGORY_CHARACTER: post_processor.character_thresh }
+        self.vocabulary: TagVocabulary = None
+        self.images = 0
+
+        # mcut picks a threshold per image, which histograms can't tell
+        self.supported = not (post_processor.general_mcut_enabled or post_processor.character_mcut_enabled)
+
+        self._lock = threading.Lock()
+        self._pending: List[np.ndarray] = []
+
+        # per category, the thresholds of the tags which have their own (NaN for the others) and which tags are which
+        self._tag_thresholds: Dict[str, np.ndarray] = {}
+        self._threshold_tags: Dict[str, np.ndarray] = {}
+        self._fixed_tags: Dict[str, np.ndarray] = {}
+
+        self._fixed_counts: Dict[str, np.ndarray] = {}
+        self._image_fixed: Dict[str, List[np.ndarray]] = { category: [] for category in SWEEP_CATEGORIES }
+
+        self._tag_bins: Dict[str, np.ndarray] = {}
+        self._tag_counts: Dict[str, np.ndarray] = {}
+        self._image_bins: Dict[str, List[np.ndarray]] = { category: [] for category in SWEEP_CATEGORIES }
+        self._image_max_bins: Dict[str, List[np.ndarray]] = { category: [] for category in SWEEP_CATEGORIES }
+
+    def add(self, prediction: Prediction):
+        with self._lock:
+            if not self.supported:
+                return
+
+            if self.vocabulary is None:
+                self.vocabulary = prediction.vocabulary
+
+                for category in SWEEP_CATEGORIES:
+                    tag_thresholds = self._tag_thresholds[category] = self.post_processor.tag_thresholds(self.vocabulary, category)
+
+                    self._threshold_tags[category] = np.flatnonzero(np.isnan(tag_thresholds))
+                    self._fixed_tags[category] = np.flatnonzero(~np.isnan(tag_thresholds))
+                    self._fixed_counts[category] = np.zeros(len(self._fixed_tags[category]), dtype=np.int64)
+
+                    # int32 is plenty for image counts, and halves what's kept for large vocabularies
+                    self._tag_bins[category] = np.zeros((len(self._threshold_tags[category]), SWEEP_BINS + 1), dtype=np.int32)
+
+            # models that come up with their own tags for every image (e.g. florence) can't be summed up like this
+            if prediction.vocabulary is not self.vocabulary:
+                self.supported = False
+                self._pending.clear()
+                return
+
+            self._pending.append(prediction.scores)
+            self.images += 1
+
+            if len(self._pending) >= SWEEP_BLOCK_SIZE:
+                self._add_pending()
+
+    def _top_k(self, scores: np.ndarray, indexes: np.ndarray, top_k: int):
+        # the same as the post processor does it, a few rows at a time in double precision
+        return np.concatenate([
+            _top_k_mask(scores[i:i+POST_PROCESS_BATCH_ROWS, indexes].astype(np.float64), top_k)
+            for i in range(0, len(scores), POST_PROCESS_BATCH_ROWS)
+        ])
+
+    def _add_pending(self):
+        if len(self._pending) == 0:
+            return
+
+        scores = np.stack(self._pending)
+        self._pending.clear()
+
+        rows = np.arange(len(scores))[:, np.newaxis]
+
+        for category in SWEEP_CATEGORIES:
+            indexes = self.vocabulary.indexes(category)
+            threshold_tags = self._threshold_tags[category]
+            fixed_tags = self._fixed_tags[category]
+
+            top_k = self.post_processor.top_k(category)
+            in_top = self._top_k(scores, indexes, top_k) if top_k and top_k < len(indexes) else None
+
+            # tags with their own threshold are picked or not regardless of the sliders
+            fixed = scores[:, indexes[fixed_tags]] >= self._tag_thresholds[category][fixed_tags]
+            if in_top is not None:
+                fixed &= in_top[:, fixed_tags]
+
+            self._fixed_counts[category] += fixed.sum(axis=0)
+            self._image_fixed[category].append(fixed.any(axis=1))
+
+            tag_bins = self._tag_bins[category]
+            tag_count = len(tag_bins)
+
+            bins = _score_bins(scores[:, indexes[threshold_tags]])
+            image_bins = np.zeros((len(scores), SWEEP_BINS + 1), dtype=bool)
+
+            if in_top is None:
+                tag_bins += np.bincount(
+                    (bins + np.arange(tag_count) * (SWEEP_BINS + 1)).ravel(),
+                    minlength=tag_count * (SWEEP_BINS + 1),
+                ).reshape(tag_count, SWEEP_BINS + 1)
+
+                image_bins[rows, bins] = True
+                image_max_bins = bins.max(axis=1, initial=-1)
+            else:
+                # tags outside of the top-k of an image are never picked, whatever their score
+                picked_rows, picked_tags = np.nonzero(in_top[:, threshold_tags])
+                picked_bins = bins[picked_rows, picked_tags]
+
+                tag_bins += np.bincount(
+                    picked_bins + picked_tags * (SWEEP_BINS + 1),
+                    minlength=tag_count * (SWEEP_BINS + 1),
+                ).reshape(tag_count, SWEEP_BINS + 1)
+
+                image_bins[picked_rows, picked_bins] = True
+                image_max_bins = np.full(len(scores), -1, dtype=np.intp)
+                np.maximum.at(image_max_bins, picked_rows, picked_bins)
+
+            self._image_bins[category].append(image_bins)
+            self._image_max_bins[category].append(image_max_bins)
+            self._tag_counts.pop(category, None)
+
+    def _threshold_bin(self, threshold: float):
+        return min(max(int(round(threshold * SWEEP_BINS)), 0), SWEEP_BINS)
+
+    def stats(self, category: str, threshold: float) -> SweepStats:
+        with self._lock:
+            assert self.supported and self.vocabulary is not None, "No tag statistics for this dataset"
+
+            self._add_pending()
+
+            # per tag, the number of images scoring at or above each bin
+            tag_counts = self._tag_counts.get(category)
+            if tag_counts is None:
+                tag_counts = self._tag_counts[category] = self._tag_bins[category][:, ::-1].cumsum(axis=1, dtype=np.int32)[:, ::-1]
+
+            # blocks are joined once they're needed, so that adding stays cheap
+            if len(self._image_bins[category]) > 1:
+                self._image_bins[category] = [np.concatenate(self._image_bins[category])]
+                self._image_max_bins[category] = [np.concatenate(self._image_max_bins[category])]
+                self._image_fixed[category] = [np.concatenate(self._image_fixed[category])]
+
+            image_bins = self._image_bins[category][0] if len(self._image_bins[category]) > 0 else np.zeros((0, SWEEP_BINS + 1), dtype=bool)
+            image_max_bins = self._image_max_bins[category][0] if len(self._image_max_bins[category]) > 0 else np.zeros((0,), dtype=np.intp)
+            image_fixed = self._image_fixed[category][0] if len(self._image_fixed[category]) > 0 else np.zeros((0,), dtype=bool)
+            fixed_counts = self._fixed_counts[category].copy()
+
+        i = self._threshold_bin(threshold)
+        low, high = sorted((i, self._threshold_bin(self.thresholds[category])))
+
+        counts = np.zeros(len(self._tag_thresholds[category]), dtype=np.int64)
+        counts[self._threshold_tags[category]] = tag_counts[:, i]
+        counts[self._fixed_tags[category]] = fixed_counts
+
+        return SweepStats(
+            threshold=i / SWEEP_BINS,
+            images=len(image_bins),
+            tags=int(counts.sum()),
+            images_without_tags=int(((image_max_bins < i) & ~image_fixed).sum()),
+            # images with any tag scored between the two thresholds end up with different tags
+            images_changed=int(image_bins[:, low:high].any(axis=1).sum()),
+            tag_counts=counts,
+        )
+
+    def tag_names(self, category: str, indexes: np.ndarray, replace_underscores: bool = False) -> List[str]:
+        names = self.vocabulary.names[self.vocabulary.indexes(category)[indexes]].tolist()
+
+        if replace_underscores:
+            names = list(map(_replace_underscore_for_tag, names))
+
+        return names
+
+    def changed_tags(self, category: str, before: SweepStats, after: SweepStats, limit: int, replace_underscores: bool = False) -> Dict[str, int]:
+        """Returns the tags whose image counts change the most between two thresholds."""
+        difference = after.tag_counts - before.tag_counts
+        changed = np.flatnonzero(difference)
+
+        if len(changed) > limit:
+            changed = changed[np.argpartition(-np.abs(difference[changed]), limit - 1)[:limit]]
+
+        changed = changed[np.argsort(-np.abs(difference[changed]), kind='stable')]
+
+        return dict(zip(self.tag_names(category, changed, replace_underscores), difference[changed].tolist()))
@@ -1,7 +1,11 @@
+from typing import List
+
 import huggingface_hub
 
 from PIL import Image
 
+from yadt.tagger_prediction import Prediction, TagVocabulary
+
 MODEL_REPO_PREFIX = "Camais03/" 
 
 CAMIE_MODEL_FULL = "Camais03/camie-tagger"
@@ -10,6 +14,7 @@ CAMIE_MODEL_INITIAL_ONLY = "Camais03/camie-tagger (low vram/initial only)"
 class Predictor:
     def __init__(self):
         self.model = None
+        self.vocabulary: TagVocabulary = None
 
     def download_model(self, full_model: bool):
         metadata_path = huggingface_hub.hf_hub_download(
@@ -53,7 +58,7 @@ class Predictor:
 
         from yadt.tagger_camie_model import load_model
 
-        self.model, _, _ = load_model(
+        self.model, dataset, _ = load_model(
             '.',
             full=full_model,
             metadata_path=metadata_path,
@@ -62,11 +67,37 @@ class Predictor:
             device=device,
         )
 
+        self.vocabulary = TagVocabulary.shared(
+            dataset.tag_names.tolist(),
+            dataset.category_indices('rating'),
+            dataset.category_indices('general'),
+            dataset.category_indices('character'),
+        )
+
+
+    def memory_usage(self) -> int:
+        assert self.model is not None, "No model loaded"
+
+        return sum(t.numel() * t.element_size() for t in self.model.parameters()) + \
+            sum(t.numel() * t.element_size() for t in self.model.buffers())
 
     def predict(self, image: Image):
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images: List[Image.Image]):
+        return self.predict_prepared([self.prepare_image(image) for image in images])
+
+    def prepare_image(self, image: Image):
+        assert self.model is not None, "No model loaded"
+
+        return self.model.preprocess_image(image)
+
+    def predict_prepared(self, inputs: List):
         assert self.model is not None, "No model loaded"
 
-        results = self.model.predict(image)
-        tags = self.model.get_tags_from_predictions(results['predictions'], probabilities=results['refined_probabilities'])
+        import torch
+
+        results = self.model.predict_tensor(torch.stack(inputs))
+        probabilities = results['refined_probabilities'].float().cpu().numpy()
 
-        return dict(tags['rating']), dict(tags['general']), dict(tags['character'])
+        return [Prediction(self.vocabulary, probs) for probs in probabilities]
@@ -1,6 +1,7 @@
 # Author: Camais03
 # Source: https://huggingface.co/Camais03/camie-tagger
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -125,8 +126,20 @@ class InitialOnlyImageTagger(nn.Module):
         """
         Run inference on an image with support for category-specific thresholds.
         """
-        # Preprocess the image
-        img_tensor = self.preprocess_image(image_path).unsqueeze(0)
+        return self.predict_batch([image_path], threshold=threshold, category_thresholds=category_thresholds)
+
+    def predict_batch(self, images, threshold=0, category_thresholds=None):
+        """
+        Run inference on a batch of images with support for category-specific thresholds.
+        """
+        # Preprocess the images
+        img_tensor = torch.stack([self.preprocess_image(image) for image in images])
+        return self.predict_tensor(img_tensor, threshold=threshold, category_thresholds=category_thresholds)
+
+    def predict_tensor(self, img_tensor, threshold=0, category_thresholds=None):
+        """
+        Run inference on a batch of preprocessed images with support for category-specific thresholds.
+        """
         
         # Move to the same device as model and convert to half precision
         device = next(self.parameters()).device
@@ -147,21 +160,11 @@ class InitialOnlyImageTagger(nn.Module):
                 
                 # Apply thresholds by category
                 for category, cat_threshold in category_thresholds.items():
-                    # Create a mask for tags in this category
-                    category_mask = torch.zeros_like(initial_probs, dtype=torch.bool)
-                    
-                    # Find indices for this category
-                    for tag_idx in range(initial_probs.size(-1)):
-                        try:
-                            _, tag_category = self.dataset.get_tag_info(tag_idx)
-                            if tag_category == category:
-                                category_mask[:, tag_idx] = True
-                        except:
-                            continue
+                    # Mask for tags in this category
+                    category_mask = self.dataset.category_mask(category, device)
                     
                     # Apply threshold only to tags in this category
-                    cat_threshold_tensor = torch.tensor(cat_threshold, device=device, dtype=dtype)
-                    initial_binary[category_mask] = (initial_probs[category_mask] >= cat_threshold_tensor).to(dtype)
+                    initial_binary[:, category_mask] = (initial_probs[:, category_mask] >= cat_threshold).to(dtype)
                 
                 predictions = initial_binary
             else:
@@ -188,28 +191,13 @@ class InitialOnlyImageTagger(nn.Module):
             probabilities = probabilities[0]  # Remove batch dimension
             
         # Get indices of positive predictions
-        indices = torch.where(predictions > 0)[0].cpu().tolist()
+        indices = torch.where(predictions > 0)[0].cpu().numpy()
 
-        # Group by category
-        result = {}
-        for idx in indices:
-            tag_name, category = self.dataset.get_tag_info(idx)
-            
-            if category not in result:
-                result[category] = []
-            
-            if probabilities is not None:
-                prob = probabilities[idx].item()
-                result[category].append((tag_name, prob))
-            else:
-                result[category].append(tag_name)
-        
-        # Sort tags by probability within each category
         if probabilities is not None:
-            for category in result:
-                result[category] = sorted(result[category], key=lambda x: x[1], reverse=True)
-        
-        return result
+            probabilities = probabilities.float().cpu().numpy()
+
+        # Group by category
+        return self.dataset.tags_by_category(indices, probabilities)
 
 # class FlashAttentionCPU(nn.MultiheadAttention):
 #     def forward(self, query: torch.Tensor, key: Optional[torch.Tensor] = None, 
@@ -565,6 +553,14 @@ class TagDataset:
         self.total_tags = total_tags
         self.idx_to_tag = {int(k): v for k, v in idx_to_tag.items()}
         self.tag_to_category = tag_to_category
+
+        # Lookup tables so that tags can be resolved with array indexing instead of per-tag calls
+        tag_info = [self.get_tag_info(idx) for idx in range(total_tags)]
+        self.tag_names = np.array([tag_name for tag_name, _ in tag_info], dtype=object)
+        self.categories = list(dict.fromkeys(category for _, category in tag_info))
+        category_codes = {category: code for code, category in enumerate(self.categories)}
+        self.tag_category_codes = np.array([category_codes[category] for _, category in tag_info], dtype=np.int64)
+        self._category_masks = {}
     
     def get_tag_info(self, idx):
         """Get tag name and category for a given index"""
@@ -572,6 +568,53 @@ class TagDataset:
         category = self.tag_to_category.get(tag_name, "general")
         return tag_name, category
 
+    def category_indices(self, category):
+        """Get the indices of all the tags in a category"""
+        if category not in self.categories:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.flatnonzero(self.tag_category_codes == self.categories.index(category))
+
+    def category_mask(self, category, device):
+        """Get a boolean mask over all tags selecting the given category"""
+        key = (category, str(device))
+        mask = self._category_masks.get(key)
+
+        if mask is None:
+            mask = torch.zeros(self.total_tags, dtype=torch.bool)
+            mask[torch.from_numpy(self.category_indices(category))] = True
+            mask = self._category_masks[key] = mask.to(device)
+
+        return mask
+
+    def tags_by_category(self, indices, probabilities=None):
+        """Group tag indices by category, keeping categories in order of first appearance"""
+        result = {}
+
+        if len(indices) == 0:
+            return result
+
+        codes = self.tag_category_codes[indices]
+        _, first_seen = np.unique(codes, return_index=True)
+
+        for code in codes[np.sort(first_seen)]:
+            category_indices = indices[codes == code]
+            tag_names = self.tag_names[category_indices].tolist()
+
+            if probabilities is not None:
+                category_probabilities = probabilities[category_indices]
+
+                # Sort tags by probability within each category
+                order = np.argsort(-category_probabilities, kind='stable')
+                result[self.categories[code]] = list(zip(
+                    [tag_names[i] for i in order],
+                    category_probabilities[order].tolist(),
+                ))
+            else:
+                result[self.categories[code]] = tag_names
+
+        return result
+
 class ImageTagger(nn.Module):
     def __init__(self, total_tags, dataset, model_name='efficientnet_v2_l',
                  num_heads=16, dropout=0.1, pretrained=True,
@@ -756,8 +799,20 @@ class ImageTagger(nn.Module):
         """
         Run inference on an image with support for category-specific thresholds.
         """
-        # Preprocess the image
-        img_tensor = self.preprocess_image(image_path).unsqueeze(0)
+        return self.predict_batch([image_path], threshold=threshold, category_thresholds=category_thresholds)
+
+    def predict_batch(self, images, threshold=0, category_thresholds=None):
+        """
+        Run inference on a batch of images with support for category-specific thresholds.
+        """
+        # Preprocess the images
+        img_tensor = torch.stack([self.preprocess_image(image) for image in images])
+        return self.predict_tensor(img_tensor, threshold=threshold, category_thresholds=category_thresholds)
+
+    def predict_tensor(self, img_tensor, threshold=0, category_thresholds=None):
+        """
+        Run inference on a batch of preprocessed images with support for category-specific thresholds.
+        """
         
         # Move to the same device as model and convert to half precision
         device = next(self.parameters()).device
@@ -779,21 +834,11 @@ class ImageTagger(nn.Module):
                 
                 # Apply thresholds by category
                 for category, cat_threshold in category_thresholds.items():
-                    # Create a mask for tags in this category
-                    category_mask = torch.zeros_like(refined_probs, dtype=torch.bool)
+                    # Mask for tags in this category
+                    category_mask = self.dataset.category_mask(category, device)
                     
-                    # Find indices for this category
-                    for tag_idx in range(refined_probs.size(-1)):
-                        try:
-                            _, tag_category = self.dataset.get_tag_info(tag_idx)
-                            if tag_category == category:
-                                category_mask[:, tag_idx] = True
-                        except:
-                            continue
-                    
-                    # Apply threshold only to tags in this category - ensure dtype consistency
-                    cat_threshold_tensor = torch.tensor(cat_threshold, device=device, dtype=dtype)
-                    refined_binary[category_mask] = (refined_probs[category_mask] >= cat_threshold_tensor).to(dtype)
+                    # Apply threshold only to tags in this category
+                    refined_binary[:, category_mask] = (refined_probs[:, category_mask] >= cat_threshold).to(dtype)
                 
                 predictions = refined_binary
             else:
@@ -820,28 +865,13 @@ class ImageTagger(nn.Module):
             probabilities = probabilities[0]  # Remove batch dimension
             
         # Get indices of positive predictions
-        indices = torch.where(predictions > 0)[0].cpu().tolist()
+        indices = torch.where(predictions > 0)[0].cpu().numpy()
 
-        # Group by category
-        result = {}
-        for idx in indices:
-            tag_name, category = self.dataset.get_tag_info(idx)
-            
-            if category not in result:
-                result[category] = []
-            
-            if probabilities is not None:
-                prob = probabilities[idx].item()
-                result[category].append((tag_name, prob))
-            else:
-                result[category].append(tag_name)
-        
-        # Sort tags by probability within each category
         if probabilities is not None:
-            for category in result:
-                result[category] = sorted(result[category], key=lambda x: x[1], reverse=True)
-        
-        return result
+            probabilities = probabilities.float().cpu().numpy()
+
+        # Group by category
+        return self.dataset.tags_by_category(indices, probabilities)
 
 def load_model(model_dir, full=False, device='cpu', **kwargs):
     """Load model with better error handling and warnings"""
@@ -1,7 +1,11 @@
+from typing import List
+
 import huggingface_hub
 
 from PIL import Image
 
+from yadt.tagger_prediction import Prediction
+
 MODEL_REPO_PREFIX = "MiaoshouAI/" 
 
 FLORENCE2_PROMPTGEN_LARGE = "MiaoshouAI/Florence-2-large-PromptGen-v2.0"
@@ -33,16 +37,31 @@ class Predictor:
         if self.device is not None:
             self.model.to(self.device)
 
-    def predict(self, image: Image):
+    def memory_usage(self) -> int:
         assert self.model is not None, "No model loaded"
-        assert self.processor is not None, "No model processor loaded"
 
+        return sum(t.numel() * t.element_size() for t in self.model.parameters()) + \
+            sum(t.numel() * t.element_size() for t in self.model.buffers())
+
+    def predict(self, image: Image):
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images: List[Image.Image]):
+        return self.predict_prepared([self.prepare_image(image) for image in images])
+
+    def prepare_image(self, image: Image):
         if getattr(image, "mode", "NOT_RGB") != "RGB":
             rgb_image = Image.new("RGB", image.size, (255, 255, 255))
             rgb_image.paste(image)
             image = rgb_image
 
-        inputs = self.processor(text=self.prompt, images=image, return_tensors="pt")
+        return image
+
+    def predict_prepared(self, rgb_images: List[Image.Image]):
+        assert self.model is not None, "No model loaded"
+        assert self.processor is not None, "No model processor loaded"
+
+        inputs = self.processor(text=[self.prompt] * len(rgb_images), images=rgb_images, return_tensors="pt")
         if self.device is not None:
             inputs = inputs.to(self.device)
 
@@ -53,8 +72,11 @@ class Predictor:
             do_sample=False,
             num_beams=3
         )
-        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+        generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=False)
 
-        parsed_answer: str = self.processor.post_process_generation(generated_text, task=self.prompt, image_size=(image.width, image.height))
+        predictions = []
+        for image, generated_text in zip(rgb_images, generated_texts):
+            parsed_answer: str = self.processor.post_process_generation(generated_text, task=self.prompt, image_size=(image.width, image.height))
+            predictions.append(Prediction.from_dicts({}, { tag.strip(): 1.0 for tag in parsed_answer[self.prompt].split(',')}, {}))
 
-        return {}, { tag.strip(): 1.0 for tag in parsed_answer[self.prompt].split(',')}, {}
+        return predictions
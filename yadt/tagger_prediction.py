@@ -0,0 +1,166 @@
+import sys
+import zlib
+import struct
+import hashlib
+import threading
+import functools
+import weakref
+
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+CATEGORY_RATING = 'rating'
+CATEGORY_GENERAL = 'general'
+CATEGORY_CHARACTER = 'character'
+
+CATEGORIES = (CATEGORY_RATING, CATEGORY_GENERAL, CATEGORY_CHARACTER)
+
+_vocabularies: 'weakref.WeakValueDictionary[bytes, TagVocabulary]' = weakref.WeakValueDictionary()
+_vocabularies_lock = threading.Lock()
+
+# category sizes, followed by the category indexes and the '\0' separated tag names
+_VOCABULARY_HEADER = struct.Struct('<III')
+
+class TagVocabulary:
+    """Tag names of a model, split by category. Shared between all the predictions made by that model."""
+
+    def __init__(self, names: Sequence[str], rating_indexes: Sequence[int], general_indexes: Sequence[int], character_indexes: Sequence[int]):
+        self.names = np.array([sys.intern(str(name)) for name in names], dtype=object)
+        self.rating_indexes = np.asarray(rating_indexes, dtype=np.int64)
+        self.general_indexes = np.asarray(general_indexes, dtype=np.int64)
+        self.character_indexes = np.asarray(character_indexes, dtype=np.int64)
+
+        self._category_names: Dict[tuple[str, bool], frozenset[str]] = {}
+        self._bytes: bytes = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def shared(names: Sequence[str], rating_indexes: Sequence[int], general_indexes: Sequence[int], character_indexes: Sequence[int]) -> 'TagVocabulary':
+        """Returns the vocabulary already in use for the same tags, creating it if needed."""
+        digest = TagVocabulary._digest(names, rating_indexes, general_indexes, character_indexes)
+
+        with _vocabularies_lock:
+            vocabulary = _vocabularies.get(digest)
+
+            if vocabulary is None:
+                vocabulary = TagVocabulary(names, rating_indexes, general_indexes, character_indexes)
+                vocabulary.__dict__['digest'] = digest
+                _vocabularies[digest] = vocabulary
+
+            return vocabulary
+
+    @staticmethod
+    def _digest(names: Sequence[str], rating_indexes: Sequence[int], general_indexes: Sequence[int], character_indexes: Sequence[int]) -> bytes:
+        digest = hashlib.sha256('\0'.join(names).encode())
+
+        for indexes in (rating_indexes, general_indexes, character_indexes):
+            digest.update(b'\0')
+            digest.update(np.asarray(indexes, dtype=np.int64).tobytes())
+
+        return digest.digest()
+
+    @functools.cached_property
+    def digest(self) -> bytes:
+        return self._digest(self.names.tolist(), self.rating_indexes, self.general_indexes, self.character_indexes)
+
+    def to_bytes(self) -> bytes:
+        if self._bytes is not None:
+            return self._bytes
+
+        indexes = (self.rating_indexes, self.general_indexes, self.character_indexes)
+
+        self._bytes = zlib.compress(b''.join([
+            _VOCABULARY_HEADER.pack(*map(len, indexes)),
+            *(i.astype('<i4').tobytes() for i in indexes),
+            '\0'.join(self.names.tolist()).encode(),
+        ]))
+
+        return self._bytes
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'TagVocabulary':
+        data = zlib.decompress(data)
+
+        counts = _VOCABULARY_HEADER.unpack_from(data)
+        offset = _VOCABULARY_HEADER.size
+
+        indexes = []
+        for count in counts:
+            indexes.append(np.frombuffer(data, dtype='<i4', count=count, offset=offset))
+            offset += count * 4
+
+        names = data[offset:].decode().split('\0') if offset < len(data) else []
+        return TagVocabulary.shared(names, *indexes)
+
+    def indexes(self, category: str) -> np.ndarray:
+        match category:
+            case 'rating':
+                return self.rating_indexes
+            case 'general':
+                return self.general_indexes
+            case 'character':
+                return self.character_indexes
+            case _:
+                raise AssertionError(f"Unknown tag category: {category}")
+
+    def category_names(self, category: str, replace_underscores: bool = False) -> frozenset[str]:
+        key = (category, replace_underscores)
+        category_names = self._category_names.get(key)
+
+        if category_names is None:
+            from yadt.process_prediction import _replace_underscore_for_tag
+
+            names = self.names[self.indexes(category)].tolist()
+
+            if replace_underscores:
+                names = map(_replace_underscore_for_tag, names)
+
+            category_names = self._category_names[key] = frozenset(names)
+
+        return category_names
+
+
+class Prediction:
+    """Scores for one image, indexed by the model's tag vocabulary."""
+
+    __slots__ = ('vocabulary', 'scores')
+
+    def __init__(self, vocabulary: TagVocabulary, scores: np.ndarray):
+        # half precision scores are kept as is, so cached predictions don't need to be copied
+        scores = np.asarray(scores)
+        if scores.dtype != np.float16:
+            scores = scores.astype(np.float32, copy=False)
+
+        assert scores.shape == (len(vocabulary),), f"Expected {len(vocabulary)} scores, got shape {scores.shape}"
+
+        self.vocabulary = vocabulary
+        self.scores = scores
+
+    @staticmethod
+    def from_dicts(rating: Dict[str, float], general_res: Dict[str, float], character_res: Dict[str, float]) -> 'Prediction':
+        names: List[str] = []
+        scores: List[float] = []
+        indexes: List[List[int]] = []
+
+        for results in (rating, general_res, character_res):
+            indexes.append(list(range(len(names), len(names) + len(results))))
+            names.extend(results.keys())
+            scores.extend(results.values())
+
+        return Prediction(TagVocabulary.shared(names, *indexes), np.array(scores, dtype=np.float32))
+
+    def _category_dict(self, category: str) -> Dict[str, float]:
+        indexes = self.vocabulary.indexes(category)
+        return dict(zip(self.vocabulary.names[indexes].tolist(), self.scores[indexes].tolist()))
+
+    def rating(self) -> Dict[str, float]:
+        return self._category_dict(CATEGORY_RATING)
+
+    def general(self) -> Dict[str, float]:
+        return self._category_dict(CATEGORY_GENERAL)
+
+    def character(self) -> Dict[str, float]:
+        return self._category_dict(CATEGORY_CHARACTER)
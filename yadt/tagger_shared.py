@@ -1,41 +1,265 @@
-from typing import Tuple, Dict
+import gc
+import sys
+import time
 
+from typing import List
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Condition, RLock, Thread
+
+from injector import inject
 from PIL import Image
 
+from yadt.configuration import Configuration
+from yadt.tagger_prediction import Prediction
+
 from yadt import tagger_camie
 from yadt import tagger_smilingwolf
 from yadt import tagger_florence2_promptgen
 
+@dataclass
+class LoadedModel:
+    model_repo: str
+    model: object
+    memory_usage: int
+    last_used: float
+    # runs and calls using the model at the moment, it isn't unloaded while there are any
+    in_use: int = 0
+
 class Predictor:
-    def __init__(self):
-        self.last_loaded_repo = None
-        self.model: 'Predictor' = None
+    @inject
+    def __init__(self, configuration: Configuration):
+        self._configuration = configuration
 
-    def load_model(self, model_repo: str, **kwargs):
-        if self.last_loaded_repo == model_repo:
-            return
-        
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._models_lock = RLock()
+        self._models_cv = Condition(self._models_lock)
+        # models are loaded outside of the lock, so the loaded ones can still be used in the meantime
+        self._loading: set[str] = set()
+        self._loading_cv = Condition(self._models_lock)
+        self._model_kwargs_last = {}
+        self._cleanup_thread: Thread = None
+
+    def max_batch_size(self, model: LoadedModel) -> int:
+        max_batch_size = self._configuration.batch_size
+
+        # some backends (e.g. onnx models exported with a fixed batch dimension) can't go above a certain size
+        model_max_batch_size = getattr(model.model, 'max_batch_size', None)
+        if model_max_batch_size is not None:
+            max_batch_size = min(max_batch_size, model_max_batch_size)
+
+        return max(1, max_batch_size)
+
+    @property
+    def loaded_models(self) -> List[str]:
+        with self._models_lock:
+            return list(self._models.keys())
+
+    def _model_kwargs(self, **kwargs):
+        kwargs.setdefault('device', self._configuration.device)
+        kwargs.setdefault('session_options', dict(
+            graph_optimization_level=self._configuration.onnx_graph_optimization_level,
+            intra_op_threads=self._configuration.onnx_intra_op_threads,
+            inter_op_threads=self._configuration.onnx_inter_op_threads,
+            execution_mode=self._configuration.onnx_execution_mode,
+            enable_mem_arena=self._configuration.onnx_enable_mem_arena,
+            enable_mem_pattern=self._configuration.onnx_enable_mem_pattern,
+        ))
+
+        return kwargs
+
+    def _create_model(self, model_repo: str, **kwargs):
         if model_repo.startswith(tagger_smilingwolf.MODEL_REPO_PREFIX):
             from yadt.tagger_smilingwolf import Predictor
-            self.model = Predictor()
-            self.model.load_model(model_repo, **kwargs)
+            model = Predictor()
+            model.load_model(model_repo, **kwargs)
         elif model_repo.startswith(tagger_camie.MODEL_REPO_PREFIX):
             from yadt.tagger_camie import Predictor
-            self.model = Predictor()
-            self.model.load_model(model_repo, **kwargs)
+            model = Predictor()
+            model.load_model(model_repo, **kwargs)
         elif model_repo.startswith(tagger_florence2_promptgen.MODEL_REPO_PREFIX):
             from yadt.tagger_florence2_promptgen import Predictor
-            self.model = Predictor()
-            self.model.load_model(model_repo, **kwargs)
+            model = Predictor()
+            model.load_model(model_repo, **kwargs)
         else:
             raise AssertionError("Model is not supported: " + model_repo)
-        
-        self.last_loaded_repo = model_repo
 
+        return model
+
+    def load_model(self, model_repo: str, **kwargs) -> LoadedModel:
+        """Loads the model unless it's loaded already, and returns the handle to predict with."""
+        with self._models_lock:
+            self._model_kwargs_last[model_repo] = self._model_kwargs(**kwargs)
+
+        loaded_model = self._acquire_model(model_repo)
+        self._release_model(loaded_model)
+
+        return loaded_model
+
+    @contextmanager
+    def use_model(self, model_repo: str, **kwargs):
+        """Loads the model and keeps it from being unloaded until the end of the block."""
+        with self._models_lock:
+            self._model_kwargs_last[model_repo] = self._model_kwargs(**kwargs)
+
+        loaded_model = self._acquire_model(model_repo)
+
+        try:
+            yield loaded_model
+        finally:
+            self._release_model(loaded_model)
+
+    def _acquire_model(self, model_repo: str) -> LoadedModel:
+        with self._models_lock:
+            while model_repo in self._loading:
+                self._loading_cv.wait()
+
+            loaded_model = self._models.get(model_repo)
+
+            if loaded_model is not None:
+                loaded_model.in_use += 1
+                loaded_model.last_used = time.time()
+                self._models.move_to_end(model_repo)
+
+                return loaded_model
+
+            self._loading.add(model_repo)
+            kwargs = self._model_kwargs_last.get(model_repo) or self._model_kwargs()
+
+        try:
+            model = self._create_model(model_repo, **kwargs)
+            loaded_model = LoadedModel(model_repo=model_repo, model=model, memory_usage=model.memory_usage(), last_used=time.time(), in_use=1)
+        finally:
+            with self._models_lock:
+                if loaded_model is not None:
+                    self._models[model_repo] = loaded_model
+
+                self._loading.discard(model_repo)
+                self._loading_cv.notify_all()
+
+        self._evict_models(keep=model_repo)
+        self._start_cleanup()
+
+        return loaded_model
+
+    def _release_model(self, loaded_model: LoadedModel):
+        with self._models_lock:
+            loaded_model.in_use -= 1
+            loaded_model.last_used = time.time()
+
+            if loaded_model.in_use > 0:
+                return
+
+        # models that were in use while another one was loaded might still be over the budget
+        self._evict_models(keep=loaded_model.model_repo)
+
+    @contextmanager
+    def _use(self, loaded_model: LoadedModel):
+        # the handle might have been unloaded while idle, in which case it's loaded back in
+        loaded_model = self._acquire_model(loaded_model.model_repo)
+
+        try:
+            yield loaded_model
+        finally:
+            self._release_model(loaded_model)
+
+    def unload_model(self, model_repo: str):
+        with self._models_lock:
+            loaded_model = self._models.get(model_repo)
+
+            if loaded_model is None or loaded_model.in_use > 0:
+                return
+
+            self._models.pop(model_repo)
+
+        self._free_model(loaded_model)
+
+    def _evict_models(self, keep: str):
+        max_bytes = self._configuration.model_cache_max_bytes
+        evicted_models: list[LoadedModel] = []
+
+        with self._models_lock:
+            # least recently used models are at the front
+            evictable = [m for m in self._models.values() if m.model_repo != keep and m.in_use == 0]
+
+            while len(evictable) > 0 and sum(m.memory_usage for m in self._models.values()) > max_bytes:
+                evicted_models.append(self._models.pop(evictable.pop(0).model_repo))
+
+        for loaded_model in evicted_models:
+            self._free_model(loaded_model)
+
+    def _free_model(self, loaded_model: LoadedModel):
+        print('* Unloading model:', loaded_model.model_repo)
+
+        loaded_model.model = None
+        gc.collect()
+
+        # torch keeps freed gpu memory cached unless told otherwise
+        if 'torch' in sys.modules:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _start_cleanup(self):
+        if self._configuration.model_idle_timeout <= 0 or self._cleanup_thread is not None:
+            return
+
+        self._cleanup_thread = Thread(name='Predictor._cleanup', target=self._cleanup, daemon=True)
+        self._cleanup_thread.start()
+
+    def _cleanup(self):
+        idle_timeout = self._configuration.model_idle_timeout
+
+        try:
+            while True:
+                with self._models_cv:
+                    self._models_cv.wait(timeout=min(60, idle_timeout))
+
+                self._cleanup_models()
+        except KeyboardInterrupt:
+            return
+
+    def _cleanup_models(self):
+        current_t = time.time()
+
+        with self._models_lock:
+            idle_models = [
+                m.model_repo for m in self._models.values() if current_t - m.last_used > self._configuration.model_idle_timeout
+            ]
+
+        for model_repo in idle_models:
+            self.unload_model(model_repo)
+
+
+    def predict(self, model: LoadedModel, image: Image) -> Prediction:
+        with self._use(model) as model:
+            return model.model.predict(image)
+
+    def predict_batch(self, model: LoadedModel, images: List[Image.Image]) -> List[Prediction]:
+        with self._use(model) as model:
+            max_batch_size = self.max_batch_size(model)
+            results = []
+
+            for i in range(0, len(images), max_batch_size):
+                results.extend(model.model.predict_batch(images[i:i+max_batch_size]))
+
+            return results
+
+    def prepare_image(self, model: LoadedModel, image: Image) -> object:
+        """Turns an image into the model's input, can be called from multiple threads at once."""
+        with self._use(model) as model:
+            return model.model.prepare_image(image)
+
+    def predict_prepared(self, model: LoadedModel, inputs: List[object]) -> List[Prediction]:
+        with self._use(model) as model:
+            max_batch_size = self.max_batch_size(model)
+            results = []
+
+            for i in range(0, len(inputs), max_batch_size):
+                results.extend(model.model.predict_prepared(inputs[i:i+max_batch_size]))
 
-    def predict(self, image: Image) -> Tuple[str, Dict[str, float], Dict[str, float], Dict[str, float]]:
-        assert self.model is not None, "No model loaded"
-        return self.model.predict(image)
+            return results
 
 default_repo = tagger_smilingwolf.EVA02_LARGE_MODEL_DSV3_REPO
 
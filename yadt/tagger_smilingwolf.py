@@ -1,3 +1,5 @@
+import os
+
 from typing import List
 import huggingface_hub
 import numpy as np
@@ -6,6 +8,8 @@ import pandas as pd
 
 from PIL import Image
 
+from yadt.tagger_prediction import Prediction, TagVocabulary
+
 MODEL_REPO_PREFIX = "SmilingWolf/"
 
 # SmilingWolf v3 series:
@@ -26,6 +30,68 @@ VIT_MODEL_DSV2_REPO = "SmilingWolf/wd-v1-4-vit-tagger-v2"
 MODEL_FILENAME = "model.onnx"
 LABEL_FILENAME = "selected_tags.csv"
 
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    "sequential": rt.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": rt.ExecutionMode.ORT_PARALLEL,
+}
+
+def session_providers(device: str) -> List:
+    available_providers = rt.get_available_providers()
+
+    device = device or 'cpu'
+    device_type, _, device_id = device.partition(':')
+    device_id = int(device_id) if device_id else 0
+
+    providers = []
+
+    # torch reports rocm devices as cuda as well
+    if device_type == 'cuda':
+        if 'CUDAExecutionProvider' in available_providers:
+            providers.append(('CUDAExecutionProvider', { 'device_id': device_id }))
+        elif 'ROCMExecutionProvider' in available_providers:
+            providers.append(('ROCMExecutionProvider', { 'device_id': device_id }))
+        else:
+            print(f'! No onnxruntime GPU provider available for {device}, falling back to cpu')
+    elif device_type != 'cpu':
+        print(f'! Device is not supported by onnxruntime: {device}, falling back to cpu')
+
+    providers.append('CPUExecutionProvider')
+    return providers
+
+def create_session(
+        model_path: str,
+        device: str = 'cpu',
+        graph_optimization_level: str = 'all',
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        execution_mode: str = 'sequential',
+        enable_mem_arena: bool = True,
+        enable_mem_pattern: bool = True,
+) -> rt.InferenceSession:
+    assert graph_optimization_level in GRAPH_OPTIMIZATION_LEVELS, f"Unsupported graph optimization level: {graph_optimization_level}"
+    assert execution_mode in EXECUTION_MODES, f"Unsupported execution mode: {execution_mode}"
+    assert intra_op_threads >= 0, "Intra-op thread count cannot be negative"
+    assert inter_op_threads >= 0, "Inter-op thread count cannot be negative"
+
+    options = rt.SessionOptions()
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+    options.execution_mode = EXECUTION_MODES[execution_mode]
+    options.enable_cpu_mem_arena = enable_mem_arena
+    options.enable_mem_pattern = enable_mem_pattern
+
+    # 0 keeps onnxruntime's defaults
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+
+    return rt.InferenceSession(model_path, sess_options=options, providers=session_providers(device))
+
 def load_labels(dataframe) -> List[str]:
     name_series = dataframe["name"]
     tag_names = name_series.tolist()
@@ -43,9 +109,12 @@ class Predictor:
     rating_indexes: List[str]
     general_indexes: List[str]
     character_indexes: List[str]
+    vocabulary: TagVocabulary
 
     def __init__(self):
         self.model_target_size = None
+        self.model_size = 0
+        self.max_batch_size = None
         self.model = None
 
     def download_model(self, model_repo):
@@ -69,13 +138,26 @@ class Predictor:
         self.rating_indexes = sep_tags[1]
         self.general_indexes = sep_tags[2]
         self.character_indexes = sep_tags[3]
+        self.vocabulary = TagVocabulary.shared(*sep_tags)
 
-        model = rt.InferenceSession(model_path)
-        _, height, width, _ = model.get_inputs()[0].shape
+        device = kwargs.pop('device', 'cpu')
+        session_options = kwargs.pop('session_options', None) or {}
+
+        model = create_session(model_path, device=device, **session_options)
+        batch_size, height, width, _ = model.get_inputs()[0].shape
+
+        # dynamic batch dimensions are exported as symbolic names (e.g. "batch_size")
+        if isinstance(batch_size, int):
+            self.max_batch_size = batch_size
 
         self.model_target_size = height
+        self.model_size = os.path.getsize(model_path)
         self.model = model
 
+    def memory_usage(self) -> int:
+        # onnxruntime doesn't expose its allocations, the weights are a good enough estimate
+        return self.model_size
+
     def prepare_image(self, image):
         target_size = self.model_target_size
 
@@ -113,26 +195,18 @@ class Predictor:
         return np.expand_dims(image_array, axis=0)
 
     def predict(self, image: Image):
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images: List[Image.Image]):
+        return self.predict_prepared([self.prepare_image(image) for image in images])
+
+    def predict_prepared(self, inputs: List[np.ndarray]):
         assert self.model is not None, "No model loaded"
 
-        image = self.prepare_image(image)
+        batch = np.concatenate(inputs)
 
         input_name = self.model.get_inputs()[0].name
         label_name = self.model.get_outputs()[0].name
-        preds = self.model.run([label_name], {input_name: image})[0]
-
-        labels = list(zip(self.tag_names, preds[0].astype(float)))
-
-        # First 4 labels are actually ratings: pick one with argmax
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        rating = dict(ratings_names)
-
-        # Then we have general tags: pick any where prediction confidence > threshold
-        general_names = [labels[i] for i in self.general_indexes]
-        general_res = dict(general_names)
-
-        # Everything else is characters: pick any where prediction confidence > threshold
-        character_names = [labels[i] for i in self.character_indexes]
-        character_res = dict(character_names)
+        preds = self.model.run([label_name], {input_name: batch})[0]
 
-        return rating, general_res, character_res
+        return [Prediction(self.vocabulary, pred) for pred in preds]
@@ -0,0 +1,13 @@
+from yadt.benchmark import benchmarks, compare, measure, to_json
+
+def test_benchmarks(tmp_path):
+    # making sure the benchmarks still run, on small enough data to be quick
+    with benchmarks(tmp_path, [500]) as all_benchmarks:
+        results = to_json([measure(benchmark, repeat=1, min_seconds=0) for benchmark in all_benchmarks])
+
+    assert len(results['benchmarks']) > 0
+    assert all(result['seconds'] > 0 for result in results['benchmarks'].values())
+
+    comparison = compare(results, results)
+    assert len(comparison) == len(results['benchmarks'])
+    assert not any(regressed for _, _, _, regressed in comparison)
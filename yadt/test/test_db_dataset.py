@@ -0,0 +1,130 @@
+import pytest
+import asyncio
+import sqlite3
+
+from yadt.configuration import Configuration
+from yadt.db_dataset import AsyncDatasetDB, DatasetDB
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatasetDB(Configuration(
+        device='cpu',
+        cache_folder=tmp_path,
+        score_slider_step=0.05,
+        score_general_threshold=0.35,
+        score_character_threshold=0.9,
+        batch_size=1,
+    ))
+
+    yield db
+    db.close()
+
+def test_async_dataset_db(db: DatasetDB):
+    async_db = AsyncDatasetDB(db)
+
+    async def run():
+        await async_db.set_dataset_settings('dataset', { 'model_repo': 'repo', 'general_thresh': '0.5' })
+        await async_db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'dataset', bytes([i])) for i in range(10) ])
+
+        return await asyncio.gather(
+            async_db.get_dataset_settings('dataset'),
+            async_db.get_dataset_settings('other'),
+            async_db.get_dataset_cache_many([ bytes([i]) * 32 for i in range(0, 20, 2) ], 'repo'),
+        )
+
+    settings, other_settings, cache = asyncio.run(run())
+
+    assert settings == { 'model_repo': 'repo', 'general_thresh': '0.5' }
+    assert other_settings == {}
+    assert cache == { bytes([i]) * 32: bytes([i]) for i in range(0, 10, 2) }
+    assert db.get_dataset_setting('dataset', 'model_repo') == 'repo'
+
+def test_dataset_cache_usage(db: DatasetDB):
+    def usage():
+        with db._conn() as conn:
+            by_repo = conn.execute('select repo_name, count(*), sum(length(data)) from dataset_cache group by repo_name').fetchall()
+            by_dataset = conn.execute('select d.dataset, count(*), sum(length(c.data)) from dataset_cache c left join dataset_cache_stats s on c.id = s.hash_id left join dataset_stats d on d.id = s.dataset_id group by d.dataset').fetchall()
+
+        assert sorted((row['repo_name'], row['rows'], row['bytes']) for row in db.get_dataset_cache_usage_for_repo_name()) == sorted(by_repo)
+        assert sorted((row['dataset'] or '', row['rows'], row['bytes']) for row in db.get_dataset_cache_usage_for_dataset()) == sorted((row[0] or '', row[1], row[2]) for row in by_dataset)
+
+        return sorted(by_repo)
+
+    db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'a', bytes([i]) * i) for i in range(10) ])
+    db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'b', bytes([i]) * 2 * i) for i in range(5, 15) ])
+    db.set_dataset_cache_many([ (bytes([i]) * 32, 'other', 'b', bytes([i]) * 3) for i in range(5) ])
+    assert usage() == [ ('other', 5, 15), ('repo', 15, sum(range(5)) + 2 * sum(range(5, 15))) ]
+
+    db.delete_dataset_cache_by_dataset('a')
+    assert usage() == [ ('other', 5, 15), ('repo', 10, 2 * sum(range(5, 15))) ]
+
+    db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'c', bytes([i])) for i in range(10, 20) ])
+    db.delete_dataset_cache_by_repo_name('other')
+    db.delete_dataset_cache_by_dataset('b')
+    assert usage() == [ ('repo', 10, 10) ]
+
+    db.delete_dataset_cache_by_dataset('c')
+    assert usage() == []
+    assert db.get_dataset_cache_for_repo_name() == []
+
+def test_dataset_cache_eviction(db: DatasetDB, tmp_path):
+    for i in range(10):
+        db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'dataset', bytes(100)) ])
+
+    db.set_dataset_edit('dataset', bytes([1]) * 32, '', 'edit')
+
+    # a file which was hashed but never cached, and one whose cached prediction is evicted
+    (tmp_path / 'hashed.png').touch()
+    (tmp_path / 'evicted.png').touch()
+
+    db.set_file_hash(str(tmp_path / 'hashed.png'), 0, 0, 0, bytes([20]) * 32)
+    db.set_file_hash(str(tmp_path / 'evicted.png'), 0, 0, 0, bytes([5]) * 32)
+
+    # recently read ones are kept
+    assert len(db.get_dataset_cache_many([ bytes([i]) * 32 for i in range(3) ], 'repo')) == 3
+
+    with sqlite3.connect(db.path) as conn:
+        conn.execute('update dataset_cache set last_access = last_access - 10')
+
+    db.flush_dataset_cache_access()
+
+    assert db.evict_dataset_cache(1000) == (0, 0)
+    assert db.evict_dataset_cache(500) == (6, 600)
+
+    cache = db.get_dataset_cache_many([ bytes([i]) * 32 for i in range(10) ], 'repo')
+    assert sorted(cache) == [ bytes([i]) * 32 for i in range(3) ] + [ bytes([9]) * 32 ]
+    assert db.get_dataset_cache_usage_for_repo_name() == [ { 'repo_name': 'repo', 'bytes': 400, 'rows': 4 } ]
+
+    with db._conn() as conn:
+        assert conn.execute('select path from dataset_file_stat').fetchall() == [ (str(tmp_path / 'hashed.png'),) ]
+
+    # unused file hashes go along, but not the one of the manual edit
+    assert db.evict_dataset_cache(0) == (4, 400)
+    assert db.get_dataset_edits('dataset') == { bytes([1]) * 32: ('', 'edit') }
+
+    with db._conn() as conn:
+        assert conn.execute('select hash from dataset_file_hash').fetchall() == [ (bytes([1]) * 32,) ]
+
+def test_dataset_cache_eviction_vocabularies(db: DatasetDB):
+    from yadt import ui_dataset
+    from yadt.db_dataset import DATASET_CACHE_HEADER_SIZE, DATASET_CACHE_MAGIC
+
+    assert ui_dataset.CACHE_HEADER.size == DATASET_CACHE_HEADER_SIZE
+
+    header = DATASET_CACHE_MAGIC + bytes(DATASET_CACHE_HEADER_SIZE - len(DATASET_CACHE_MAGIC))
+
+    with sqlite3.connect(db.path) as conn:
+        conn.executemany('insert into dataset_vocabulary (digest, data) values (?, ?)', [ (bytes([i]) * 32, b'') for i in range(3) ])
+        conn.execute('insert into dataset_file_stat (path, size, mtime_ns, inode, hash) values (?, 0, 0, 0, ?)', ('unused', bytes([9]) * 32))
+
+    db.set_dataset_cache_many([ (bytes([i]) * 32, 'repo', 'dataset', header + bytes([i]) * 32) for i in range(2) ])
+    db.set_file_hash('used', 0, 0, 0, bytes([0]) * 32)
+    db.set_dataset_vocabulary(bytes([3]) * 32, b'')
+
+    assert db.evict_dataset_cache(32 * 2 + 2 * len(header)) == (0, 0)
+    assert db.evict_dataset_cache(50) == (1, 32 + len(header))
+
+    # vocabularies which were just written might still be waiting for their cached predictions
+    with db._conn() as conn:
+        assert conn.execute('select digest from dataset_vocabulary order by digest').fetchall() == [ (bytes([1]) * 32,), (bytes([3]) * 32,) ]
+        assert conn.execute('select path from dataset_file_stat').fetchall() == []
@@ -0,0 +1,220 @@
+import pytest
+
+from yadt.db_pool import Sqlite3DBPool
+
+def test_pool_profile(tmp_path):
+    pool = Sqlite3DBPool(tmp_path / 'test.db', profile='wal', busy_timeout='10000', foreign_keys='on')
+    pool.open()
+
+    try:
+        with pool.connection() as conn:
+            assert conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('pragma synchronous').fetchone()[0] == 1
+            assert conn.execute('pragma foreign_keys').fetchone()[0] == 1
+            assert conn.execute('pragma busy_timeout').fetchone()[0] == 10000
+    finally:
+        pool.close()
+
+def test_pool_fifo(tmp_path):
+    import time
+    import threading
+
+    pool = Sqlite3DBPool(tmp_path / 'test.db', max_connections=1)
+    pool.open()
+
+    order = []
+
+    def checkout(i: int):
+        with pool.connection():
+            order.append(i)
+
+    try:
+        with pool.connection():
+            threads = []
+
+            # every thread waits in line before the next one starts
+            for i in range(5):
+                threads.append(threading.Thread(target=checkout, args=(i,)))
+                threads[-1].start()
+
+                while pool.metrics().waiting < i + 1:
+                    time.sleep(0.001)
+
+            with pytest.raises(TimeoutError):
+                with pool.connection(timeout=0.01):
+                    pass
+
+        for thread in threads:
+            thread.join()
+
+        assert order == list(range(5))
+
+        metrics = pool.metrics()
+        assert (metrics.in_use, metrics.idle, metrics.waiting, metrics.opens, metrics.checkouts) == (0, 1, 0, 1, 6)
+        assert sum(checkouts for _, checkouts in metrics.wait_histogram) == 6
+    finally:
+        pool.close()
+
+def test_pool_health_check(tmp_path):
+    pool = Sqlite3DBPool(tmp_path / 'test.db')
+    pool.open()
+
+    try:
+        with pool.connection() as conn:
+            conn.execute('create table test (id integer primary key)')
+
+        # connections are given back in the middle of a transaction when an error comes up, which is undone
+        with pytest.raises(ZeroDivisionError):
+            with pool.connection() as conn:
+                conn.execute('insert into test (id) values (1)')
+                1 / 0
+
+        pool._idle[-1].connection.close()
+
+        # the closed connection is replaced before it's handed out again
+        with pool.connection() as conn:
+            assert conn.execute('select count(*) from test').fetchone()[0] == 0
+
+        metrics = pool.metrics()
+        assert (metrics.failed_health_checks, metrics.opens, metrics.closes) == (1, 2, 1)
+    finally:
+        pool.close()
+
+    metrics = pool.metrics()
+    assert (metrics.in_use, metrics.idle, metrics.opens, metrics.closes) == (0, 0, 2, 2)
+
+def test_pool_close_in_use(tmp_path):
+    import sqlite3
+
+    pool = Sqlite3DBPool(tmp_path / 'test.db')
+    pool.open()
+
+    with pool.connection() as conn:
+        pool.close(timeout=0)
+        pool.open()
+
+        conn.execute('select 1')
+
+    # connections opened before the pool was closed aren't used again
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('select 1')
+
+    pool.close()
+
+@pytest.mark.parametrize(
+    [
+        'database',
+        'pragmas',
+    ],
+    [
+        [ 'test.db', { 'journal_model': 'wal' } ],
+        [ ':memory:', { 'journal_mode': 'wal' } ],
+    ],
+    ids=[
+        'unknown pragma',
+        'not applied',
+    ]
+)
+def test_pool_pragmas_verified(tmp_path, database: str, pragmas: dict[str, str]):
+    pool = Sqlite3DBPool(database if database == ':memory:' else tmp_path / database, default_timeout=1, **pragmas)
+    pool.open()
+
+    try:
+        with pytest.raises(AssertionError):
+            with pool.connection():
+                pass
+
+        # the failed connection doesn't take up a slot of the pool
+        with pytest.raises(AssertionError):
+            with pool.connection():
+                pass
+    finally:
+        pool.close()
+
+def test_writer(tmp_path):
+    import sqlite3
+
+    from concurrent.futures import ThreadPoolExecutor
+    from yadt.db_pool import Sqlite3DBWriter
+
+    writer = Sqlite3DBWriter(tmp_path / 'test.db', profile='wal')
+    writer.open()
+
+    try:
+        writer.write(lambda cursor: cursor.execute('create table test (id integer primary key, value text not null)'))
+
+        def insert(i: int):
+            def write(cursor: sqlite3.Cursor):
+                cursor.execute('insert into test (id, value) values (?, ?)', (i, str(i)))
+
+                # a failing write only undoes its own changes, not those of the writes grouped with it
+                if i % 10 == 0:
+                    cursor.execute('insert into test (id, value) values (?, null)', (i + 1000,))
+
+                return i
+
+            return writer.write(write)
+
+        failures = 0
+        with ThreadPoolExecutor(8) as executor:
+            for future in [executor.submit(insert, i) for i in range(100)]:
+                try:
+                    future.result()
+                except sqlite3.IntegrityError:
+                    failures += 1
+
+        assert failures == 10
+
+        # writes that can't be part of a transaction run on their own
+        writer.write(lambda cursor: cursor.execute('vacuum'), transaction=False)
+
+        rows = writer.write(lambda cursor: cursor.execute('select id from test order by id').fetchall())
+        assert [row[0] for row in rows] == [i for i in range(100) if i % 10 != 0]
+    finally:
+        writer.close()
+
+    with pytest.raises(AssertionError):
+        writer.write(lambda cursor: None)
+
+def test_writer_lost_transaction(tmp_path):
+    import sqlite3
+    import threading
+
+    from yadt.db_pool import Sqlite3DBWriter
+
+    writer = Sqlite3DBWriter(tmp_path / 'test.db', max_batch_size=8)
+    writer.open()
+
+    try:
+        writer.write(lambda cursor: cursor.execute('create table test (id integer primary key)'))
+
+        # the writes are queued up behind this one, so they all end up in the same transaction
+        blocked = threading.Event()
+        blocking = writer.submit(lambda cursor: blocked.wait())
+
+        def insert(i: int):
+            def write(cursor: sqlite3.Cursor):
+                cursor.execute('insert into test (id) values (?)', (i,))
+
+                # taking the whole transaction down with it, like a full disk would
+                if i == 2:
+                    cursor.execute('rollback')
+                    raise ValueError(i)
+
+                return i
+
+            return write
+
+        futures = [writer.submit(insert(i)) for i in range(5)]
+        blocked.set()
+        blocking.result()
+
+        with pytest.raises(ValueError):
+            futures[2].result()
+
+        assert [future.result() for i, future in enumerate(futures) if i != 2] == [0, 1, 3, 4]
+
+        rows = writer.write(lambda cursor: cursor.execute('select id from test order by id').fetchall())
+        assert [row[0] for row in rows] == [0, 1, 3, 4]
+    finally:
+        writer.close()
@@ -50,6 +50,24 @@ import pytest
             'TAG_1, BREAK, TAG_2, TAG_3, TAG_4, TAG_5',
             'TAG_1, BREAK, TAG_2, TAG_4, TAG_5',
         ],
+        [
+            'long hair, smile',
+            'long hairs, smile',
+            'very long hair, smile',
+            'very long hair, long hairs, smile',
+        ],
+        [
+            'a, b, c',
+            'a, b, c',
+            'a, c',
+            'a, b, c',
+        ],
+        [
+            'TAG_1, BREAK',
+            'TAG_0, TAG_1, BREAK',
+            '',
+            'TAG_0, TAG_1, BREAK',
+        ],
     ],
     ids=[
         'add new tag',
@@ -58,7 +76,10 @@ import pytest
         'move tag',
         'insert tag',
         'append tags',
-        'remove and append tags'
+        'remove and append tags',
+        'similar tags',
+        'keep unedited tag',
+        'no predictions',
     ]
 )
 def test_post_process_manual_edits(
@@ -71,3 +92,360 @@ def test_post_process_manual_edits(
 
     results = post_process_manual_edits(initial_tags, edited_tags, new_tags)
     assert results == wanted_tags
+
+def _post_process_manual_edits_reference(
+        initial_tags: str,
+        edited_tags: str,
+        new_tags: str,
+        whitelist: list[str] = None,
+):
+    # the difflib based implementation post_process_manual_edits has to keep matching
+    import difflib
+
+    def merge_diffs(initial, new):
+        i_initial = 0
+        l_initial = len(initial)
+        i_new = 0
+        l_new = len(new)
+
+        merged = []
+
+        while i_initial < l_initial and i_new < l_new:
+            c_initial = initial[i_initial]
+            c_new = new[i_new]
+
+            op_initial, tag_initial = c_initial[:2], c_initial[2:]
+            op_new, tag_new = c_new[:2], c_new[2:]
+
+            tags_equal = tag_initial == tag_new
+
+            match (tags_equal, op_initial, op_new):
+                case (True, _, _):
+                    merged.append(c_initial)
+                    i_initial += 1
+                    i_new += 1
+                case (False, '  ', _):
+                    merged.append(c_new)
+                    i_new += 1
+                case (False, _, '  '):
+                    merged.append(c_initial)
+                    i_initial += 1
+                case (False, '+ ', '+ '):
+                    merged.append(c_new)
+                    i_new += 1
+                case (False, '+ ', '- '):
+                    merged.append(c_new)
+                    merged.append(c_initial)
+                    i_initial += 1
+                    i_new += 1
+                case (False, '- ', '+ '):
+                    merged.append(c_new)
+                    merged.append(c_initial)
+                    i_initial += 1
+                    i_new += 1
+                case (False, '- ', '- '):
+                    merged.append(c_initial)
+                    merged.append(c_new)
+                    i_initial += 1
+                    i_new += 1
+
+        for i in range(i_initial, l_initial):
+            merged.append(initial[i])
+
+        for i in range(i_new, l_new):
+            merged.append(new[i])
+
+        return merged
+
+    initial_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in initial_tags.split(',')]))
+    edited_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in edited_tags.split(',')]))
+    new_tags = list(filter(lambda tag: len(tag) > 0, [tag.strip() for tag in new_tags.split(',')]))
+
+    diff_initial = list(difflib.ndiff(initial_tags, edited_tags))
+    diff_new = list(difflib.ndiff(initial_tags, new_tags))
+
+    if whitelist is not None:
+        diff_new_with_whitelist = []
+
+        for diff in diff_new:
+            diff_type = diff[:2]
+            tag = diff[2:]
+            tag_in_whitelist = tag in whitelist
+
+            match (diff_type, tag_in_whitelist):
+                case ('  ', _):
+                    diff_new_with_whitelist.append(diff)
+                case ('- ', False):
+                    diff_new_with_whitelist.append(diff)
+                case ('- ', True):
+                    diff_new_with_whitelist.append('  ' + tag)
+                case ('+ ', False):
+                    pass
+                case ('+ ', True):
+                    diff_new_with_whitelist.append(diff)
+
+        diff_new = diff_new_with_whitelist
+
+    diff_after = merge_diffs(diff_initial, diff_new)
+
+    return ', '.join(difflib.restore(diff_after, 2))
+
+def test_post_process_manual_edits_reference():
+    import random
+
+    from yadt.process_prediction import post_process_manual_edits
+
+    # none of these are similar enough for ndiff to pair them up, which the reference can't merge
+    tags = [
+        '1girl', 'solo', 'smile', 'long hair', 'blue eyes', 'open mouth', 'shirt', 'dress', 'looking at viewer', 'BREAK',
+        'white background', 'holding', 'outdoors', 'sky', 'tree', 'hat', 'red eyes', 'jacket', 'closed eyes', 'bow', 'flower', 'day',
+    ]
+
+    rng = random.Random(16)
+
+    def _edit(caption: list[str]):
+        caption = list(caption)
+
+        for _ in range(rng.randint(0, 5)):
+            match rng.randint(0, 2):
+                case 0 if len(caption) > 0:
+                    caption.pop(rng.randrange(len(caption)))
+                case 1:
+                    caption.insert(rng.randint(0, len(caption)), rng.choice(tags))
+                case 2 if len(caption) > 1:
+                    i, j = rng.sample(range(len(caption)), 2)
+                    caption[i], caption[j] = caption[j], caption[i]
+
+        return caption
+
+    for _ in range(2000):
+        initial_tags = rng.sample(tags, rng.randint(0, 12))
+        edited_tags = _edit(initial_tags)
+        new_tags = _edit(initial_tags)
+        whitelist = rng.choice([None, rng.sample(tags, 8)])
+
+        args = (', '.join(initial_tags), ', '.join(edited_tags), ', '.join(new_tags))
+
+        assert post_process_manual_edits(*args, whitelist=whitelist) == _post_process_manual_edits_reference(*args, whitelist=whitelist), args
+
+
+def test_post_process_prediction():
+    from yadt.process_prediction import post_process_prediction
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    vocabulary = TagVocabulary(
+        ['rating_general', 'rating_explicit', 'long_hair', 'hair', 'blue_eyes', '^_^', 'some_character'],
+        [0, 1],
+        [2, 3, 4, 5],
+        [6],
+    )
+    prediction = Prediction(vocabulary, [0.9, 0.1, 0.8, 0.7, 0.2, 0.6, 0.95])
+
+    tag_string, rating, general_res, character_res = post_process_prediction(
+        prediction,
+        0.35, False, 0.9, False,
+        True, True, False,
+    )
+
+    assert tag_string == 'some character, long hair, ^_^'
+    assert rating == pytest.approx({ 'general': 0.9, 'explicit': 0.1 })
+    assert general_res == pytest.approx({ 'long hair': 0.8, '^_^': 0.6 })
+    assert character_res == pytest.approx({ 'some character': 0.95 })
+
+def test_post_processor():
+    from yadt.process_prediction import PostProcessor
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    vocabulary = TagVocabulary(
+        ['rating_general', 'long_hair', 'blue_eyes', 'smile', 'some_character'],
+        [0],
+        [1, 2, 3],
+        [4],
+    )
+
+    post_processor = PostProcessor(
+        0.35, False, 0.9, False,
+        True, False, False,
+        prefix_tags='solo', keep_tags='smile', ban_tags='blue eyes', map_tags='long hair&-smile : hair',
+    )
+
+    tag_string, _, general_res, _ = post_processor.process(Prediction(vocabulary, [1.0, 0.8, 0.7, 0.1, 0.2]))
+    assert tag_string == 'solo, BREAK, hair'
+    assert general_res == {}
+
+    tag_string, _, general_res, _ = post_processor.process(Prediction(vocabulary, [1.0, 0.8, 0.7, 0.6, 0.95]))
+    assert tag_string == 'solo, smile, BREAK, some character, long hair'
+    assert general_res == pytest.approx({ 'long hair': 0.8, 'smile': 0.6 })
+
+    with pytest.raises(AssertionError):
+        PostProcessor(0.35, False, 0.9, False, True, False, False, map_tags='-smile : hair')
+
+@pytest.mark.parametrize(
+    [
+        'map_tags',
+        'wanted_tags',
+    ],
+    [
+        [ 'long hair : hair', 'hair, smile' ],
+        [ 'long hair : hair\nhair&smile : happy', 'happy' ],
+        [ 'hair&smile : happy\nlong hair : hair', 'happy' ],
+        [ 'long hair&-smile : hair', 'long hair, smile' ],
+        [ 'long hair : long hair, hair', 'long hair, hair, smile' ],
+        [ 'long hair : smile', 'smile' ],
+    ],
+    ids=[
+        'map tag',
+        'map chain',
+        'map chain out of order',
+        'negative condition',
+        'keep mapped tag',
+        'merge into existing tag',
+    ],
+)
+def test_post_processor_map_tags(
+        map_tags: str,
+        wanted_tags: str,
+):
+    from yadt.process_prediction import PostProcessor
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    vocabulary = TagVocabulary(['rating_general', 'long_hair', 'smile'], [0], [1, 2], [])
+    post_processor = PostProcessor(0.35, False, 0.9, False, True, False, False, map_tags=map_tags)
+
+    tag_string, _, _, _ = post_processor.process(Prediction(vocabulary, [0.9, 0.5, 0.4]))
+    assert tag_string == wanted_tags
+
+def test_post_processor_map_tags_cycle():
+    from yadt.process_prediction import PostProcessor
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    with pytest.raises(AssertionError, match="cycle: 'long hair : hair' -> 'hair : long hair'"):
+        PostProcessor(0.35, False, 0.9, False, True, False, False, map_tags='long hair : hair\nhair : long hair')
+
+    with pytest.raises(AssertionError, match='cycle'):
+        PostProcessor(0.35, False, 0.9, False, True, False, False, map_tags='long hair : hair\nhair&-long hair : long hair')
+
+    # rules keeping a tag they map from aren't cycles
+    vocabulary = TagVocabulary(['rating_general', 'long_hair', 'smile'], [0], [1, 2], [])
+    post_processor = PostProcessor(0.35, False, 0.9, False, True, False, False, map_tags='long hair : long hair, hair\nhair : hairstyle')
+
+    tag_string, _, _, _ = post_processor.process(Prediction(vocabulary, [0.9, 0.5, 0.4]))
+    assert tag_string == 'long hair, hairstyle, smile'
+
+@pytest.mark.parametrize(
+    [
+        'tags',
+        'wanted_tags',
+    ],
+    [
+        [ ['long hair', 'hair', 'smile'], ['long hair', 'smile'] ],
+        [ ['hair', 'long hair', 'very long hair'], ['very long hair'] ],
+        [ ['hairs', 'long hair'], ['hairs', 'long hair'] ],
+        [ ['open mouth', 'mouth', 'open'], ['open mouth'] ],
+        [ ['a b c', 'b c', 'a c'], ['a b c', 'a c'] ],
+        [ ['long  hair', 'long hair', 'smile'], ['long  hair', 'smile'] ],
+    ],
+    ids=[
+        'suffix',
+        'chain',
+        'partial word',
+        'prefix and suffix',
+        'not contiguous',
+        'same words',
+    ],
+)
+def test_post_processor_trim_general_tag_dupes(
+        tags: list[str],
+        wanted_tags: list[str],
+):
+    from yadt.process_prediction import PostProcessor
+
+    post_processor = PostProcessor(0.35, False, 0.9, False, False, True, False)
+
+    trimmed = post_processor._trim_general_tag_dupes([ (tag, 0.5) for tag in tags ])
+    assert [ tag for tag, _ in trimmed ] == wanted_tags
+
+@pytest.mark.parametrize('mcut_enabled', [False, True], ids=['threshold', 'mcut'])
+def test_post_processor_batch(mcut_enabled: bool):
+    import numpy as np
+
+    from yadt.process_prediction import PostProcessor, mcut_threshold, mcut_thresholds
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    names = ['rating_general', 'rating_explicit'] + [f'tag_{i}' for i in range(40)] + [f'character_{i}' for i in range(10)]
+    vocabulary = TagVocabulary(names, [0, 1], list(range(2, 42)), list(range(42, 52)))
+    scores = np.random.default_rng(0).random((20, len(names)), dtype=np.float32)
+
+    assert mcut_thresholds(scores).tolist() == [ mcut_threshold(row) for row in scores ]
+
+    post_processor = PostProcessor(0.35, mcut_enabled, 0.85, mcut_enabled, True, True, False, keep_tags='tag 3')
+
+    assert post_processor.process_batch(scores, vocabulary) == [ post_processor.process(Prediction(vocabulary, row)) for row in scores ]
+
+def test_post_processor_threshold_table(tmp_path):
+    import json
+
+    from yadt.process_prediction import PostProcessor, load_threshold_table
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    path = tmp_path / 'thresholds.json'
+    path.write_text(json.dumps({ 'categories': { 'character': 0.5 }, 'tags': { 'long_hair': 0.6, 'open mouth': 0.2 } }))
+
+    vocabulary = TagVocabulary(['rating_general', 'long_hair', 'smile', 'open_mouth', 'character_a'], [0], [1, 2, 3], [4])
+    post_processor = PostProcessor(0.35, False, 0.9, False, True, False, False, threshold_table=load_threshold_table(path))
+
+    _, _, general_res, character_res = post_processor.process(Prediction(vocabulary, [0.9, 0.5, 0.4, 0.3, 0.7]))
+    assert list(general_res.keys()) == ['smile', 'open mouth']
+    assert list(character_res.keys()) == ['character a']
+
+@pytest.mark.parametrize(
+    [
+        'general_thresh',
+        'top_k',
+        'wanted_tags',
+    ],
+    [
+        [ 0.0, 2, ['long hair', 'open mouth'] ],
+        [ 0.7, 2, ['long hair'] ],
+        [ 0.0, 10, ['long hair', 'open mouth', 'smile'] ],
+    ],
+    ids=[
+        'top k',
+        'threshold first',
+        'more than tags',
+    ],
+)
+def test_post_processor_top_k(
+        general_thresh: float,
+        top_k: int,
+        wanted_tags: list[str],
+):
+    from yadt.process_prediction import PostProcessor
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    vocabulary = TagVocabulary(['rating_general', 'long_hair', 'smile', 'open_mouth'], [0], [1, 2, 3], [])
+    post_processor = PostProcessor(general_thresh, False, 0.9, False, True, False, False, general_top_k=top_k)
+
+    _, _, general_res, _ = post_processor.process(Prediction(vocabulary, [0.9, 0.8, 0.3, 0.6]))
+    assert list(general_res.keys()) == wanted_tags
+
+def test_post_process_cache():
+    from yadt.process_prediction import PostProcessor, PostProcessCache
+
+    assert PostProcessor(0.35, False, 0.9, False, True, False, False).fingerprint == PostProcessor(0.35, False, 0.9, False, True, False, False).fingerprint
+    assert PostProcessor(0.35, False, 0.9, False, True, False, False).fingerprint != PostProcessor(0.4, False, 0.9, False, True, False, False).fingerprint
+    assert PostProcessor(0.35, False, 0.9, False, True, False, False).fingerprint != PostProcessor(0.35, False, 0.9, False, True, False, False, general_top_k=3).fingerprint
+
+    cache = PostProcessCache(2)
+    cache.set('a', (1,))
+    cache.set('b', (2,))
+    assert cache.get('a') == (1,)
+
+    cache.set('c', (3,))
+    assert cache.get('b') is None
+    assert cache.get('a') == (1,) and cache.get('c') == (3,)
+    assert (cache.hits, cache.misses, len(cache)) == (3, 1, 2)
+
+    cache = PostProcessCache(0)
+    cache.set('a', (1,))
+    assert cache.get('a') is None and len(cache) == 0
@@ -0,0 +1,83 @@
+import pytest
+
+@pytest.mark.parametrize('dtype', ['float16', 'float32'])
+def test_threshold_sweep(dtype: str):
+    import numpy as np
+
+    from yadt.process_prediction import PostProcessor
+    from yadt.process_sweep import ThresholdSweep
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    names = ['rating_general'] + [f'tag_{i}' for i in range(30)] + [f'character_{i}' for i in range(5)]
+    vocabulary = TagVocabulary(names, [0], list(range(1, 31)), list(range(31, 36)))
+
+    # scores right on the bin edges would depend on rounding, which isn't what's tested here
+    scores = (np.random.default_rng(0).integers(0, 100, (300, len(names))) + 0.5) / 100
+    scores = scores.astype(dtype)
+
+    threshold_sweep = ThresholdSweep(PostProcessor(0.35, False, 0.9, False, False, False, False))
+    for row in scores:
+        threshold_sweep.add(Prediction(vocabulary, row))
+
+    general = scores[:, vocabulary.general_indexes].astype(np.float64)
+
+    before = threshold_sweep.stats('general', 0.35)
+    after = threshold_sweep.stats('general', 0.5)
+
+    assert after.images == 300
+    assert after.tags == (general >= 0.5).sum()
+    assert after.tag_counts.tolist() == (general >= 0.5).sum(axis=0).tolist()
+    assert after.images_without_tags == (general < 0.5).all(axis=1).sum()
+    assert after.images_changed == ((general >= 0.35) & (general < 0.5)).any(axis=1).sum()
+
+    changed_tags = threshold_sweep.changed_tags('general', before, after, 3)
+    assert len(changed_tags) == 3
+    assert all(count < 0 for count in changed_tags.values())
+
+@pytest.mark.parametrize('top_k', [None, 4])
+def test_threshold_sweep_post_processor(top_k: int):
+    import numpy as np
+
+    from yadt.process_prediction import PostProcessor, ThresholdTable
+    from yadt.process_sweep import ThresholdSweep
+    from yadt.tagger_prediction import Prediction, TagVocabulary
+
+    names = ['rating_general'] + [f'tag_{i}' for i in range(30)] + [f'character_{i}' for i in range(5)]
+    vocabulary = TagVocabulary(names, [0], list(range(1, 31)), list(range(31, 36)))
+
+    scores = ((np.random.default_rng(1).integers(0, 100, (300, len(names))) + 0.5) / 100).astype('float16')
+    threshold_table = ThresholdTable(categories={ 'character': 0.6 }, tags={ 'tag_0': 0.2, 'tag_1': 0.95 })
+
+    def _post_processor(general_thresh: float):
+        return PostProcessor(general_thresh, False, 0.9, False, False, False, False, threshold_table=threshold_table, general_top_k=top_k, character_top_k=top_k)
+
+    threshold_sweep = ThresholdSweep(_post_processor(0.35))
+    for row in scores:
+        threshold_sweep.add(Prediction(vocabulary, row))
+
+    # the counts match the tags the post processor picks, at the thresholds submitted with and any other
+    for category, thresholds in (('general', (0.35, 0.5, 0.8)), ('character', (0.9, 0.3))):
+        for threshold in thresholds:
+            results = _post_processor(threshold if category == 'general' else 0.35).process_batch(scores, vocabulary)
+            picked = [general_res if category == 'general' else character_res for _, _, general_res, character_res in results]
+
+            stats = threshold_sweep.stats(category, threshold)
+            wanted_counts = [sum(name in tags for tags in picked) for name in vocabulary.names[vocabulary.indexes(category)]]
+
+            assert stats.tag_counts.tolist() == wanted_counts
+            assert stats.tags == sum(map(len, picked))
+            assert stats.images_without_tags == sum(len(tags) == 0 for tags in picked)
+
+def test_threshold_sweep_mixed_vocabularies():
+    from yadt.process_prediction import PostProcessor
+    from yadt.process_sweep import ThresholdSweep
+    from yadt.tagger_prediction import Prediction
+
+    threshold_sweep = ThresholdSweep(PostProcessor(0.35, False, 0.9, False, False, False, False))
+    threshold_sweep.add(Prediction.from_dicts({ 'general': 0.9 }, { 'tag_a': 0.5 }, {}))
+    threshold_sweep.add(Prediction.from_dicts({ 'general': 0.9 }, { 'tag_b': 0.5 }, {}))
+
+    assert not threshold_sweep.supported
+
+    with pytest.raises(AssertionError):
+        threshold_sweep.stats('general', 0.5)
@@ -2,33 +2,80 @@ import os
 import gradio as gr
 
 import zlib
+import struct
 import pickle
 import hashlib
 import pathlib
 import duckdb
 import functools
 import huggingface_hub
+import numpy as np
+
+import threading
+
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
 
 from injector import inject, singleton
 
 from PIL import Image
 
-from yadt.db_dataset import DatasetDB
+from yadt.db_dataset import AsyncDatasetDB, DatasetDB, DATASET_CACHE_MAGIC, DATASET_CACHE_VOCABULARY_DIGEST_SIZE
 from yadt.configuration import Configuration
-from yadt.tagger_shared import Predictor
+from yadt.tagger_shared import LoadedModel, Predictor
+from yadt.tagger_prediction import Prediction, TagVocabulary
 
 from yadt import tagger_shared
 from yadt import process_prediction
+from yadt import process_sweep
 from yadt import ui_utils
 
+# cached predictions start with a header, followed by either the digest of a vocabulary stored in the
+# dataset_vocabulary table or the vocabulary itself, and end with the scores as little endian float16
+CACHE_MAGIC = DATASET_CACHE_MAGIC
+CACHE_FORMAT_VERSION = 1
+CACHE_HEADER = struct.Struct('<4sBBxxI')
+CACHE_FLAG_INLINE_VOCABULARY = 1
+
+# vocabularies that change with every prediction (e.g. florence) are stored inline when small enough
+CACHE_INLINE_VOCABULARY_MAX_TAGS = 256
+
+# new predictions are written to the cache in batches, rather than one transaction per file
+CACHE_WRITE_BATCH_SIZE = 64
+
+# cached predictions are post processed this many at a time
+CACHE_POST_PROCESS_BATCH_SIZE = 256
+
+# tag statistics are kept in memory for this many of the most recently processed datasets
+THRESHOLD_SWEEPS_MAX = 4
+
+# number of tags listed as gained or lost in the threshold preview
+THRESHOLD_PREVIEW_TAGS = 5
+
+@dataclass
+class DatasetFile:
+    index: int
+    image_path: str
+    file_hash: bytes
+    image: Image.Image
+    prediction: Prediction = None
+    model_input: object = None
+    cache_outdated: bool = False
 
 @singleton
 class DatasetPage:
     @inject
-    def __init__(self, configuration: Configuration, db: DatasetDB, predictor: Predictor):
+    def __init__(self, configuration: Configuration, db: DatasetDB, async_db: AsyncDatasetDB, predictor: Predictor):
         self._configuration = configuration
         self._db = db
+        self._async_db = async_db
         self._predictor = predictor
+        self._cache_vocabularies: dict[bytes, TagVocabulary] = {}
+        self._threshold_sweeps: dict[tuple[str, str], process_sweep.ThresholdSweep] = {}
+        self._post_process_cache = process_prediction.PostProcessCache(self._configuration.post_process_cache_size)
 
         self._settings_model_repo_default = tagger_shared.default_repo
         self._settings_general_thresh_default = self._configuration.score_general_threshold
@@ -66,8 +113,11 @@ class DatasetPage:
             self._settings_whitelist_tag_group_defaults,
         ]
 
+    # downloaded when the tag groups are first needed, so the page can be used (e.g. by the benchmarks) without network access
+    @functools.cached_property
+    def _tag_groups_parquet(self):
         try:
-            self._tag_groups_parquet = huggingface_hub.hf_hub_download(
+            return huggingface_hub.hf_hub_download(
                 'itterative/danbooru_wikis_full',
                 filename='tag_groups.parquet',
                 repo_type='dataset',
@@ -98,16 +148,78 @@ class DatasetPage:
         with open(caption_file_path, 'r') as f:
             return f.read().strip()
 
-    def _hash_file(self, path: str):
+    def _hash_file(self, path: str, file_hashes: dict[str, tuple[int, int, int, bytes]] = None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        # files that weren't touched since they were last hashed don't need to be read again
+        if not self._configuration.verify_file_hashes:
+            if file_hashes is not None:
+                size, mtime_ns, inode, file_hash = file_hashes.get(path, (None, None, None, None))
+                if (size, mtime_ns, inode) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    return file_hash
+            else:
+                file_hash = self._db.get_file_hash(path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                if file_hash is not None:
+                    return file_hash
+
         with open(path, 'rb') as f:
-            hash = hashlib.sha256(f.read())
-            return hash.digest()
+            file_hash = hashlib.file_digest(f, 'sha256').digest()
+
+        self._db.set_file_hash(path, stat.st_size, stat.st_mtime_ns, stat.st_ino, file_hash)
+        return file_hash
+
+    def _encode_results(self, prediction: Prediction):
+        vocabulary = prediction.vocabulary
+        scores = prediction.scores.astype('<f2').tobytes()
+
+        if len(vocabulary) <= CACHE_INLINE_VOCABULARY_MAX_TAGS:
+            vocabulary_data = vocabulary.to_bytes()
+            padding = b'\0' * (len(vocabulary_data) % 2)
+
+            return b''.join([CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, CACHE_FLAG_INLINE_VOCABULARY, len(vocabulary_data)), vocabulary_data, padding, scores])
+
+        self._db.set_dataset_vocabulary(vocabulary.digest, vocabulary.to_bytes())
+        return b''.join([CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, 0, 0), vocabulary.digest, scores])
+
+    def _decode_results(self, data: bytes) -> Prediction:
+        if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            return self._decode_results_legacy(data)
+
+        _, version, flags, vocabulary_size = CACHE_HEADER.unpack_from(data)
+        if version != CACHE_FORMAT_VERSION:
+            return None
+
+        offset = CACHE_HEADER.size
+
+        if flags & CACHE_FLAG_INLINE_VOCABULARY:
+            vocabulary = TagVocabulary.from_bytes(data[offset:offset+vocabulary_size])
+            offset += vocabulary_size + vocabulary_size % 2
+        else:
+            vocabulary = self._load_cache_vocabulary(data[offset:offset+DATASET_CACHE_VOCABULARY_DIGEST_SIZE])
+            offset += DATASET_CACHE_VOCABULARY_DIGEST_SIZE
+
+        # the vocabulary might have been removed from the db since, which makes the prediction unusable
+        if vocabulary is None:
+            return None
 
-    def _encode_results(self, *args):
-        return zlib.compress(pickle.dumps(args))
+        return Prediction(vocabulary, np.frombuffer(data, dtype='<f2', offset=offset))
 
-    def _decode_results(self, data: bytes):
-        return pickle.loads(zlib.decompress(data))
+    def _decode_results_legacy(self, data: bytes) -> Prediction:
+        # older caches stored the (rating, general_res, character_res) dicts
+        return Prediction.from_dicts(*pickle.loads(zlib.decompress(data)))
+
+    def _load_cache_vocabulary(self, digest: bytes):
+        vocabulary = self._cache_vocabularies.get(digest)
+
+        if vocabulary is None:
+            data = self._db.get_dataset_vocabulary(digest)
+            if data is None:
+                return None
+
+            vocabulary = self._cache_vocabularies[digest] = TagVocabulary.from_bytes(data)
+
+        return vocabulary
     
     def _load_whitelist_tag_groups(self):
         return list(map(lambda row: str(row[0]), duckdb.sql(f"select distinct tag_group from '{self._tag_groups_parquet}'").fetchall()))
@@ -133,7 +245,8 @@ class DatasetPage:
         if replace_underscores:
             tags = list(map(lambda t: t.replace('_', ' '), tags))
 
-        return tags
+        # looked up once for every tag of every image
+        return frozenset(tags)
     
     def _load_dataset_folder(
             self,
@@ -172,6 +285,36 @@ class DatasetPage:
         return all_images
 
 
+    def _read_dataset_file(self, index: int, image_path: str, model_repo: str, model: Callable[[], LoadedModel], file_hashes: dict[str, tuple[int, int, int, bytes]], cache: dict[bytes, bytes]):
+        file_hash = self._hash_file(image_path, file_hashes)
+
+        try:
+            image = Image.open(image_path)
+        except Exception as e:
+            return None
+
+        dataset_file = DatasetFile(index=index, image_path=image_path, file_hash=file_hash, image=image)
+
+        # only files which changed since they were last hashed weren't looked up ahead of time
+        if file_hash in cache:
+            data = cache[file_hash]
+        else:
+            data = self._db.get_dataset_cache(file_hash, model_repo)
+
+        if data is not None:
+            dataset_file.prediction = self._decode_results(data)
+            dataset_file.cache_outdated = not data.startswith(CACHE_MAGIC)
+
+        if dataset_file.prediction is not None:
+            # the image only needs to be decoded if there's no thumbnail for it yet
+            if not os.path.exists(self._temp_folder_gallery_path(file_hash.hex())):
+                image.load()
+        else:
+            image.load()
+            dataset_file.model_input = self._predictor.prepare_image(model(), image)
+
+        return dataset_file
+
     def _process_dataset_folder(
             self,
             folder: str,
@@ -211,74 +354,80 @@ class DatasetPage:
         all_character_res = dict()
         all_general_res = dict()
 
-        for index, file in progress.tqdm(list(enumerate(files)), desc=folder):
-            image_path = str(pathlib.Path(folder) / file)
+        all_results = [None] * len(files)
 
-            file_hash = self._hash_file(image_path)
-            file_hash_hex = file_hash.hex()
+        post_processor = process_prediction.PostProcessor(
+            # general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
+            general_thresh, False, character_thresh, False,
+            replace_underscores, trim_general_tag_dupes, escape_brackets,
+            prefix_tags, keep_tags, ban_tags, map_tags,
+            threshold_table=process_prediction.load_threshold_table(self._configuration.score_threshold_table),
+            general_top_k=self._configuration.score_general_top_k,
+            character_top_k=self._configuration.score_character_top_k,
+        )
 
-            try:
-                image = Image.open(image_path)
-            except Exception as e:
-                continue
+        threshold_sweep = process_sweep.ThresholdSweep(post_processor)
 
-            cache = self._db.get_dataset_cache(file_hash, model_repo)
-            if cache is not None:
-                rating, general_res, character_res = self._decode_results(cache)
-            else:
-                self._predictor.load_model(model_repo, device=self._configuration.device)
-                rating, general_res, character_res = self._predictor.predict(image)
-
-                self._db.set_dataset_cache(file_hash, model_repo, folder, self._encode_results(rating, general_res, character_res))
-
-            sorted_general_strings, rating, general_res, character_res = \
-                process_prediction.post_process_prediction(
-                    rating, general_res, character_res,
-                    # general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
-                    general_thresh, False, character_thresh, False,
-                    replace_underscores, trim_general_tag_dupes, escape_brackets,
-                    prefix_tags, keep_tags, ban_tags, map_tags,
-                )
-            
-            manual_edit = self._db.get_dataset_edit(folder, file_hash)
+        def _process_image(index: int, image_path: str, file_hash: bytes, image: Image.Image, prediction: Prediction, manual_edits: dict = None, post_processed: tuple = None):
+            threshold_sweep.add(prediction)
+
+            if post_processed is None:
+                post_processed = self._post_process_prediction(post_processor, model_repo, file_hash, prediction)
 
-            if merge_existing_captions and manual_edit is not None:
-                previous_edit, new_edit = manual_edit
+            all_results[index] = self._process_dataset_image(
+                folder,
+                image_path,
+                file_hash,
+                image,
+                prediction,
+                post_processor,
+                replace_underscores,
+                overwrite_current_caption,
+                merge_existing_captions,
+                prefix_tags,
+                keep_tags,
+                whitelist_tags,
+                whitelist_tag_group,
+                skip_whitelist,
+                manual_edits=manual_edits,
+                post_processed=post_processed,
+            )
 
-                existing_caption = self._load_caption_for_image_path(str(image_path))
+        image_paths = [str(pathlib.Path(folder) / file) for file in files]
 
-                # file was changed
-                if existing_caption is not None and new_edit != existing_caption:
-                    previous_edit = sorted_general_strings
-                    new_edit = existing_caption
+        file_hashes = {}
+        if not self._configuration.verify_file_hashes:
+            file_hashes = self._db.get_file_hashes([os.path.abspath(image_path) for image_path in image_paths])
 
-                    self._db.set_dataset_edit(folder, file_hash, previous_edit, new_edit)
+        hashes = list({file_hash for _, _, _, file_hash in file_hashes.values()})
+        cached = self._db.get_dataset_cache_many(hashes, model_repo)
+        cache = {file_hash: cached.get(file_hash) for file_hash in hashes}
 
-                sorted_general_strings_post = process_prediction.post_process_manual_edits(
-                    previous_edit, new_edit, sorted_general_strings,
-                    whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
-                )
-            elif merge_existing_captions and (existing_caption := self._load_caption_for_image_path(str(image_path))):
-                sorted_general_strings_post = process_prediction.post_process_manual_edits(
-                    sorted_general_strings, existing_caption, sorted_general_strings,
-                    whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
-                )
-                
-                self._db.set_dataset_edit(folder, file_hash, sorted_general_strings, existing_caption)
-                sorted_general_strings = existing_caption
-            else:
-                sorted_general_strings_post = process_prediction.post_process_manual_edits(
-                    '', '', sorted_general_strings,
-                    whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
-                )
+        cached_files = self._load_cached_dataset_files(image_paths, file_hashes, cache)
 
-            all_count += 1
+        if cached_files is not None:
+            # every prediction is already cached, so only the post processing needs to run again
+            manual_edits = self._db.get_dataset_edits(folder)
 
-            temp_image_path = self._temp_folder_gallery_path(file_hash_hex)
-            if not os.path.exists(temp_image_path):
-                image.convert("RGB").save(temp_image_path, quality=75, optimize=True)
+            for i in progress.tqdm(range(0, len(cached_files), CACHE_POST_PROCESS_BATCH_SIZE), desc=folder):
+                batch = cached_files[i:i+CACHE_POST_PROCESS_BATCH_SIZE]
+                results = self._post_process_predictions(post_processor, model_repo, [file_hash for _, _, file_hash, _ in batch], [prediction for _, _, _, prediction in batch])
 
-            all_images.append((file_hash_hex, [image_path, sorted_general_strings, sorted_general_strings_post]))
+                for (index, image_path, file_hash, prediction), post_processed in zip(batch, results):
+                    _process_image(index, image_path, file_hash, None, prediction, manual_edits=manual_edits, post_processed=post_processed)
+        else:
+            self._predict_dataset_files(folder, image_paths, model_repo, file_hashes, cache, _process_image, progress)
+
+        self._set_threshold_sweep(folder, model_repo, threshold_sweep)
+
+        for result in all_results:
+            if result is None:
+                continue
+
+            gallery_item, rating, general_res, character_res = result
+
+            all_count += 1
+            all_images.append(gallery_item)
 
             for k in rating.keys():
                 all_rating[k] = all_rating.get(k, 0) + rating[k]
@@ -289,8 +438,6 @@ class DatasetPage:
             for k in general_res.keys():
                 all_general_res[k] = all_general_res.get(k, 0) + 1
 
-            self._save_caption_for_image_path(image_path, sorted_general_strings_post, overwrite_current_caption=overwrite_current_caption)
-
         for k in all_rating.keys():
             all_rating[k] = all_rating[k] / all_count
 
@@ -303,26 +450,336 @@ class DatasetPage:
         return all_images, all_rating, all_general_res, all_character_res
 
 
+    def _load_cached_dataset_files(self, image_paths: list[str], file_hashes: dict[str, tuple[int, int, int, bytes]], cache: dict[bytes, bytes]):
+        if self._configuration.verify_file_hashes:
+            return None
+
+        cached_files = []
+
+        for index, image_path in enumerate(image_paths):
+            row = file_hashes.get(os.path.abspath(image_path))
+            if row is None:
+                return None
+
+            size, mtime_ns, inode, file_hash = row
+
+            stat = os.stat(image_path)
+            if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != (size, mtime_ns, inode):
+                return None
+
+            data = cache.get(file_hash)
+            if data is None:
+                # files which were hashed but never tagged are fine, as long as they're not images
+                if self._is_image(image_path):
+                    return None
+
+                continue
+
+            # predictions cached in an older format are rewritten by going through the whole pipeline once
+            if not data.startswith(CACHE_MAGIC):
+                return None
+
+            prediction = self._decode_results(data)
+            if prediction is None:
+                return None
+
+            if not os.path.exists(self._temp_folder_gallery_path(file_hash.hex())):
+                return None
+
+            cached_files.append((index, image_path, file_hash, prediction))
+
+        return cached_files
+
+    def _set_threshold_sweep(self, folder: str, model_repo: str, threshold_sweep: process_sweep.ThresholdSweep):
+        key = (folder, model_repo)
+
+        self._threshold_sweeps.pop(key, None)
+        if threshold_sweep.supported and threshold_sweep.images > 0:
+            self._threshold_sweeps[key] = threshold_sweep
+
+        while len(self._threshold_sweeps) > THRESHOLD_SWEEPS_MAX:
+            self._threshold_sweeps.pop(next(iter(self._threshold_sweeps)))
+
+    def _preview_thresholds(self, folder: str, model_repo: str, general_thresh: float, character_thresh: float, replace_underscores: bool):
+        threshold_sweep = self._threshold_sweeps.get((folder, model_repo))
+        if threshold_sweep is None:
+            return '<i>Submit the dataset to preview how the thresholds change its tags.</i>'
+
+        def _signed(value: float, format: str = ',d'):
+            return ('+' if value > 0 else '') + f'{value:{format}}'
+
+        rows = [
+            '| | General tags | Character tags |',
+            '| --- | --- | --- |',
+        ]
+        columns = []
+
+        for category, threshold in (('general', general_thresh), ('character', character_thresh)):
+            before = threshold_sweep.stats(category, threshold_sweep.thresholds[category])
+            after = threshold_sweep.stats(category, threshold)
+            changed_tags = threshold_sweep.changed_tags(category, before, after, THRESHOLD_PREVIEW_TAGS, replace_underscores=replace_underscores)
+
+            columns.append([
+                f'{after.threshold:.2f} (submitted with {before.threshold:.2f})',
+                f'{after.tags:,d} ({_signed(after.tags - before.tags)})',
+                f'{after.tags_per_image:.1f} ({_signed(after.tags_per_image - before.tags_per_image, ".1f")})',
+                f'{after.images_without_tags:,d} ({_signed(after.images_without_tags - before.images_without_tags)})',
+                f'{after.images_changed:,d} of {after.images:,d}',
+                ', '.join(f'{tag} ({_signed(count)})' for tag, count in changed_tags.items()) or '-',
+            ])
+
+        labels = ['Threshold', 'Tags', 'Tags per image', 'Images without tags', 'Images with changed tags', 'Most changed tags']
+        for label, general, character in zip(labels, *columns):
+            rows.append(f'| {label} | {general} | {character} |')
+
+        rows.append('')
+        rows.append('<i>Counts the tags picked by the thresholds, the threshold table and top-k, before the trim, map, ban, keep and prefix rules.</i>')
+
+        return '\n'.join(rows)
+
+    def _post_process_key(self, post_processor: process_prediction.PostProcessor, model_repo: str, file_hash: bytes):
+        # the model's prediction for a file never changes, so the results only depend on the settings
+        return (file_hash, model_repo, post_processor.fingerprint)
+
+    def _post_process_prediction(self, post_processor: process_prediction.PostProcessor, model_repo: str, file_hash: bytes, prediction: Prediction):
+        key = self._post_process_key(post_processor, model_repo, file_hash)
+
+        result = self._post_process_cache.get(key)
+        if result is None:
+            result = post_processor.process(prediction)
+            self._post_process_cache.set(key, result)
+
+        return result
+
+    def _post_process_predictions(self, post_processor: process_prediction.PostProcessor, model_repo: str, file_hashes: list[bytes], predictions: list[Prediction]):
+        keys = [self._post_process_key(post_processor, model_repo, file_hash) for file_hash in file_hashes]
+        results = [self._post_process_cache.get(key) for key in keys]
+
+        # predictions made by the same model share their vocabulary, so their scores are post processed together
+        batches: dict[int, list[int]] = {}
+        for i, prediction in enumerate(predictions):
+            if results[i] is None:
+                batches.setdefault(id(prediction.vocabulary), []).append(i)
+
+        for indexes in batches.values():
+            vocabulary = predictions[indexes[0]].vocabulary
+            scores = np.stack([predictions[i].scores for i in indexes])
+
+            for i, result in zip(indexes, post_processor.process_batch(scores, vocabulary)):
+                results[i] = result
+                self._post_process_cache.set(keys[i], result)
+
+        return results
+
+    def _is_image(self, path: str):
+        try:
+            with Image.open(path):
+                return True
+        except Exception as e:
+            return False
+
+    def _predict_dataset_files(
+            self,
+            folder: str,
+            image_paths: list[str],
+            model_repo: str,
+            file_hashes: dict[str, tuple[int, int, int, bytes]],
+            cache: dict[bytes, bytes],
+            process_image: Callable[[int, str, bytes, Image.Image, Prediction], None],
+            progress: gr.Progress,
+    ):
+        pending: list[DatasetFile] = []
+        cache_rows: list[tuple[bytes, str, str, bytes]] = []
+
+        # the model is only loaded once a file turns out not to be cached, after which the same one is used for
+        # the inputs, the predictions and the cache until the end of the run
+        models = ExitStack()
+        model_lock = threading.Lock()
+        loaded_models: list[LoadedModel] = []
+
+        def _model():
+            with model_lock:
+                if len(loaded_models) == 0:
+                    loaded_models.append(models.enter_context(self._predictor.use_model(model_repo, device=self._configuration.device)))
+
+                return loaded_models[0]
+
+        def _flush_cache_rows():
+            self._db.set_dataset_cache_many(cache_rows)
+            cache_rows.clear()
+
+        def _write_image(dataset_file: DatasetFile, prediction: Prediction, write_cache: bool):
+            if write_cache:
+                data = self._encode_results(prediction)
+                cache_rows.append((dataset_file.file_hash, model_repo, folder, data))
+
+                # continue with the stored precision, so the results don't change once read back from the cache
+                prediction = self._decode_results(data)
+
+                if len(cache_rows) >= CACHE_WRITE_BATCH_SIZE:
+                    _flush_cache_rows()
+
+            process_image(dataset_file.index, dataset_file.image_path, dataset_file.file_hash, dataset_file.image, prediction)
+
+        # files are read, hashed and decoded ahead of time by the readers, while the writer takes care of the
+        # post processing and all the db and file writes; only the inference happens on this thread
+        workers = max(1, self._configuration.dataset_workers)
+        max_queued = workers + 2 * max(1, self._configuration.batch_size)
+
+        with models, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='DatasetPage._read') as readers, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix='DatasetPage._write') as writer:
+            files_iter = iter(enumerate(image_paths))
+            reads: deque[Future] = deque()
+            writes: deque[Future] = deque()
+
+            def _queue_reads():
+                while len(reads) < max_queued:
+                    try:
+                        index, image_path = next(files_iter)
+                    except StopIteration:
+                        return
+
+                    reads.append(readers.submit(self._read_dataset_file, index, image_path, model_repo, _model, file_hashes, cache))
+
+            def _queue_write(dataset_file: DatasetFile, prediction: Prediction, write_cache: bool):
+                writes.append(writer.submit(_write_image, dataset_file, prediction, write_cache))
+
+                # don't let decoded images pile up if the writer falls behind
+                while len(writes) > max_queued:
+                    writes.popleft().result()
+
+            def _process_pending():
+                if len(pending) == 0:
+                    return
+
+                predictions = self._predictor.predict_prepared(_model(), [dataset_file.model_input for dataset_file in pending])
+
+                for dataset_file, prediction in zip(pending, predictions):
+                    dataset_file.model_input = None
+                    _queue_write(dataset_file, prediction, True)
+
+                pending.clear()
+
+            try:
+                _queue_reads()
+
+                for _ in progress.tqdm(range(len(image_paths)), desc=folder):
+                    dataset_file: DatasetFile = reads.popleft().result()
+                    _queue_reads()
+
+                    if dataset_file is None:
+                        continue
+
+                    if dataset_file.prediction is not None:
+                        _queue_write(dataset_file, dataset_file.prediction, dataset_file.cache_outdated)
+                        continue
+
+                    pending.append(dataset_file)
+
+                    if len(pending) >= self._predictor.max_batch_size(_model()):
+                        _process_pending()
+
+                _process_pending()
+
+                writes.append(writer.submit(_flush_cache_rows))
+
+                while len(writes) > 0:
+                    writes.popleft().result()
+            finally:
+                for future in reads:
+                    future.cancel()
+
+    def _process_dataset_image(
+            self,
+            folder: str,
+            image_path: str,
+            file_hash: bytes,
+            image: Image.Image,
+            prediction: Prediction,
+            post_processor: process_prediction.PostProcessor,
+            replace_underscores: bool,
+            overwrite_current_caption: bool,
+            merge_existing_captions: bool,
+            prefix_tags: str,
+            keep_tags: str,
+            whitelist_tags: str,
+            whitelist_tag_group: str,
+            skip_whitelist: bool,
+            manual_edits: dict[bytes, tuple[str, str]] = None,
+            post_processed: tuple[str, dict, dict, dict] = None,
+    ):
+        file_hash_hex = file_hash.hex()
+
+        if post_processed is None:
+            post_processed = post_processor.process(prediction)
+
+        sorted_general_strings, rating, general_res, character_res = post_processed
+        
+        if manual_edits is not None:
+            manual_edit = manual_edits.get(file_hash)
+        else:
+            manual_edit = self._db.get_dataset_edit(folder, file_hash)
+
+        if merge_existing_captions and manual_edit is not None:
+            previous_edit, new_edit = manual_edit
+
+            existing_caption = self._load_caption_for_image_path(str(image_path))
+
+            # file was changed
+            if existing_caption is not None and new_edit != existing_caption:
+                previous_edit = sorted_general_strings
+                new_edit = existing_caption
+
+                self._db.set_dataset_edit(folder, file_hash, previous_edit, new_edit)
+
+            sorted_general_strings_post = process_prediction.post_process_manual_edits(
+                previous_edit, new_edit, sorted_general_strings,
+                whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
+            )
+        elif merge_existing_captions and (existing_caption := self._load_caption_for_image_path(str(image_path))):
+            sorted_general_strings_post = process_prediction.post_process_manual_edits(
+                sorted_general_strings, existing_caption, sorted_general_strings,
+                whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
+            )
+            
+            self._db.set_dataset_edit(folder, file_hash, sorted_general_strings, existing_caption)
+            sorted_general_strings = existing_caption
+        else:
+            sorted_general_strings_post = process_prediction.post_process_manual_edits(
+                '', '', sorted_general_strings,
+                whitelist=self._process_whitelist_tag(whitelist_tag_group, whitelist_tags, 'BREAK', prefix_tags, keep_tags, replace_underscores=replace_underscores, skip=skip_whitelist)
+            )
+
+        temp_image_path = self._temp_folder_gallery_path(file_hash_hex)
+        if image is not None and not os.path.exists(temp_image_path):
+            image.convert("RGB").save(temp_image_path, quality=75, optimize=True)
+
+        self._save_caption_for_image_path(image_path, sorted_general_strings_post, overwrite_current_caption=overwrite_current_caption)
+
+        return (file_hash_hex, [image_path, sorted_general_strings, sorted_general_strings_post]), rating, general_res, character_res
+
     def _load_recent_datasets(self):
         return self._db.get_recent_datasets()
 
-    def _load_dataset_settings(self, folder: str):
-        model_repo = str(self._db.get_dataset_setting(folder, 'model_repo', default=self._settings_model_repo_default))
-        general_thresh = float(self._db.get_dataset_setting(folder, 'general_thresh', default=self._settings_general_thresh_default))
-        # general_mcut_enabled = (self.db.get_dataset_setting(folder, 'general_mcut_enabled', default=self._settings_general_mcut_enabled_default)) == 'True'
-        character_thresh = float(self._db.get_dataset_setting(folder, 'character_thresh', default=self._settings_character_thresh_default))
-        # character_mcut_enabled = (self.db.get_dataset_setting(folder, 'character_mcut_enabled', default=self._settings_character_mcut_enabled_default)) == 'True'
-        replace_underscores = (self._db.get_dataset_setting(folder, 'replace_underscores', default=self._settings_replace_underscores_default)) == 'True'
-        trim_general_tag_dupes = (self._db.get_dataset_setting(folder, 'trim_general_tag_dupes', default=self._settings_trim_general_tag_dupes_default)) == 'True'
-        escape_brackets = (self._db.get_dataset_setting(folder, 'escape_brackets', default=self._settings_escape_brackets_default)) == ''
-        overwrite_current_caption = (self._db.get_dataset_setting(folder, 'overwrite_current_caption', default=self._settings_overwrite_current_caption_default)) == 'True'
-        merge_existing_captions = (self._db.get_dataset_setting(folder, 'merge_existing_captions', default=self._settings_merge_existing_captions_default)) == 'True'
-        prefix_tags = str(self._db.get_dataset_setting(folder, 'prefix_tags', default=self._settings_prefix_tags_default))
-        keep_tags = str(self._db.get_dataset_setting(folder, 'keep_tags', default=self._settings_keep_tags_default))
-        ban_tags = str(self._db.get_dataset_setting(folder, 'ban_tags', default=self._settings_ban_tags_default))
-        map_tags = str(self._db.get_dataset_setting(folder, 'map_tags', default=self._settings_map_tags_default))
-        whitelist_tags = str(self._db.get_dataset_setting(folder, 'whitelist_tags', default=self._settings_whitelist_tags_defaults))
-        whitelist_tag_group = str(self._db.get_dataset_setting(folder, 'whitelist_tag_group', default=self._settings_whitelist_tag_group_defaults))
+    async def _load_dataset_settings(self, folder: str):
+        settings = await self._async_db.get_dataset_settings(folder)
+
+        model_repo = str(settings.get('model_repo', self._settings_model_repo_default))
+        general_thresh = float(settings.get('general_thresh', self._settings_general_thresh_default))
+        # general_mcut_enabled = settings.get('general_mcut_enabled', self._settings_general_mcut_enabled_default) == 'True'
+        character_thresh = float(settings.get('character_thresh', self._settings_character_thresh_default))
+        # character_mcut_enabled = settings.get('character_mcut_enabled', self._settings_character_mcut_enabled_default) == 'True'
+        replace_underscores = settings.get('replace_underscores', self._settings_replace_underscores_default) == 'True'
+        trim_general_tag_dupes = settings.get('trim_general_tag_dupes', self._settings_trim_general_tag_dupes_default) == 'True'
+        escape_brackets = settings.get('escape_brackets', self._settings_escape_brackets_default) == ''
+        overwrite_current_caption = settings.get('overwrite_current_caption', self._settings_overwrite_current_caption_default) == 'True'
+        merge_existing_captions = settings.get('merge_existing_captions', self._settings_merge_existing_captions_default) == 'True'
+        prefix_tags = str(settings.get('prefix_tags', self._settings_prefix_tags_default))
+        keep_tags = str(settings.get('keep_tags', self._settings_keep_tags_default))
+        ban_tags = str(settings.get('ban_tags', self._settings_ban_tags_default))
+        map_tags = str(settings.get('map_tags', self._settings_map_tags_default))
+        whitelist_tags = str(settings.get('whitelist_tags', self._settings_whitelist_tags_defaults))
+        whitelist_tag_group = str(settings.get('whitelist_tag_group', self._settings_whitelist_tag_group_defaults))
 
         return [
             model_repo,
@@ -343,7 +800,7 @@ class DatasetPage:
             whitelist_tag_group,
         ]
 
-    def _save_dataset_settings(
+    async def _save_dataset_settings(
             self,
             folder: str,
             model_repo: str,
@@ -363,22 +820,24 @@ class DatasetPage:
             whitelist_tags: str,
             whitelist_tag_group: str,
     ):
-        self._db.set_dataset_setting(folder, 'model_repo', str(model_repo))
-        self._db.set_dataset_setting(folder, 'general_thresh', str(general_thresh))
-        # self.db.set_dataset_setting(folder, 'general_mcut_enabled', str(general_mcut_enabled))
-        self._db.set_dataset_setting(folder, 'character_thresh', str(character_thresh))
-        # self.db.set_dataset_setting(folder, 'character_mcut_enabled', str(character_mcut_enabled))
-        self._db.set_dataset_setting(folder, 'replace_underscores', str(replace_underscores))
-        self._db.set_dataset_setting(folder, 'trim_general_tag_dupes', str(trim_general_tag_dupes))
-        self._db.set_dataset_setting(folder, 'escape_brackets', str(escape_brackets))
-        self._db.set_dataset_setting(folder, 'overwrite_current_caption', str(overwrite_current_caption))
-        self._db.set_dataset_setting(folder, 'merge_existing_captions', str(merge_existing_captions))
-        self._db.set_dataset_setting(folder, 'prefix_tags', str(prefix_tags))
-        self._db.set_dataset_setting(folder, 'keep_tags', str(keep_tags))
-        self._db.set_dataset_setting(folder, 'ban_tags', str(ban_tags))
-        self._db.set_dataset_setting(folder, 'map_tags', str(map_tags))
-        self._db.set_dataset_setting(folder, 'whitelist_tags', str(whitelist_tags))
-        self._db.set_dataset_setting(folder, 'whitelist_tag_group', str(whitelist_tag_group))
+        await self._async_db.set_dataset_settings(folder, {
+            'model_repo': str(model_repo),
+            'general_thresh': str(general_thresh),
+            # 'general_mcut_enabled': str(general_mcut_enabled),
+            'character_thresh': str(character_thresh),
+            # 'character_mcut_enabled': str(character_mcut_enabled),
+            'replace_underscores': str(replace_underscores),
+            'trim_general_tag_dupes': str(trim_general_tag_dupes),
+            'escape_brackets': str(escape_brackets),
+            'overwrite_current_caption': str(overwrite_current_caption),
+            'merge_existing_captions': str(merge_existing_captions),
+            'prefix_tags': str(prefix_tags),
+            'keep_tags': str(keep_tags),
+            'ban_tags': str(ban_tags),
+            'map_tags': str(map_tags),
+            'whitelist_tags': str(whitelist_tags),
+            'whitelist_tag_group': str(whitelist_tag_group),
+        })
 
 
     def ui(self):
@@ -421,6 +880,9 @@ class DatasetPage:
                             scale=3,
                         )
 
+                    # shows what the thresholds would do to the whole dataset while dragging the sliders
+                    threshold_preview = gr.Markdown()
+
                     with gr.Row(variant='panel'):
                         overwrite_current_caption = gr.Checkbox(
                             value=False,
@@ -703,7 +1165,7 @@ class DatasetPage:
             inputs=[gallery_selection, gallery_cache, gallery_tags_edit],
             outputs=[gallery_cache],
         )
-        def _on_gallery_save(selection: tuple[str, str], all_images: list[tuple[str, tuple[str, str, str]]], caption: str):
+        async def _on_gallery_save(selection: tuple[str, str], all_images: list[tuple[str, tuple[str, str, str]]], caption: str):
             with ui_utils.gradio_warning():
                 assert len(selection) > 0, "No gallery image selected"
 
@@ -717,7 +1179,7 @@ class DatasetPage:
                 image_path, initial_edit, _ = gallery_item[1]
 
                 self._save_caption_for_image_path(image_path, caption, overwrite_current_caption=True)
-                self._db.set_dataset_edit(folder, file_hash, initial_edit, caption)
+                await self._async_db.set_dataset_edit(folder, file_hash, initial_edit, caption)
 
                 try:
                     all_images_i = list(map(lambda i: i[0], all_images)).index(file_hash_hex)
@@ -730,6 +1192,18 @@ class DatasetPage:
             return all_images
 
 
+        @gr.on(
+            (general_thresh.change, character_thresh.change, model_repo.change, folder.change, replace_underscores.change, gallery_cache.change),
+            inputs=[folder, model_repo, general_thresh, character_thresh, replace_underscores],
+            outputs=[threshold_preview],
+            show_progress='hidden',
+        )
+        def _preview_thresholds(folder: str, model_repo: str, general_thresh: float, character_thresh: float, replace_underscores: bool):
+            with ui_utils.gradio_warning():
+                return self._preview_thresholds(folder, model_repo, general_thresh, character_thresh, replace_underscores)
+
+            return None
+
         @gr.on(
             page.load,
             outputs=[
@@ -752,11 +1226,11 @@ class DatasetPage:
                 whitelist_tag_groups,
             ],
         )
-        def _load_recent_datasets():
+        async def _load_recent_datasets():
             with ui_utils.gradio_warning():
-                choices = self._load_recent_datasets()
+                choices = await self._async_db.get_recent_datasets()
                 value = choices[0] if len(choices) > 0 else None
-                settings = self._load_dataset_settings(value) if value is not None else self._settings_defaults
+                settings = await self._load_dataset_settings(value) if value is not None else self._settings_defaults
 
                 return [gr.Dropdown(value=value, choices=choices)] + settings
 
@@ -784,9 +1258,9 @@ class DatasetPage:
                 whitelist_tag_groups,
             ],
         )
-        def _load_dataset_settings(folder: str):
+        async def _load_dataset_settings(folder: str):
             with ui_utils.gradio_warning():
-                return self._load_dataset_settings(folder)
+                return await self._load_dataset_settings(folder)
             
             return self._settings_defaults
         
@@ -917,6 +1391,6 @@ class DatasetPage:
                 whitelist_tag_groups,
             ],
         )
-        def _save_dataset_settings(*args):
+        async def _save_dataset_settings(*args):
             with ui_utils.gradio_warning():
-                self._save_dataset_settings(*args)
+                await self._save_dataset_settings(*args)
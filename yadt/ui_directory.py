@@ -36,7 +36,7 @@ class DirectoryPage:
         assert len(folder) > 0, "No folder given"
         assert os.path.isdir(folder), "Folder either doesn't exist or is not a folder"
 
-        self._predictor.load_model(model_repo, device=self._configuration.device)
+        model = self._predictor.load_model(model_repo, device=self._configuration.device)
 
         files = os.listdir(folder)
         files = list(filter(lambda f: not f.endswith('.txt') and not f.endswith('.npz'), files))
@@ -46,6 +46,13 @@ class DirectoryPage:
         all_character_res = dict()
         all_general_res = dict()
 
+        post_processor = process_prediction.PostProcessor(
+            general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
+            replace_underscores, trim_general_tag_dupes, escape_brackets,
+            threshold_table=process_prediction.load_threshold_table(self._configuration.score_threshold_table),
+            general_top_k=self._configuration.score_general_top_k,
+            character_top_k=self._configuration.score_character_top_k,
+        )
         
         for index, file in progress.tqdm(list(enumerate(files))):
             try:
@@ -53,12 +60,7 @@ class DirectoryPage:
             except Exception as e:
                 continue
 
-            sorted_general_strings, rating, general_res, character_res = \
-                process_prediction.post_process_prediction(
-                    *self._predictor.predict(image),
-                    general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
-                    replace_underscores, trim_general_tag_dupes, escape_brackets,
-                )
+            sorted_general_strings, rating, general_res, character_res = post_processor.process(self._predictor.predict(model, image))
 
             all_count += 1
 
@@ -32,13 +32,17 @@ class ImagePage:
     ):
         assert image is not None, "No image selected"
 
-        self._predictor.load_model(model_repo, device=self._configuration.device)
+        model = self._predictor.load_model(model_repo, device=self._configuration.device)
 
-        return process_prediction.post_process_prediction(
-            *self._predictor.predict(image),
+        post_processor = process_prediction.PostProcessor(
             general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled,
             replace_underscores, trim_general_tag_dupes, escape_brackets,
+            threshold_table=process_prediction.load_threshold_table(self._configuration.score_threshold_table),
+            general_top_k=self._configuration.score_general_top_k,
+            character_top_k=self._configuration.score_character_top_k,
         )
+
+        return post_processor.process(self._predictor.predict(model, image))
     
 
     def ui(self):
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import pathlib
 
 import gradio as gr
@@ -8,13 +9,13 @@ from injector import inject, singleton
 from yadt import ui_utils
 
 from yadt.configuration import Configuration
-from yadt.db_dataset import DatasetDB
+from yadt.db_dataset import AsyncDatasetDB
 from yadt.ui_shared import SharedState
 
 @singleton
 class MiscPage:
     @inject
-    def __init__(self, configuration: Configuration, dataset_db: DatasetDB, shared_state: SharedState):
+    def __init__(self, configuration: Configuration, dataset_db: AsyncDatasetDB, shared_state: SharedState):
         self._configuration = configuration
         self._dataset_db = dataset_db
         self._shared_state = shared_state
@@ -23,47 +24,76 @@ class MiscPage:
     def _database_size(self):
         return os.stat(self._dataset_db.path).st_size
 
-    def _dataset_cache_for_repo_name(self):
+    async def _dataset_cache_for_repo_name(self):
         return sorted(
-            [ui_utils.NO_DROPDOWN_SELECTION] + self._dataset_db.get_dataset_cache_for_repo_name(),
+            [ui_utils.NO_DROPDOWN_SELECTION] + await self._dataset_db.get_dataset_cache_for_repo_name(),
             key=ui_utils.natural_sort,
         )
 
-    def _dataset_cache_usage_for_repo_name(self):
+    async def _dataset_cache_usage_for_repo_name(self):
         return sorted(
-            [ [row['repo_name'], ui_utils.human_readable_bytes(row['bytes'])] for row in self._dataset_db.get_dataset_cache_usage_for_repo_name() ],
+            [ [row['repo_name'], row['rows'], ui_utils.human_readable_bytes(row['bytes'])] for row in await self._dataset_db.get_dataset_cache_usage_for_repo_name() ],
             key=lambda r: ui_utils.natural_sort(r[0]),
         )
 
-    def _dataset_cache_for_dataset(self):
+    async def _dataset_cache_for_dataset(self):
         return sorted(
-            [ui_utils.NO_DROPDOWN_SELECTION] + [ row or 'UNKNOWN' for row in self._dataset_db.get_dataset_cache_for_dataset() ],
+            [ui_utils.NO_DROPDOWN_SELECTION] + [ row or 'UNKNOWN' for row in await self._dataset_db.get_dataset_cache_for_dataset() ],
             key=ui_utils.natural_sort,
         )
 
-    def _dataset_cache_usage_for_dataset(self):
+    async def _dataset_cache_usage_for_dataset(self):
         return sorted(
-            [ [row['dataset'] or 'UNKNOWN', ui_utils.human_readable_bytes(row['bytes'])] for row in self._dataset_db.get_dataset_cache_usage_for_dataset() ],
+            [ [row['dataset'] or 'UNKNOWN', row['rows'], ui_utils.human_readable_bytes(row['bytes'])] for row in await self._dataset_db.get_dataset_cache_usage_for_dataset() ],
             key=lambda r: ui_utils.natural_sort(r[0]),
         )
 
-    def _reset_database(self):
-        self._dataset_db.reset()
+    def _connection_pool_metrics(self):
+        metrics = self._dataset_db.pool_metrics()
+
+        def format_seconds(seconds: float):
+            return f'{seconds * 1000:g} ms' if seconds < 1 else f'{seconds:g} s'
+
+        rows = [
+            ['Connections in use', metrics.in_use],
+            ['Idle connections', metrics.idle],
+            ['Waiting for a connection', metrics.waiting],
+            ['Connections opened', metrics.opens],
+            ['Connections closed', metrics.closes],
+            ['Idle evictions', metrics.idle_evictions],
+            ['Failed health checks', metrics.failed_health_checks],
+            ['Checkouts', metrics.checkouts],
+            ['Average wait', format_seconds(metrics.wait_seconds / metrics.checkouts if metrics.checkouts > 0 else 0)],
+        ]
+
+        lower_bound = None
+        for upper_bound, checkouts in metrics.wait_histogram:
+            if upper_bound == float('inf'):
+                rows.append([f'Waits over {format_seconds(lower_bound)}', checkouts])
+            else:
+                rows.append([f'Waits up to {format_seconds(upper_bound)}', checkouts])
+
+            lower_bound = upper_bound
+
+        return rows
+
+    async def _reset_database(self):
+        await self._dataset_db.reset()
 
-    def _drop_dataset_cache_for_repo_name(self, repo_name: str):
+    async def _drop_dataset_cache_for_repo_name(self, repo_name: str):
         if repo_name == ui_utils.NO_DROPDOWN_SELECTION:
             pass
         else:
-            self._dataset_db.delete_dataset_cache_by_repo_name(repo_name)
+            await self._dataset_db.delete_dataset_cache_by_repo_name(repo_name)
     
-    def _drop_dataset_cache_for_dataset(self, dataset: str):
+    async def _drop_dataset_cache_for_dataset(self, dataset: str):
         if dataset == ui_utils.NO_DROPDOWN_SELECTION:
             pass
         else:
             if dataset == 'UNKNOWN':
                 dataset = None
 
-            self._dataset_db.delete_dataset_cache_by_dataset(dataset)
+            await self._dataset_db.delete_dataset_cache_by_dataset(dataset)
 
     def _cache_folder_size(self):
         def dutree(p: pathlib.Path):
@@ -100,11 +130,11 @@ class MiscPage:
                     
                     with gr.Column(variant="panel"):
                         with gr.Row(equal_height=True):
-                            dataset_cache_for_repo_name_dropdown = gr.Dropdown(choices=self._dataset_cache_for_repo_name(), value=ui_utils.NO_DROPDOWN_SELECTION, interactive=True, label="Clear model cache", scale=1)
+                            dataset_cache_for_repo_name_dropdown = gr.Dropdown(choices=[ui_utils.NO_DROPDOWN_SELECTION], value=ui_utils.NO_DROPDOWN_SELECTION, interactive=True, label="Clear model cache", scale=1)
                             dataset_cache_for_repo_name_clear = gr.Button(value="Clear", variant="primary", scale=0)
 
                         with gr.Row(equal_height=True):
-                            dataset_cache_for_dataset_dropdown = gr.Dropdown(choices=self._dataset_cache_for_dataset(), value=ui_utils.NO_DROPDOWN_SELECTION, interactive=True, label="Clear dataset cache", scale=1)
+                            dataset_cache_for_dataset_dropdown = gr.Dropdown(choices=[ui_utils.NO_DROPDOWN_SELECTION], value=ui_utils.NO_DROPDOWN_SELECTION, interactive=True, label="Clear dataset cache", scale=1)
                             dataset_cache_for_dataset_clear = gr.Button(value="Clear", variant="primary", scale=0)
 
                     with gr.Column(variant="panel"):
@@ -129,15 +159,19 @@ class MiscPage:
                     with gr.Column(variant="panel"):
                         gr.HTML('<p>Cache usage by model</p>')
                         cache_usage_by_model = gr.DataFrame(
-                            headers=['Model', 'Usage'],
-                            value=self._dataset_cache_usage_for_repo_name(),
+                            headers=['Model', 'Entries', 'Usage'],
                         )
 
                     with gr.Column(variant="panel"):
                         gr.HTML('<p>Cache usage by dataset</p><p style="font-size: 0.8em"><i>Caches might be shared between datasets, so total cache usage might be lower</i></p>')
                         cache_usage_by_dataset = gr.DataFrame(
-                            headers=['Dataset', 'Usage'],
-                            value=self._dataset_cache_usage_for_dataset(),
+                            headers=['Dataset', 'Entries', 'Usage'],
+                        )
+
+                    with gr.Column(variant="panel"):
+                        gr.HTML('<p>Connection pool</p>')
+                        connection_pool = gr.DataFrame(
+                            headers=['Metric', 'Value'],
                         )
 
         @gr.on(
@@ -169,13 +203,13 @@ class MiscPage:
                 cache_usage_by_model,
             ],
         )
-        def _drop_dataset_cache_for_repo_name(repo_name: str):
+        async def _drop_dataset_cache_for_repo_name(repo_name: str):
             with ui_utils.gradio_warning():
-                self._drop_dataset_cache_for_repo_name(repo_name)
+                await self._drop_dataset_cache_for_repo_name(repo_name)
 
             return [
-                gr.Dropdown(choices=self._dataset_cache_for_repo_name()),
-                self._dataset_cache_usage_for_repo_name(),
+                gr.Dropdown(choices=await self._dataset_cache_for_repo_name()),
+                await self._dataset_cache_usage_for_repo_name(),
             ]
 
         @gr.on(
@@ -186,30 +220,40 @@ class MiscPage:
                 cache_usage_by_dataset,
             ],
         )
-        def _drop_dataset_cache_for_dataset(dataset: str):
+        async def _drop_dataset_cache_for_dataset(dataset: str):
             with ui_utils.gradio_warning():
-                self._drop_dataset_cache_for_dataset(dataset)
+                await self._drop_dataset_cache_for_dataset(dataset)
 
             return [
-                gr.Dropdown(choices=self._dataset_cache_for_dataset()),
-                self._dataset_cache_usage_for_dataset(),
+                gr.Dropdown(choices=await self._dataset_cache_for_dataset()),
+                await self._dataset_cache_usage_for_dataset(),
             ]
 
         @gr.on(
-            (refresh.click, self._shared_state.db_cleared.change, self._shared_state.cache_cleared.change),
+            (page.load, refresh.click, self._shared_state.db_cleared.change, self._shared_state.cache_cleared.change),
             outputs=[
                 dataset_cache_for_repo_name_dropdown,
                 dataset_cache_for_dataset_dropdown,
                 cache_usage_by_model,
                 cache_usage_by_dataset,
+                connection_pool,
             ],
         )
-        def _refresh_database():
-            return [
-                gr.Dropdown(choices=self._dataset_cache_for_repo_name()),
-                gr.Dropdown(choices=self._dataset_cache_for_dataset()),
+        async def _refresh_database():
+            # the queries don't wait on each other, as they're run on a pool of connections
+            choices_for_repo_name, choices_for_dataset, usage_for_repo_name, usage_for_dataset = await asyncio.gather(
+                self._dataset_cache_for_repo_name(),
+                self._dataset_cache_for_dataset(),
                 self._dataset_cache_usage_for_repo_name(),
                 self._dataset_cache_usage_for_dataset(),
+            )
+
+            return [
+                gr.Dropdown(choices=choices_for_repo_name),
+                gr.Dropdown(choices=choices_for_dataset),
+                usage_for_repo_name,
+                usage_for_dataset,
+                self._connection_pool_metrics(),
             ]
         
         @gr.on(
@@ -217,9 +261,9 @@ class MiscPage:
             inputs=[self._shared_state.db_cleared],
             outputs=[self._shared_state.db_cleared],
         )
-        def _reset_database(previous_state):
+        async def _reset_database(previous_state):
             with ui_utils.gradio_warning():
-                self._reset_database()
+                await self._reset_database()
 
                 gr.Info('Dataset database folder has been reset.')
 
@@ -232,8 +276,10 @@ class MiscPage:
             inputs=[dataset_db_title],
             outputs=[dataset_db_title],
         )
-        def _vacuum_database(previous_title: str):
-            self._dataset_db.vacuum()
+        async def _vacuum_database(previous_title: str):
+            with ui_utils.gradio_warning():
+                await self._dataset_db.vacuum()
+
             return _dataset_db_title(previous_title)
 
 
@@ -242,10 +288,10 @@ class MiscPage:
             inputs=[self._shared_state.cache_cleared],
             outputs=[self._shared_state.cache_cleared],
         )
-        def _drop_cache_folder(previous_state):
+        async def _drop_cache_folder(previous_state):
             with ui_utils.gradio_warning():
-                self._drop_cache_folder()
-                self._reset_database()
+                await asyncio.to_thread(self._drop_cache_folder)
+                await self._reset_database()
 
                 gr.Info('Cache folder has been cleared.')
 